@@ -1,9 +1,9 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, Response, stream_with_context, g, has_app_context, has_request_context, get_flashed_messages
 from flask_sqlalchemy import SQLAlchemy
+from markupsafe import escape
 from datetime import datetime, timedelta
 import os
 import pytz
-import qrcode
 import io
 import base64
 import hashlib
@@ -12,6 +12,35 @@ from sqlalchemy import text
 import uuid
 from sqlalchemy import func
 import json
+import csv
+import click
+import threading
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from PIL import Image
+import itertools
+import sys
+import random
+import math
+import sqlite3
+import requests
+import requests.adapters
+import tempfile
+import shutil
+import types
+import difflib
+import gzip
+import zlib
+from collections import Counter, OrderedDict
+from sqlalchemy import event
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.orm import Session as SASession
+
+from qr_posters import render_qr_png, render_qr_poster
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your_secret_key')
@@ -26,6 +55,9 @@ def get_database_url():
     if not DATABASE_URL:
         print("No DATABASE_URL found, using SQLite")
         return 'sqlite:///shifts.db'
+    if DATABASE_URL.startswith("sqlite"):
+        # A scratch database (tests, benchmarks)
+        return DATABASE_URL
     
     # Test if PostgreSQL is accessible
     try:
@@ -105,14 +137,21 @@ def cleanup_db_session():
     except Exception as e:
         print(f"Error cleaning up session: {e}")
 
+# Set once the tables are known to exist; they are never dropped while the app runs
+_tables_verified = False
+
 def ensure_tables_exist():
     """Ensure database tables exist, create them if they don't"""
+    global _tables_verified
+    if _tables_verified:
+        return True
     try:
         with app.app_context():
             # Check if tables exist by trying to query them
             db.session.execute(text("SELECT 1 FROM shift LIMIT 1"))
             db.session.commit()
             print("Database tables already exist")
+        _tables_verified = True
         return True
     except Exception as e:
         print(f"Tables don't exist or error: {e}")
@@ -120,12 +159,15 @@ def ensure_tables_exist():
             with app.app_context():
                 db.create_all()
                 print("Database tables created successfully")
+            _tables_verified = True
             return True
         except Exception as create_error:
             print(f"Failed to create tables: {create_error}")
             return False
 
-init_database()
+if multiprocessing.parent_process() is None:
+    # Not in a QR print pool process, which only renders images
+    init_database()
 
 # Job site timezone mapping
 JOB_SITE_TIMEZONES = {
@@ -188,10 +230,15 @@ class Shift(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     qr_batch_id = db.Column(db.String(64))  # New column for QR batch ID
     flagged = db.Column(db.Boolean, default=False)  # Auto-closed or problematic shift
+    __table_args__ = (
+        db.Index('ix_shift_code_clock_in', 'code', 'clock_in'),
+        db.Index('ix_shift_clock_out', 'clock_out'),
+        db.Index('ix_shift_qr_batch_id_clock_in', 'qr_batch_id', 'clock_in'),
+    )
 
 class Break(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    shift_code = db.Column(db.String(16), nullable=False)  # No longer a ForeignKey
+    shift_code = db.Column(db.String(16), nullable=False, index=True)  # No longer a ForeignKey
     start = db.Column(db.DateTime, nullable=False)
     end = db.Column(db.DateTime)
     # No foreign key constraint on shift_code
@@ -212,6 +259,106 @@ class WorkerCode(db.Model):
     code = db.Column(db.String(16), unique=True, nullable=False)
     __table_args__ = (db.UniqueConstraint('name', 'subcontractor', name='uix_worker_name_sub'),)
 
+class WorkerDirectory(db.Model):
+    """Every name/subcontractor/code seen at clock-in; backs the worker search index"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    subcontractor = db.Column(db.String(120), nullable=False)
+    code = db.Column(db.String(16), nullable=False)
+    first_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('name', 'subcontractor', 'code', name='uix_worker_directory'),)
+
+class SiteOccupancy(db.Model):
+    """Live count of workers on site per job site and subcontractor"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_site = db.Column(db.String(255), nullable=False)
+    subcontractor = db.Column(db.String(120), nullable=False)
+    on_site = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('job_site', 'subcontractor', name='uix_occupancy_site_sub'),)
+
+class DashboardEvent(db.Model):
+    """Short-lived feed of shift changes pushed to open admin dashboards"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class DataVersion(db.Model):
+    """Counter bumped in the same transaction as every write to a tracked table"""
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ClockEvent(db.Model):
+    """Append-only log of punches and corrections; shift and break rows are projections of it"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    shift_id = db.Column(db.Integer)
+    break_id = db.Column(db.Integer)
+    code = db.Column(db.String(16))
+    occurred_at = db.Column(db.DateTime, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    payload = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_clock_event_shift_id', 'shift_id', 'id'),
+        db.Index('ix_clock_event_occurred_at', 'occurred_at', 'id'),
+    )
+
+class ShiftAnomaly(db.Model):
+    """Why the anomaly analyzer flagged a shift; one row per shift and check"""
+    id = db.Column(db.Integer, primary_key=True)
+    shift_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    detail = db.Column(db.String(255))
+    detected_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('shift_id', 'kind', name='uix_shift_anomaly'),)
+
+class JobWatermark(db.Model):
+    """How far a periodic job has got through an append-only table"""
+    name = db.Column(db.String(64), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ManpowerHour(db.Model):
+    """Person-seconds on site per site-local hour, from closed shifts (the heatmap cube)"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_site = db.Column(db.String(255), nullable=False)
+    subcontractor = db.Column(db.String(120), nullable=False)
+    local_date = db.Column(db.Date, nullable=False)
+    hour = db.Column(db.SmallInteger, nullable=False)
+    person_seconds = db.Column(db.Float, nullable=False, default=0)
+    shifts = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('job_site', 'subcontractor', 'local_date', 'hour', name='uix_manpower_hour'),
+        db.Index('ix_manpower_hour_site_date', 'job_site', 'local_date'),
+    )
+
+class PunchReceipt(db.Model):
+    """Result of a punch sent with an idempotency key, so a resend is answered, not replayed"""
+    key = db.Column(db.String(64), primary_key=True)
+    action = db.Column(db.String(16))
+    # What was asked for under this key; a different punch sent with the same key is refused
+    request_hash = db.Column(db.String(64))
+    result = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class OutboxMessage(db.Model):
+    """Outbound API call written in the transaction it reports on; sent later by the outbox dispatcher"""
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(36))
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_outbox_message_status_next', 'status', 'next_attempt_at'),
+    )
+
 JOB_SITES = list(JOB_SITE_TIMEZONES.keys())
 
 def generate_code():
@@ -223,30 +370,41 @@ def generate_code():
             return code
 
 def get_or_create_code(name: str, subcontractor: str) -> str:
-    """Return existing persistent code for worker or create a new one."""
-    worker = WorkerCode.query.filter_by(name=name, subcontractor=subcontractor).first()
+    """Return existing persistent code for worker or create a new one (caller commits)."""
+    worker = lookup_worker(name=name, subcontractor=subcontractor)
     if worker:
         return worker.code
     # Generate a new unique code
     code = generate_code()
     new_worker = WorkerCode(name=name, subcontractor=subcontractor, code=code)
     db.session.add(new_worker)
-    db.session.commit()
+    record_worker(name, subcontractor, code)
     return code
 
 def get_worker_by_code(code: str):
-    return WorkerCode.query.filter_by(code=code).first()
+    return lookup_worker(code=code)
 
 def format_seconds(secs):
     hours = int(secs // 3600)
     minutes = int((secs % 3600) // 60)
     return f"{hours}h {minutes}m"
 
+def parse_duration_hours(value):
+    """Hours in a format_seconds() string such as '7h 30m' (0 when empty)"""
+    if not value:
+        return 0.0
+    time_parts = value.split()
+    hours = float(time_parts[0].replace('h', ''))
+    minutes = float(time_parts[1].replace('m', '')) if len(time_parts) > 1 else 0
+    return hours + (minutes / 60)
+
 @app.route("/reset-session")
 def reset_session():
     """Reset database session to fix binding issues"""
+    global _tables_verified
     try:
         cleanup_db_session()
+        _tables_verified = False
         # Ensure tables exist after session reset
         ensure_tables_exist()
         return {
@@ -359,7 +517,7 @@ def health_check():
 @app.route("/", methods=["GET", "POST"])
 def index():
     try:
-        close_overdue_shifts()
+        sweep_overdue_shifts()
     except Exception as e:
         print(f"Error in close_overdue_shifts: {e}")
         # Continue running even if database operations fail
@@ -385,21 +543,41 @@ def index():
                     return redirect(url_for("index"))
                 
                 # Check if already clocked in at any job site
-                existing_shift = Shift.query.filter_by(name=name, subcontractor=subcontractor, clock_out=None).first()
+                existing_shift = lookup_open_shift(name, subcontractor)
                 if existing_shift:
-                    flash(f"You are already clocked in at job site: {existing_shift.job_site}.", "error")
+                    flash(f"You are already clocked in at job site: {existing_shift[1]}.", "error")
                     return redirect(url_for("index"))
                 
-                code = get_or_create_code(name, subcontractor)
-                shift = Shift(name=name, subcontractor=subcontractor, job_site=job_site, clock_in=now, code=code)
-                db.session.add(shift)
-                db.session.commit()
+                # A new name close to an existing worker is usually a typo: ask before creating a second code.
+                # The page never shows the matched name or its code; a returning worker proves who they
+                # are by typing their code, which goes through the quick clock-in.
+                # Only here: scan-page punches are queued on the phone and may be sent after the
+                # worker has walked away, so there is nobody to ask (see api_punch).
+                if not request.form.get("confirm_new") and not lookup_worker(name=name, subcontractor=subcontractor):
+                    try:
+                        similar = find_similar_worker(name, subcontractor)
+                    except Exception as e:
+                        print(f"Error looking up similar workers: {e}")
+                        db.session.rollback()
+                        similar = None
+                    if similar:
+                        return kiosk_response(render_template(
+                            "index.html",
+                            job_sites=JOB_SITES,
+                            subcontractors=get_subcontractor_suggestions(),
+                            duplicate_check={"name": name, "subcontractor": subcontractor, "job_site": job_site},
+                        ))
+                
+                code = run_punch(punch_clock_in, name, subcontractor, job_site, now)
                 flash(
                     f"Your code is: <b>{code}</b><br>"
                     f"<span style='color:red;'>This code is required to clock out. Please write it down or remember it. It will not be shown again!</span>",
                     "success"
                 )
                 return redirect(url_for("index"))
+            except PunchError as e:
+                flash(str(e), "error")
+                return redirect(url_for("index"))
             except Exception as e:
                 print(f"Error in clockin: {e}")
                 flash("Database error. Please try again later.", "error")
@@ -411,18 +589,11 @@ def index():
                 if not input_code:
                     flash("Please enter your code to start a break.", "error")
                     return redirect(url_for("index"))
-                shift = Shift.query.filter_by(code=input_code).first()
-                if not shift:
-                    flash("Code not found.", "error")
-                    return redirect(url_for("index"))
-                last_break = Break.query.filter_by(shift_code=input_code).order_by(Break.id.desc()).first()
-                if not last_break or last_break.end is not None:
-                    new_break = Break(shift_code=input_code, start=now)
-                    db.session.add(new_break)
-                    db.session.commit()
-                    flash("Break started.", "success")
-                else:
-                    flash("You are already on a break.", "error")
+                run_punch(punch_break_start, input_code, now)
+                flash("Break started.", "success")
+                return redirect(url_for("index"))
+            except PunchError as e:
+                flash(str(e), "error")
                 return redirect(url_for("index"))
             except Exception as e:
                 print(f"Error in break: {e}")
@@ -435,14 +606,11 @@ def index():
                 if not input_code:
                     flash("Please enter your code to resume.", "error")
                     return redirect(url_for("index"))
-                last_break = Break.query.filter_by(shift_code=input_code).order_by(Break.id.desc()).first()
-                if last_break and last_break.end is None:
-                    last_break.end = now
-                    db.session.commit()
-                    flash("Break ended.", "success")
-                else:
-                    flash("No break to resume.", "error")
-                    return redirect(url_for("index"))
+                run_punch(punch_break_end, input_code, now)
+                flash("Break ended.", "success")
+            except PunchError as e:
+                flash(str(e), "error")
+                return redirect(url_for("index"))
             except Exception as e:
                 print(f"Error in resume: {e}")
                 flash("Database error. Please try again later.", "error")
@@ -454,39 +622,21 @@ def index():
                 if not input_code:
                     flash("Please enter your code to clock out.", "error")
                     return redirect(url_for("index"))
-                shift = Shift.query.filter_by(code=input_code, clock_out=None).order_by(Shift.clock_in.desc()).first()
-                if not shift:
+                times = run_punch(punch_clock_out, input_code, now)
+                if times is None:
                     flash("Code not found. Please check your code.", "error")
                     return redirect(url_for("index"))
-                if shift.clock_out:
-                    flash("You have already clocked out for this shift.", "error")
-                    return redirect(url_for("index"))
-                clock_in_dt = shift.clock_in
-                clock_out_dt = now
-                total_time = clock_out_dt - clock_in_dt
-                breaks = Break.query.filter_by(shift_code=input_code).all()
-                total_break = 0
-                breaks_str = ""
-                if breaks:
-                    for b in breaks:
-                        if b.start and b.end:
-                            total_break += (b.end - b.start).total_seconds()
-                    breaks_str = "; ".join(
-                        f"{b.start.strftime('%I:%M %p')} - {b.end.strftime('%I:%M %p')}" for b in breaks if b.start and b.end
-                    )
-                working_time = total_time.total_seconds() - total_break
-                shift.clock_out = clock_out_dt
-                shift.total_time = format_seconds(total_time.total_seconds())
-                shift.working_time = format_seconds(working_time)
-                shift.breaks = breaks_str
-                db.session.commit()
+                total_seconds, working_seconds = times
                 flash(
                     f"Shift complete!<br>"
-                    f"Total time: <b>{format_seconds(total_time.total_seconds())}</b><br>"
-                    f"Actual working time: <b>{format_seconds(working_time)}</b>",
+                    f"Total time: <b>{format_seconds(total_seconds)}</b><br>"
+                    f"Actual working time: <b>{format_seconds(working_seconds)}</b>",
                     "success"
                 )
                 return redirect(url_for("index"))
+            except PunchError as e:
+                flash(str(e), "error")
+                return redirect(url_for("index"))
             except Exception as e:
                 print(f"Error in clockout: {e}")
                 flash("Database error. Please try again later.", "error")
@@ -500,29 +650,12 @@ def index():
                     flash("Please enter your code and select a job site.", "error")
                     return redirect(url_for("index"))
 
-                # find worker info
-                worker = get_worker_by_code(input_code)
-                if not worker:
-                    flash("Code not found. If you're a new worker please use the New Worker form.", "error")
-                    return redirect(url_for("index"))
-
-                # Check already clocked in at any job site
-                active = Shift.query.filter_by(name=worker.name, subcontractor=worker.subcontractor, clock_out=None).first()
-                if active:
-                    flash(f"You are already clocked in at job site: {active.job_site}.", "error")
-                    return redirect(url_for("index"))
-
-                shift = Shift(
-                    name=worker.name,
-                    subcontractor=worker.subcontractor,
-                    job_site=job_site,
-                    clock_in=datetime.now(),
-                    code=input_code,
-                )
-                db.session.add(shift)
-                db.session.commit()
+                run_punch(punch_quick_clock_in, input_code, job_site, datetime.now())
                 flash("Clock-in successful!", "success")
                 return redirect(url_for("index"))
+            except PunchError as e:
+                flash(str(e), "error")
+                return redirect(url_for("index"))
             except Exception as e:
                 print(f"Error in quickclockin: {e}")
                 flash("Database error. Please try again later.", "error")
@@ -532,14 +665,7 @@ def index():
             flash("Invalid action or state.", "error")
             return redirect(url_for("index"))
 
-    # Get subcontractor suggestions with error handling
-    try:
-        subcontractors = get_subcontractor_suggestions()
-    except Exception as e:
-        print(f"Error getting subcontractor suggestions in index: {e}")
-        subcontractors = []
-
-    return render_template("index.html", job_sites=JOB_SITES, subcontractors=subcontractors)
+    return kiosk_page_response()
 
 def get_subcontractor_suggestions():
     """Get list of existing subcontractors for auto-suggestions"""
@@ -554,6 +680,27 @@ def get_subcontractor_suggestions():
         print(f"Error getting subcontractor suggestions: {e}")
         return []
 
+# Flask 2.0 has no stream_template; rendered output goes out this many template
+# chunks at a time
+TEMPLATE_STREAM_BUFFER = 200
+
+def stream_template(template_name, **context):
+    """Render a template into a streamed response body, keeping the request context"""
+    # Flashed messages leave the session when they are read: read them now, before
+    # the session cookie is written with the headers, so they are not shown twice
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(TEMPLATE_STREAM_BUFFER)
+    return stream_with_context(stream)
+
+def _listed_shifts(records):
+    """Shift records for a streamed page; a failed read ends the table, not the page"""
+    try:
+        yield from records
+    except Exception as e:
+        print(f"Error querying shifts: {e}")
+
 @app.route("/admin", methods=["GET", "POST"])
 def admin_view():
     try:
@@ -576,33 +723,23 @@ def admin_view():
         subcontractor_filter = request.args.get('subcontractor', '')
         job_site_filter = request.args.get('job_site', '')
         
-        # Get shifts with error handling and convert to dicts
         try:
-            query = Shift.query
-            if subcontractor_filter:
-                query = query.filter_by(subcontractor=subcontractor_filter)
-            if job_site_filter:
-                query = query.filter_by(job_site=job_site_filter)
-            shift_objects = query.order_by(Shift.created_at.desc()).all()
-            
-            # Convert to dictionaries to avoid session binding issues
-            shifts = []
-            for s in shift_objects:
-                shifts.append({
-                    "id": s.id,
-                    "name": s.name,
-                    "subcontractor": s.subcontractor,
-                    "job_site": s.job_site,
-                    "clock_in": s.clock_in,
-                    "clock_out": s.clock_out,
-                    "total_time": s.total_time,
-                    "working_time": s.working_time,
-                    "breaks": s.breaks,
-                    "code": s.code,
-                    "created_at": s.created_at,
-                    "qr_batch_id": s.qr_batch_id,
-                    "flagged": s.flagged,
-                })
+            close_overdue_shifts()
+        except Exception as e:
+            print(f"Error closing overdue shifts in admin: {e}")
+
+        # Nothing has been punched since the browser's copy: skip every query below
+        version = get_data_version(read_session=reporting_session())
+        etag = response_etag(version, "admin", subcontractor_filter, job_site_filter)
+        last_modified = response_last_modified(version)
+        if request.method == "GET" and request_is_fresh(etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        
+        # Streamed into the page as it renders, SHIFT_RECORD_BATCH rows at a time
+        try:
+            shifts = _listed_shifts(shift_records(
+                reporting_session(), subcontractor_filter or None, job_site_filter or None, anomaly_reasons()
+            ))
         except Exception as e:
             print(f"Error querying shifts: {e}")
             shifts = []
@@ -610,19 +747,8 @@ def admin_view():
         
         # Get project history and summary with filters
         try:
-            history_objects = build_project_history(subcontractor=subcontractor_filter or None, job_site=job_site_filter or None)
-            subcontractor_stats = calculate_subcontractor_days(subcontractor=subcontractor_filter or None, job_site=job_site_filter or None)
-            
-            # Convert history objects to dictionaries (these are SQLAlchemy result objects)
-            histories = []
-            for h in history_objects:
-                histories.append({
-                    "subcontractor": h.subcontractor,
-                    "job_site": h.job_site,
-                    "first_day": h.first_day,
-                    "last_day": h.last_day,
-                    "manpower": h.manpower,
-                })
+            histories = project_history_rows(version, subcontractor_filter or None, job_site_filter or None)
+            subcontractor_stats = subcontractor_days(version, subcontractor_filter or None, job_site_filter or None)
         except Exception as e:
             print(f"Error loading project history: {e}")
             histories = []
@@ -631,19 +757,23 @@ def admin_view():
         
         # Get unique subcontractors and job sites for filters
         try:
-            subcontractors = [row[0] for row in db.session.query(Shift.subcontractor).distinct().all()]
-            job_sites = [row[0] for row in db.session.query(Shift.job_site).distinct().all()]
+            subcontractors, job_sites = filter_options(version)
         except Exception as e:
             print(f"Error loading filter options: {e}")
             subcontractors = []
             job_sites = []
-        
+
         try:
-            close_overdue_shifts()
+            latest_event_id = latest_dashboard_event_id()
+            on_site = occupancy_total(
+                get_occupancy_snapshot(), job_site=job_site_filter or None, subcontractor=subcontractor_filter or None
+            )
         except Exception as e:
-            print(f"Error closing overdue shifts in admin: {e}")
+            print(f"Error loading live dashboard state: {e}")
+            latest_event_id = 0
+            on_site = 0
         
-        return render_template(
+        response = Response(stream_template(
             "admin.html", 
             shifts=shifts,
             histories=histories,
@@ -651,9 +781,15 @@ def admin_view():
             job_sites=job_sites,
             selected_subcontractor=subcontractor_filter,
             selected_job_site=job_site_filter,
+            all_job_sites=JOB_SITES,
             subcontractor_stats=subcontractor_stats,
+            latest_event_id=latest_event_id,
+            on_site=on_site,
             format_time_for_display=format_time_for_display
-        )
+        ), mimetype="text/html")
+        if request.method == "GET":
+            add_cache_validators(response, etag, last_modified)
+        return response
     except Exception as e:
         print(f"Admin view error: {e}")
         flash(f"Admin view error: {str(e)}", "error")
@@ -662,7 +798,7 @@ def admin_view():
 def calculate_subcontractor_days(subcontractor=None, job_site=None):
     """Calculate days worked and total hours for each subcontractor, with optional filters"""
     subcontractor_stats = {}
-    query = Shift.query.filter(Shift.clock_out.isnot(None))
+    query = reporting_session().query(Shift).filter(Shift.clock_out.isnot(None))
     if subcontractor:
         query = query.filter_by(subcontractor=subcontractor)
     if job_site:
@@ -675,22 +811,17 @@ def calculate_subcontractor_days(subcontractor=None, job_site=None):
                 'hours': 0.0
             }
         subcontractor_stats[shift.subcontractor]['days'] += 1
-        if shift.working_time:
-            time_parts = shift.working_time.split()
-            hours = float(time_parts[0].replace('h', ''))
-            minutes = float(time_parts[1].replace('m', '')) if len(time_parts) > 1 else 0
-            total_hours = hours + (minutes / 60)
-            subcontractor_stats[shift.subcontractor]['hours'] += total_hours
+        subcontractor_stats[shift.subcontractor]['hours'] += parse_duration_hours(shift.working_time)
     return subcontractor_stats
 
 def update_subcontractor_history(shift):
-    """Update subcontractor project history when a shift is completed"""
+    """Update subcontractor project history when a shift is completed (caller commits)"""
     history = SubcontractorProjectHistory.query.filter_by(
         subcontractor=shift.subcontractor,
         job_site=shift.job_site
     ).first()
     
-    shift_date = shift.clock_out.date()
+    shift_date = datetime.combine(shift.clock_out.date(), datetime.min.time())
     
     if not history:
         # First time this subcontractor works on this job site
@@ -705,14 +836,12 @@ def update_subcontractor_history(shift):
     else:
         # Update existing history
         # Update first/last day if needed
-        if shift_date < history.first_day.date():
+        if shift_date < history.first_day:
             history.first_day = shift_date
-        if shift_date > history.last_day.date():
+        if shift_date > history.last_day:
             history.last_day = shift_date
         # Always increment manpower for each shift
         history.manpower += 1
-    
-    db.session.commit()
 
 def get_daily_manpower_summary(start_date=None, end_date=None, job_site=None, subcontractor=None):
     """Get daily manpower summary with optional filters"""
@@ -757,24 +886,30 @@ def admin_export():
     # Get the filtered project history (use current filters if present)
     subcontractor_filter = request.args.get('subcontractor', '')
     job_site_filter = request.args.get('job_site', '')
-    histories = build_project_history(subcontractor=subcontractor_filter or None, job_site=job_site_filter or None)
+    version = get_data_version(read_session=reporting_session())
+    etag = response_etag(version, "export", subcontractor_filter, job_site_filter)
+    last_modified = response_last_modified(version)
+    if request_is_fresh(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    histories = project_history_rows(version, subcontractor_filter or None, job_site_filter or None)
     def generate():
         data = [
             ["Subcontractor", "Job Site", "First Day", "Last Day", "Manpower"]
         ]
         for h in histories:
             data.append([
-                h.subcontractor,
-                h.job_site,
-                h.first_day.strftime('%Y-%m-%d'),
-                h.last_day.strftime('%Y-%m-%d'),
-                h.manpower
+                h["subcontractor"],
+                h["job_site"],
+                h["first_day"].strftime('%Y-%m-%d'),
+                h["last_day"].strftime('%Y-%m-%d'),
+                h["manpower"]
             ])
         output = ''
         for row in data:
             output += ','.join(f'"{str(cell)}"' for cell in row) + '\n'
         return output
-    return Response(generate(), mimetype='text/csv', headers={"Content-Disposition": "attachment;filename=subcontractor_project_history.csv"})
+    response = Response(generate(), mimetype='text/csv', headers={"Content-Disposition": "attachment;filename=subcontractor_project_history.csv"})
+    return add_cache_validators(response, etag, last_modified)
 
 @app.route("/admin/logout")
 def admin_logout():
@@ -787,9 +922,13 @@ def admin_delete_shift(shift_id):
     if not session.get("admin_authenticated"):
         return redirect(url_for("admin_view"))
     shift = Shift.query.get_or_404(shift_id)
-    # Delete associated breaks
-    Break.query.filter_by(shift_code=shift.code).delete()
-    db.session.delete(shift)
+    if shift.clock_out is None:
+        adjust_occupancy(shift.job_site, shift.subcontractor, -1)
+        publish_dashboard_event("delete", shift, on_site_delta=-1)
+    else:
+        publish_dashboard_event("delete", shift, days_delta=-1, hours_delta=-parse_duration_hours(shift.working_time))
+    # Also deletes the associated breaks
+    record_clock_event("admin_delete", datetime.now(), shift_id=shift.id, code=shift.code)
     db.session.commit()
     flash("Shift entry deleted.", "success")
     return redirect(url_for("admin_view"))
@@ -845,6 +984,7 @@ def refresh_qr_code(job_site, action):
     batch_id = str(uuid.uuid4())
     batches[key] = batch_id
     save_qr_batches(batches)
+    clear_qr_sheet_cache()
     qr_image, timestamp, qr_url = generate_qr_code(job_site, batch_id, action=action)
     return {
         'image': qr_image,
@@ -864,6 +1004,7 @@ def refresh_all_qr_codes():
             key = f"{job_site}::{action}"
             batches[key] = str(uuid.uuid4())
     save_qr_batches(batches)
+    clear_qr_sheet_cache()
     return {"status": "ok"}
 
 @app.route("/initdb")
@@ -878,24 +1019,16 @@ def init_db():
 def generate_qr_code(job_site, batch_id, timestamp=None, action="clockin"):
     if timestamp is None:
         timestamp = int(time.time())
-    site_id = hashlib.md5(job_site.encode()).hexdigest()[:8]
     from flask import request
-    host_url = request.host_url.rstrip('/')
-    if action == "clockin":
-        qr_data = f"{host_url}/scan?site={site_id}&batch={batch_id}&t={timestamp}&action=clockin"
-    else:
-        qr_data = f"{host_url}/scan?site={site_id}&batch={batch_id}&t={timestamp}&action=clockout"
-    qr_url = qr_data
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(qr_data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    img_str = base64.b64encode(buffer.getvalue()).decode()
+    qr_url = qr_scan_url(request.host_url, job_site, batch_id, timestamp, action)
+    img_str = base64.b64encode(render_qr_png(qr_url)).decode()
     return img_str, timestamp, qr_url
 
+def qr_scan_url(host_url, job_site, batch_id, timestamp, action="clockin"):
+    site_id = hashlib.md5(job_site.encode()).hexdigest()[:8]
+    action = "clockin" if action == "clockin" else "clockout"
+    return f"{host_url.rstrip('/')}/scan?site={site_id}&batch={batch_id}&t={timestamp}&action={action}"
+
 def get_job_site_from_id(site_id):
     """Get job site name from site ID"""
     for site in JOB_SITES:
@@ -918,7 +1051,14 @@ def qr_scan():
     if not job_site:
         return "Invalid job site.", 400
     
-    return render_template("qr_scan.html", job_site=job_site, batch_id=batch_id)
+    has_flashes = bool(session.get("_flashes"))
+    response = app.make_response(render_template(
+        "qr_scan.html", job_site=job_site, batch_id=batch_id, site_id=site_id, cache_name=scan_cache_name()
+    ))
+    if has_flashes:
+        # The offline copy of this page must not keep showing a one-off message
+        response.headers["Cache-Control"] = "no-store"
+    return response
 
 @app.route("/qr_clock_in", methods=["POST"])
 def qr_clock_in():
@@ -932,24 +1072,24 @@ def qr_clock_in():
         flash("Please fill in all fields.", "error")
         return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
     
-    # Check if already clocked in at any job site
-    existing_shift = Shift.query.filter_by(name=name, subcontractor=subcontractor, clock_out=None).first()
-    if existing_shift:
-        flash(f"You are already clocked in at job site: {existing_shift.job_site}.", "error")
-        return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
-    
     # Clock in
     now = datetime.now()
-    code = get_or_create_code(name, subcontractor)
-    shift = Shift(name=name, subcontractor=subcontractor, job_site=job_site, clock_in=now, code=code, qr_batch_id=batch_id)
-    db.session.add(shift)
-    db.session.commit()
+    try:
+        code = run_punch(punch_clock_in, name, subcontractor, job_site, now, batch_id)
+    except PunchError as e:
+        flash(str(e), "error")
+        return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
     flash(f"Successfully clocked in! Your code is: <b>{code}</b>", "success")
     return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
 
 def sync_to_procore(shift):
-    # Procore integration disabled; nothing to do
-    return
+    """Queue the closed shift's timecard for Procore, in the caller's transaction"""
+    if not PROCORE_API_URL:
+        # Procore integration disabled; nothing to do
+        return
+    if shift.subcontractor == BENCHMARK_SUBCONTRACTOR:
+        return
+    enqueue_outbox(PROCORE_TIMECARD_TOPIC, procore_timecard(shift))
 
 @app.route("/qr_clock_out", methods=["POST"])
 def qr_clock_out():
@@ -962,43 +1102,21 @@ def qr_clock_out():
         flash("Please enter your code.", "error")
         return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
     
-    # Find shift by code and job site
-    shift = Shift.query.filter_by(code=code, job_site=job_site, clock_out=None).first()
-    if not shift:
+    # Clock out (also updates project history tracking)
+    try:
+        times = run_punch(punch_clock_out, code, datetime.now(), job_site)
+    except PunchError as e:
+        flash(str(e), "error")
+        return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
+    if times is None:
         flash("Code not found or already clocked out.", "error")
         return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
-    
-    # Clock out
-    now = datetime.now()
-    clock_in_dt = shift.clock_in
-    clock_out_dt = now
-    total_time = clock_out_dt - clock_in_dt
-    
-    # Calculate breaks
-    breaks = Break.query.filter_by(shift_code=code).all()
-    total_break = 0
-    breaks_str = ""
-    if breaks:
-        for b in breaks:
-            if b.start and b.end:
-                total_break += (b.end - b.start).total_seconds()
-        breaks_str = "; ".join(
-            f"{b.start.strftime('%I:%M %p')} - {b.end.strftime('%I:%M %p')}" for b in breaks if b.start and b.end
-        )
-    working_time = total_time.total_seconds() - total_break
-    shift.clock_out = clock_out_dt
-    shift.total_time = format_seconds(total_time.total_seconds())
-    shift.working_time = format_seconds(working_time)
-    shift.breaks = breaks_str
-    db.session.commit()
-
-    # Update project history tracking
-    update_subcontractor_history(shift)
+    total_seconds, working_seconds = times
 
     flash(
         f"Shift complete!<br>"
-        f"Total time: <b>{format_seconds(total_time.total_seconds())}</b><br>"
-        f"Actual working time: <b>{format_seconds(working_time)}</b>",
+        f"Total time: <b>{format_seconds(total_seconds)}</b><br>"
+        f"Actual working time: <b>{format_seconds(working_seconds)}</b>",
         "success"
     )
     return redirect(url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id, t=int(time.time())))
@@ -1065,7 +1183,7 @@ def check_tables():
         return f"Database error: {str(e)}"
 
 def build_project_history(subcontractor=None, job_site=None):
-    query = db.session.query(
+    query = reporting_session().query(
         Shift.subcontractor,
         Shift.job_site,
         func.min(Shift.clock_in).label('first_day'),
@@ -1090,11 +1208,12 @@ def close_overdue_shifts(max_hours: int = 24):
         cutoff = datetime.utcnow() - timedelta(hours=max_hours)
         overdue_shifts = Shift.query.filter(Shift.clock_out.is_(None), Shift.clock_in < cutoff).all()
         for s in overdue_shifts:
-            s.clock_out = s.clock_in + timedelta(hours=max_hours)
-            s.total_time = format_seconds(max_hours * 3600)
-            s.working_time = s.total_time
-            s.breaks = "AUTO-CLOSED"
-            s.flagged = True
+            record_clock_event(
+                "auto_close", s.clock_in + timedelta(hours=max_hours), shift_id=s.id, code=s.code, max_hours=max_hours
+            )
+            adjust_occupancy(s.job_site, s.subcontractor, -1)
+            publish_dashboard_event("auto_close", s, on_site_delta=-1, days_delta=1, hours_delta=max_hours)
+            sync_to_procore(s)
         if overdue_shifts:
             db.session.commit()
     except Exception as e:
@@ -1111,6 +1230,18 @@ def add_flagged_column():
     except Exception as e:
         return str(e)
 
+@app.route('/add_shift_indexes')
+def add_shift_indexes():
+    try:
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_shift_code_clock_in ON shift (code, clock_in);"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_shift_clock_out ON shift (clock_out);"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_break_shift_code ON break (shift_code);"))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_shift_qr_batch_id_clock_in ON shift (qr_batch_id, clock_in);"))
+        db.session.commit()
+        return "shift indexes added"
+    except Exception as e:
+        return str(e)
+
 @app.route('/admin/edit/<int:shift_id>', methods=['GET', 'POST'])
 def admin_edit_shift(shift_id):
     if not session.get("admin_authenticated"):
@@ -1122,12 +1253,21 @@ def admin_edit_shift(shift_id):
         try:
             clock_in_str = request.form.get('clock_in')
             clock_out_str = request.form.get('clock_out')
-            shift.clock_in = datetime.strptime(clock_in_str, '%Y-%m-%dT%H:%M')
-            if clock_out_str:
-                shift.clock_out = datetime.strptime(clock_out_str, '%Y-%m-%dT%H:%M')
-                duration = (shift.clock_out - shift.clock_in).total_seconds()
-                shift.total_time = format_seconds(duration)
-                shift.working_time = shift.total_time
+            was_open = shift.clock_out is None
+            previous_hours = parse_duration_hours(shift.working_time)
+            clock_in = datetime.strptime(clock_in_str, '%Y-%m-%dT%H:%M')
+            clock_out = datetime.strptime(clock_out_str, '%Y-%m-%dT%H:%M') if clock_out_str else None
+            record_clock_event("admin_edit", datetime.now(), shift_id=shift.id, code=shift.code, clock_in=clock_in, clock_out=clock_out)
+            if clock_out and was_open:
+                adjust_occupancy(shift.job_site, shift.subcontractor, -1)
+            closed_now = was_open and shift.clock_out is not None
+            publish_dashboard_event(
+                "edit",
+                shift,
+                on_site_delta=-1 if closed_now else 0,
+                days_delta=1 if closed_now else 0,
+                hours_delta=parse_duration_hours(shift.working_time) - previous_hours,
+            )
             db.session.commit()
             flash('Shift updated.', 'success')
             return redirect(url_for('admin_view'))
@@ -1150,6 +1290,4515 @@ def print_qr_code(job_site, action):
     qr_image, timestamp, qr_url = generate_qr_code(job_site, batch_id, action=action)
     return render_template("print_qr.html", job_site=job_site, action=action, qr_image=qr_image, batch_id=batch_id)
 
+# ---------------------------------------------------------------------------
+# Weekly timesheets
+# ---------------------------------------------------------------------------
+
+OVERTIME_THRESHOLD_HOURS = 40
+TIMESHEET_DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+def sql_seconds_between(start, end, dialect_name):
+    """SQL expression for the number of seconds from start to end"""
+    if dialect_name == "postgresql":
+        return func.extract("epoch", end - start)
+    return (func.julianday(end) - func.julianday(start)) * 86400.0
+
+def sql_greatest(a, b, dialect_name):
+    if dialect_name == "postgresql":
+        return func.greatest(a, b)
+    # SQLite's multi-argument max() is a scalar function
+    return func.max(a, b)
+
+def sql_least(a, b, dialect_name):
+    if dialect_name == "postgresql":
+        return func.least(a, b)
+    return func.min(a, b)
+
+def sql_add_hours(value, hours, dialect_name):
+    """SQL expression for value shifted by a whole number of hours"""
+    if dialect_name == "postgresql":
+        return value + text(f"interval '{int(hours)} hours'")
+    return func.datetime(value, f"{int(hours):+d} hours")
+
+def parse_report_date(value, default=None):
+    """Parse a YYYY-MM-DD query/CLI argument, returning default when empty"""
+    if not value:
+        return default
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+def timesheet_date_range(start_date=None, end_date=None):
+    """Widen a date range to whole Monday-Sunday weeks (defaults to this week)"""
+    today = datetime.utcnow().date()
+    start_date = start_date or today
+    end_date = end_date or start_date
+    start_date = start_date - timedelta(days=start_date.weekday())
+    end_date = end_date + timedelta(days=6 - end_date.weekday())
+    return start_date, end_date
+
+def build_site_day_calendar(job_sites, start_date, end_date):
+    """UTC boundaries of every site-local day in the range, one row per (site, day).
+
+    Days are split at local midnight, so DST days are 23 or 25 hours long.
+    """
+    rows = []
+    for site in job_sites:
+        tz = pytz.timezone(JOB_SITE_TIMEZONES.get(site, "UTC"))
+        day = start_date
+        while day <= end_date:
+            next_day = day + timedelta(days=1)
+            day_start = tz.localize(datetime.combine(day, datetime.min.time()))
+            day_end = tz.localize(datetime.combine(next_day, datetime.min.time()))
+            rows.append({
+                "job_site": site,
+                "week_start": day - timedelta(days=day.weekday()),
+                "weekday": day.weekday(),
+                "day_start": day_start.astimezone(pytz.utc).replace(tzinfo=None),
+                "day_end": day_end.astimezone(pytz.utc).replace(tzinfo=None),
+            })
+            day = next_day
+    return rows
+
+def _timesheet_calendar_table():
+    metadata = db.MetaData()
+    table = db.Table(
+        "timesheet_calendar",
+        metadata,
+        db.Column("job_site", db.String(255), nullable=False),
+        db.Column("week_start", db.Date, nullable=False),
+        db.Column("weekday", db.Integer, nullable=False),
+        db.Column("day_start", db.DateTime, nullable=False),
+        db.Column("day_end", db.DateTime, nullable=False),
+        prefixes=["TEMPORARY"],
+    )
+    db.Index("ix_timesheet_calendar_site_end", table.c.job_site, table.c.day_end)
+    return table
+
+def _timesheet_calendar_values(rows):
+    columns = ["job_site", "week_start", "weekday", "day_start", "day_end"]
+    return db.values(
+        db.column("job_site", db.String(255)),
+        db.column("week_start", db.Date),
+        db.column("weekday", db.Integer),
+        db.column("day_start", db.DateTime),
+        db.column("day_end", db.DateTime),
+        name="timesheet_calendar",
+    ).data([tuple(row[column] for column in columns) for row in rows])
+
+def timesheet_weekly_totals_query(calendar, dialect_name, range_start, range_end, subcontractor=None, job_site=None):
+    """Worked seconds per worker, week and weekday, net of breaks, as one SQL statement.
+
+    Each shift is joined to the site-local days it overlaps and the clipped seconds
+    are pivoted into seven weekday columns, so the result has one row per worker-week.
+    """
+    cal = calendar.c
+    shift_filters = [Shift.clock_out.isnot(None)]
+    if subcontractor:
+        shift_filters.append(Shift.subcontractor == subcontractor)
+    if job_site:
+        shift_filters.append(Shift.job_site == job_site)
+
+    # Local days last at most 25 hours, so the extra upper bound on day_end keeps the
+    # calendar index lookup to the one or two days a shift actually touches
+    day_overlaps_shift = db.and_(
+        cal.job_site == Shift.job_site,
+        cal.day_end > Shift.clock_in,
+        cal.day_end < sql_add_hours(Shift.clock_out, 26, dialect_name),
+        cal.day_start < Shift.clock_out,
+    )
+
+    def weekday_columns(seconds):
+        return [
+            func.sum(db.case((cal.weekday == day, seconds), else_=0)).label(f"day{day}")
+            for day in range(7)
+        ]
+
+    overlap_start = sql_greatest(Shift.clock_in, cal.day_start, dialect_name)
+    overlap_end = sql_least(Shift.clock_out, cal.day_end, dialect_name)
+    worked = (
+        db.select(
+            Shift.subcontractor.label("subcontractor"),
+            Shift.name.label("name"),
+            cal.week_start.label("week_start"),
+            func.max(Shift.code).label("code"),
+            *weekday_columns(sql_seconds_between(overlap_start, overlap_end, dialect_name)),
+        )
+        .select_from(Shift.__table__.join(calendar, day_overlaps_shift))
+        .where(Shift.clock_in < range_end, Shift.clock_out > range_start, *shift_filters)
+        .group_by(Shift.subcontractor, Shift.name, cal.week_start)
+        .subquery("worked")
+    )
+
+    # Breaks are keyed by the worker's persistent code, so each break is matched to the
+    # shift that was open when it started: the latest clock-in for that code at or
+    # before the break start, found with one seek on the (code, clock_in) index.
+    break_shift_id = (
+        db.select(Shift.id)
+        .where(Shift.code == Break.shift_code, Shift.clock_in <= Break.start)
+        .order_by(Shift.clock_in.desc())
+        .limit(1)
+        .correlate(Break.__table__)
+        .scalar_subquery()
+    )
+    ranged_breaks = (
+        db.select(Break.start, Break.end, break_shift_id.label("shift_id"))
+        .where(Break.end.isnot(None), Break.start < range_end, Break.end > range_start)
+        .subquery("ranged_breaks")
+    )
+    brk = ranged_breaks.c
+    # Break time is clipped to both its shift and the local day before it is subtracted
+    break_start = sql_greatest(brk.start, cal.day_start, dialect_name)
+    break_end = sql_least(sql_least(brk.end, Shift.clock_out, dialect_name), cal.day_end, dialect_name)
+    breaks = (
+        db.select(
+            Shift.subcontractor.label("subcontractor"),
+            Shift.name.label("name"),
+            cal.week_start.label("week_start"),
+            *weekday_columns(sql_seconds_between(break_start, break_end, dialect_name)),
+        )
+        .select_from(
+            ranged_breaks
+            .join(Shift.__table__, db.and_(Shift.id == brk.shift_id, Shift.clock_out > brk.start))
+            .join(calendar, db.and_(day_overlaps_shift, brk.start < cal.day_end, brk.end > cal.day_start))
+        )
+        .where(*shift_filters)
+        .group_by(Shift.subcontractor, Shift.name, cal.week_start)
+        .subquery("breaks")
+    )
+
+    return (
+        db.select(
+            worked.c.subcontractor,
+            worked.c.name,
+            worked.c.code,
+            worked.c.week_start,
+            *[
+                (worked.c[f"day{day}"] - func.coalesce(breaks.c[f"day{day}"], 0)).label(f"day{day}")
+                for day in range(7)
+            ],
+        )
+        .select_from(worked.outerjoin(breaks, db.and_(
+            breaks.c.subcontractor == worked.c.subcontractor,
+            breaks.c.name == worked.c.name,
+            breaks.c.week_start == worked.c.week_start,
+        )))
+        .order_by(worked.c.subcontractor, worked.c.name, worked.c.week_start)
+    )
+
+def _coerce_date(value):
+    # SQLite hands dates back from subqueries as strings
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    return value
+
+def iter_weekly_timesheets(start_date=None, end_date=None, subcontractor=None, job_site=None):
+    """Yield one dict per worker and week with daily, regular and overtime hours.
+
+    All per-shift work (day splitting, break subtraction, summing) happens in the
+    database; Python only applies the overtime threshold to each worker-week row.
+    """
+    start_date, end_date = timesheet_date_range(start_date, end_date)
+    job_sites = [job_site] if job_site else sorted(
+        set(JOB_SITES) | {row[0] for row in reporting_session().query(Shift.job_site).distinct()}
+    )
+    calendar_rows = build_site_day_calendar(job_sites, start_date, end_date)
+    if not calendar_rows:
+        # start after end: no days, no timesheets
+        return
+    range_start = min(row["day_start"] for row in calendar_rows)
+    range_end = max(row["day_end"] for row in calendar_rows)
+
+    with reporting_session().bind.connect() as conn:
+        dialect_name = conn.dialect.name
+        # A hot-standby Postgres replica refuses CREATE TEMP TABLE, so Postgres gets
+        # the calendar inline as a VALUES list instead
+        use_temp_table = dialect_name != "postgresql"
+        if use_temp_table:
+            calendar = _timesheet_calendar_table()
+            if dialect_name == "sqlite":
+                # Keep the GROUP BY sorters off disk; must run before the temp table exists
+                conn.execute(text("PRAGMA temp_store = MEMORY"))
+                conn.execute(text("PRAGMA cache_size = -65536"))
+            calendar.create(conn)
+            conn.execute(calendar.insert(), calendar_rows)
+        else:
+            calendar = _timesheet_calendar_values(calendar_rows)
+        try:
+            query = timesheet_weekly_totals_query(
+                calendar, dialect_name, range_start, range_end, subcontractor, job_site
+            )
+            for subcontractor_name, name, code, week_start, *daily_seconds in (
+                conn.execution_options(stream_results=True).execute(query)
+            ):
+                yield _finish_timesheet_week({
+                    "subcontractor": subcontractor_name,
+                    "name": name,
+                    "code": code,
+                    "week_start": _coerce_date(week_start),
+                    "daily_hours": [max(round(float(secs or 0)), 0) / 3600 for secs in daily_seconds],
+                })
+        finally:
+            if use_temp_table:
+                calendar.drop(conn)
+
+def _finish_timesheet_week(week):
+    total = sum(week["daily_hours"])
+    week["total_hours"] = total
+    week["regular_hours"] = min(total, OVERTIME_THRESHOLD_HOURS)
+    week["overtime_hours"] = max(total - OVERTIME_THRESHOLD_HOURS, 0.0)
+    return week
+
+def iter_timesheet_csv(timesheets):
+    """Render timesheet rows as CSV text chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    writer.writerow(
+        ["Subcontractor", "Name", "Code", "Week Start"] + TIMESHEET_DAY_NAMES
+        + ["Total Hours", "Regular Hours", "Overtime Hours"]
+    )
+    for week in timesheets:
+        writer.writerow(
+            [week["subcontractor"], week["name"], week["code"], week["week_start"].strftime("%Y-%m-%d")]
+            + [f"{hours:.2f}" for hours in week["daily_hours"]]
+            + [f"{week['total_hours']:.2f}", f"{week['regular_hours']:.2f}", f"{week['overtime_hours']:.2f}"]
+        )
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route("/admin/timesheets")
+def admin_timesheets():
+    if not session.get("admin_authenticated"):
+        return redirect(url_for("admin_view"))
+    try:
+        start_date = parse_report_date(request.args.get("start"))
+        end_date = parse_report_date(request.args.get("end"))
+    except ValueError:
+        return "Invalid date, expected YYYY-MM-DD.", 400
+    start_date, end_date = timesheet_date_range(start_date, end_date)
+    if start_date > end_date:
+        return "Start date is after end date.", 400
+    subcontractor = request.args.get("subcontractor") or None
+    job_site = request.args.get("job_site") or None
+    version = get_data_version(read_session=reporting_session())
+    etag = response_etag(version, "timesheets", start_date.isoformat(), end_date.isoformat(), subcontractor, job_site)
+    last_modified = response_last_modified(version)
+    if request_is_fresh(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    timesheets = iter_weekly_timesheets(start_date, end_date, subcontractor=subcontractor, job_site=job_site)
+    filename = f"timesheets_{start_date:%Y%m%d}_{end_date:%Y%m%d}.csv"
+    response = Response(
+        stream_with_context(iter_timesheet_csv(timesheets)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment;filename={filename}"},
+    )
+    return add_cache_validators(response, etag, last_modified)
+
+@app.cli.command("timesheets")
+@click.option("--start", help="First day (YYYY-MM-DD), widened to its Monday.")
+@click.option("--end", help="Last day (YYYY-MM-DD), widened to its Sunday.")
+@click.option("--subcontractor", default=None)
+@click.option("--job-site", default=None)
+@click.option("--output", type=click.File("w"), default="-", help="CSV file to write (default stdout).")
+def timesheets_command(start, end, subcontractor, job_site, output):
+    """Export weekly timesheets with regular and overtime hours as CSV."""
+    try:
+        start_date, end_date = parse_report_date(start), parse_report_date(end)
+    except ValueError:
+        raise click.BadParameter("expected YYYY-MM-DD")
+    first_day, last_day = timesheet_date_range(start_date, end_date)
+    if first_day > last_day:
+        raise click.BadParameter("start date is after end date (--start defaults to today)")
+    timesheets = iter_weekly_timesheets(start_date, end_date, subcontractor=subcontractor, job_site=job_site)
+    for chunk in iter_timesheet_csv(timesheets):
+        output.write(chunk)
+
+# ---------------------------------------------------------------------------
+# Live occupancy
+# ---------------------------------------------------------------------------
+
+# Punches keep the counters current; `flask reconcile-occupancy --every 300` repairs
+# any drift from the shift table, away from the /api/occupancy poll.
+OCCUPANCY_CACHE_SECONDS = float(os.environ.get("OCCUPANCY_CACHE_SECONDS", 2))
+
+_occupancy_lock = threading.Lock()
+_occupancy_state = {"snapshot": None, "cached_at": 0.0}
+
+def _dialect_insert(table, dialect_name=None):
+    """INSERT construct supporting ON CONFLICT for the active database"""
+    if (dialect_name or db.engine.dialect.name) == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+def adjust_occupancy(job_site, subcontractor, delta):
+    """Add delta to a site/subcontractor counter inside the caller's transaction.
+
+    A single upsert statement, so concurrent punches never lose an update.
+    """
+    table = SiteOccupancy.__table__
+    now = datetime.utcnow()
+    stmt = _dialect_insert(table).values(
+        job_site=job_site, subcontractor=subcontractor, on_site=max(delta, 0), updated_at=now
+    )
+    new_count = table.c.on_site + delta
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.job_site, table.c.subcontractor],
+        set_={"on_site": db.case((new_count < 0, 0), else_=new_count), "updated_at": now},
+    )
+    db.session.execute(stmt)
+
+def reconcile_occupancy():
+    """Reset every counter to the number of open shifts (clock_out IS NULL).
+
+    Two set-based statements: one adds a row for any site/subcontractor with open
+    shifts but no counter, the other recounts every counter in place, so no count
+    is read into Python and written back over a punch's concurrent update.
+    """
+    table, shift = SiteOccupancy.__table__, Shift.__table__
+    now = datetime.utcnow()
+    open_shifts = shift.c.clock_out.is_(None)
+    db.session.execute(
+        _dialect_insert(table).from_select(
+            ["job_site", "subcontractor", "on_site", "updated_at"],
+            db.select(shift.c.job_site, shift.c.subcontractor, db.literal(0), db.literal(now))
+            .where(open_shifts)
+            .group_by(shift.c.job_site, shift.c.subcontractor),
+        ).on_conflict_do_nothing(index_elements=[table.c.job_site, table.c.subcontractor])
+    )
+    on_site = (
+        db.select(func.count())
+        .where(shift.c.job_site == table.c.job_site, shift.c.subcontractor == table.c.subcontractor, open_shifts)
+        .scalar_subquery()
+    )
+    db.session.execute(table.update().values(on_site=on_site, updated_at=now))
+    db.session.commit()
+    with _occupancy_lock:
+        _occupancy_state["cached_at"] = 0.0
+
+def get_occupancy_snapshot():
+    """Counters grouped by job site, served from a short-lived per-process cache.
+
+    Only the small site_occupancy table is read; the shift table is left to the
+    reconcile-occupancy command.
+    """
+    now = time.time()
+    with _occupancy_lock:
+        if _occupancy_state["snapshot"] is not None and now - _occupancy_state["cached_at"] < OCCUPANCY_CACHE_SECONDS:
+            return _occupancy_state["snapshot"]
+
+    sites = {}
+    rows = db.session.query(SiteOccupancy.job_site, SiteOccupancy.subcontractor, SiteOccupancy.on_site).filter(
+        SiteOccupancy.on_site > 0
+    )
+    for job_site, subcontractor, on_site in rows:
+        site = sites.setdefault(job_site, {"total": 0, "subcontractors": {}})
+        site["subcontractors"][subcontractor] = on_site
+        site["total"] += on_site
+    snapshot = {
+        "generated_at": datetime.utcnow().isoformat(),
+        "total": sum(site["total"] for site in sites.values()),
+        "sites": sites,
+    }
+    with _occupancy_lock:
+        _occupancy_state["snapshot"] = snapshot
+        _occupancy_state["cached_at"] = time.time()
+    return snapshot
+
+def occupancy_total(snapshot, job_site=None, subcontractor=None):
+    """Workers on site in a snapshot, optionally limited to one site and/or subcontractor"""
+    return sum(
+        count
+        for site, counts in snapshot["sites"].items()
+        if not job_site or site == job_site
+        for sub, count in counts["subcontractors"].items()
+        if not subcontractor or sub == subcontractor
+    )
+
+@app.route("/api/occupancy")
+def api_occupancy():
+    """Workers currently on site, per job site and subcontractor"""
+    try:
+        snapshot = get_occupancy_snapshot()
+    except Exception as e:
+        print(f"Error loading occupancy: {e}")
+        return {"status": "error", "message": "Occupancy is temporarily unavailable"}, 503
+    job_site = request.args.get("job_site")
+    if job_site:
+        site = snapshot["sites"].get(job_site, {"total": 0, "subcontractors": {}})
+        snapshot = dict(snapshot, total=site["total"], sites={job_site: site})
+    response = app.make_response(snapshot)
+    response.headers["Cache-Control"] = f"public, max-age={int(OCCUPANCY_CACHE_SECONDS)}"
+    return response
+
+@app.cli.command("reconcile-occupancy")
+@click.option("--every", type=float, help="Keep reconciling every N seconds.")
+def reconcile_occupancy_command(every):
+    """Recount on-site workers from open shifts."""
+    while True:
+        reconcile_occupancy()
+        click.echo(f"Occupancy reconciled: {get_occupancy_snapshot()['total']} on site")
+        db.session.remove()
+        if not every:
+            break
+        time.sleep(every)
+
+# ---------------------------------------------------------------------------
+# Admin dashboard live updates (Server-Sent Events)
+# ---------------------------------------------------------------------------
+
+SSE_POLL_SECONDS = float(os.environ.get("SSE_POLL_SECONDS", 1))
+SSE_HEARTBEAT_SECONDS = 15
+# Streams end after this long and the browser reconnects with Last-Event-ID, so a
+# dashboard left open never pins a worker indefinitely. gunicorn.conf.py runs
+# threaded workers; under a sync gunicorn worker, which serves one request at a
+# time, the stream answers with what is pending and closes, and the browser polls
+# again after SSE_SHORT_POLL_SECONDS.
+SSE_STREAM_SECONDS = float(os.environ.get("SSE_STREAM_SECONDS", 300))
+SSE_SHORT_POLL_SECONDS = float(os.environ.get("SSE_SHORT_POLL_SECONDS", 10))
+SSE_REPLAY_LIMIT = 500
+DASHBOARD_EVENT_RETENTION_HOURS = 24
+
+def shift_display_row(shift):
+    """A shift as the admin table shows it"""
+    return {
+        "id": shift.id,
+        "name": shift.name,
+        "subcontractor": shift.subcontractor,
+        "job_site": shift.job_site,
+        "clock_in": format_time_for_display(shift.clock_in, shift.job_site),
+        "clock_out": format_time_for_display(shift.clock_out, shift.job_site) if shift.clock_out else None,
+        "total_time": shift.total_time,
+        "working_time": shift.working_time,
+        "breaks": shift.breaks,
+        "code": shift.code,
+        "flagged": bool(shift.flagged),
+    }
+
+def publish_dashboard_event(kind, shift, on_site_delta=0, days_delta=0, hours_delta=0.0):
+    """Queue a dashboard update in the caller's transaction.
+
+    The deltas let open dashboards adjust their on-site, summary and project history
+    counters without reloading.
+    """
+    if shift.id is None:
+        db.session.flush()
+    db.session.add(DashboardEvent(kind=kind, payload=dashboard_event_payload(shift, on_site_delta, days_delta, hours_delta)))
+
+def dashboard_event_payload(shift, on_site_delta=0, days_delta=0, hours_delta=0.0):
+    return json.dumps({
+        "shift": shift_display_row(shift),
+        "on_site_delta": on_site_delta,
+        "days_delta": days_delta,
+        "hours_delta": round(hours_delta, 4),
+    })
+
+def format_sse_message(event):
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {event.payload}\n\n"
+
+def latest_dashboard_event_id():
+    return db.session.query(func.max(DashboardEvent.id)).scalar() or 0
+
+class DashboardEventRelay:
+    """Tails dashboard_event from one background thread per worker process.
+
+    New rows are fanned out to every connected SSE client, so the database sees one
+    small indexed query per poll interval no matter how many dashboards are open.
+    The thread only runs while at least one client is connected.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        self.last_id = 0
+        self.last_prune = 0.0
+
+    def subscribe(self, since):
+        subscriber = queue.Queue(maxsize=SSE_REPLAY_LIMIT)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                # A running relay is never behind a new subscriber's replay query, and
+                # a fresh one starts from the subscriber's position, so no event is lost
+                self.last_id = since
+                self.thread = threading.Thread(target=self._run, name="dashboard-event-relay", daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                try:
+                    self._poll()
+                except Exception as e:
+                    print(f"Error relaying dashboard events: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                time.sleep(SSE_POLL_SECONDS)
+
+    def _poll(self):
+        events = (
+            DashboardEvent.query.filter(DashboardEvent.id > self.last_id)
+            .order_by(DashboardEvent.id)
+            .limit(SSE_REPLAY_LIMIT)
+            .all()
+        )
+        for event in events:
+            message = (event.id, format_sse_message(event))
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    # A stalled client; it catches up from Last-Event-ID on reconnect
+                    pass
+            self.last_id = event.id
+        if time.time() - self.last_prune > 600:
+            self.last_prune = time.time()
+            cutoff = datetime.utcnow() - timedelta(hours=DASHBOARD_EVENT_RETENTION_HOURS)
+            DashboardEvent.query.filter(DashboardEvent.created_at < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+
+dashboard_relay = DashboardEventRelay()
+
+@app.route("/admin/events")
+def admin_events():
+    """Server-Sent Events stream of shift changes for the admin dashboard"""
+    if not session.get("admin_authenticated"):
+        return "Not authorized", 403
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("since") or 0
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        last_event_id = 0
+    last_event_id = max(last_event_id, latest_dashboard_event_id() - SSE_REPLAY_LIMIT)
+    # gunicorn's sync worker is the one server here that cannot hold a request open
+    # without blocking every other request to that worker
+    short_poll = (
+        request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn/")
+        and not request.environ.get("wsgi.multithread")
+    )
+    stream_seconds = 0 if short_poll else SSE_STREAM_SECONDS
+    retry_ms = int(SSE_SHORT_POLL_SECONDS * 1000) if short_poll else 3000
+
+    def stream():
+        subscriber = dashboard_relay.subscribe(last_event_id)
+        last_sent = last_event_id
+        try:
+            yield f"retry: {retry_ms}\n\n"
+            # Catch up on anything since the page (or previous stream) was rendered;
+            # the relay queue is already collecting, so nothing falls in between.
+            missed = (
+                DashboardEvent.query.filter(DashboardEvent.id > last_sent)
+                .order_by(DashboardEvent.id)
+                .limit(SSE_REPLAY_LIMIT)
+                .all()
+            )
+            # Release the pooled connection; the rest of the stream never queries
+            db.session.close()
+            for event in missed:
+                last_sent = event.id
+                yield format_sse_message(event)
+            deadline = time.time() + stream_seconds
+            while time.time() < deadline:
+                try:
+                    event_id, message = subscriber.get(
+                        timeout=max(0.1, min(SSE_HEARTBEAT_SECONDS, deadline - time.time()))
+                    )
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event_id <= last_sent:
+                    continue
+                last_sent = event_id
+                yield message
+        finally:
+            dashboard_relay.unsubscribe(subscriber)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ---------------------------------------------------------------------------
+# Data versions and conditional admin responses
+# ---------------------------------------------------------------------------
+
+SHIFT_DATA_VERSION = "shifts"
+HEATMAP_DATA_VERSION = "manpower"
+# Table name -> data version bumped whenever a row in it is written
+DATA_VERSION_TABLES = {
+    "shift": SHIFT_DATA_VERSION, "break": SHIFT_DATA_VERSION, "shift_anomaly": SHIFT_DATA_VERSION,
+    "manpower_hour": HEATMAP_DATA_VERSION,
+}
+AGGREGATE_CACHE_SIZE = int(os.environ.get("AGGREGATE_CACHE_SIZE", 64))
+
+_aggregate_cache_lock = threading.Lock()
+_aggregate_cache = {"version": None, "entries": OrderedDict()}
+
+def _source_fingerprint():
+    """Hash of the app and its templates, so a deploy changes every ETag"""
+    digest = hashlib.sha1()
+    template_dir = os.path.join(app.root_path, "templates")
+    paths = [os.path.abspath(__file__)] + sorted(
+        os.path.join(template_dir, name) for name in os.listdir(template_dir)
+    )
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+ETAG_SALT = _source_fingerprint()
+SOURCE_LOADED_AT = datetime.utcnow().replace(microsecond=0)
+
+def bump_data_version(name, connection):
+    """Increment a data version inside the transaction that owns connection"""
+    if has_app_context():
+        g.wrote_data = True
+    table = DataVersion.__table__
+    now = datetime.utcnow()
+    stmt = _dialect_insert(table, connection.dialect.name).values(name=name, version=1, updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={"version": table.c.version + 1, "updated_at": now},
+    )
+    connection.execute(stmt)
+
+@event.listens_for(SASession, "after_flush")
+def _bump_data_versions_after_flush(session, flush_context):
+    # new/dirty/deleted still describe what this flush just wrote
+    names = {
+        DATA_VERSION_TABLES.get(getattr(obj, "__tablename__", None))
+        for obj in itertools.chain(session.new, session.dirty, session.deleted)
+    }
+    names.discard(None)
+    for name in sorted(names):
+        bump_data_version(name, session.connection())
+
+@event.listens_for(SASession, "do_orm_execute")
+def _bump_data_versions_on_bulk_write(orm_execute_state):
+    # Query.update()/delete() and session.execute(update(...)) bypass the flush
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    name = DATA_VERSION_TABLES.get(getattr(table, "name", None))
+    if name:
+        bump_data_version(name, orm_execute_state.session.connection())
+
+def get_data_version(name=SHIFT_DATA_VERSION, read_session=None):
+    """(version, updated_at) of a data version; (0, None) before the first write"""
+    row = (read_session or db.session).query(DataVersion.version, DataVersion.updated_at).filter_by(name=name).first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+def cached_aggregate(version, key, compute):
+    """Return compute() for key, reused by this process until version changes.
+
+    Only entries for the newest version seen are kept; a request still holding an
+    older version computes its result without caching it.
+    """
+    with _aggregate_cache_lock:
+        current = _aggregate_cache["version"]
+        if current is None or version[0] > current[0] or (version[0] == current[0] and version != current):
+            _aggregate_cache["version"] = version
+            _aggregate_cache["entries"].clear()
+        elif version == current and key in _aggregate_cache["entries"]:
+            _aggregate_cache["entries"].move_to_end(key)
+            return _aggregate_cache["entries"][key]
+    value = compute()
+    with _aggregate_cache_lock:
+        if _aggregate_cache["version"] == version:
+            _aggregate_cache["entries"][key] = value
+            while len(_aggregate_cache["entries"]) > AGGREGATE_CACHE_SIZE:
+                _aggregate_cache["entries"].popitem(last=False)
+    return value
+
+def project_history_rows(version, subcontractor=None, job_site=None):
+    """build_project_history() as plain dicts, cached per data version and filters"""
+    return cached_aggregate(
+        version,
+        ("project_history", subcontractor, job_site),
+        lambda: [
+            {
+                "subcontractor": h.subcontractor,
+                "job_site": h.job_site,
+                "first_day": h.first_day,
+                "last_day": h.last_day,
+                "manpower": h.manpower,
+            }
+            for h in build_project_history(subcontractor=subcontractor, job_site=job_site)
+        ],
+    )
+
+def subcontractor_days(version, subcontractor=None, job_site=None):
+    """calculate_subcontractor_days() cached per data version and filters"""
+    return cached_aggregate(
+        version,
+        ("subcontractor_days", subcontractor, job_site),
+        lambda: calculate_subcontractor_days(subcontractor=subcontractor, job_site=job_site),
+    )
+
+def filter_options(version):
+    """Distinct subcontractors and job sites for the admin filters"""
+    return cached_aggregate(
+        version,
+        ("filter_options",),
+        lambda: (
+            [row[0] for row in reporting_session().query(Shift.subcontractor).distinct().all()],
+            [row[0] for row in reporting_session().query(Shift.job_site).distinct().all()],
+        ),
+    )
+
+def response_etag(version, *parts):
+    """Validator for a response rendered from data at version plus request parts"""
+    version_number, updated_at = version
+    raw = json.dumps([ETAG_SALT, version_number, updated_at.isoformat() if updated_at else None, *parts])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def response_last_modified(version):
+    updated_at = version[1]
+    return max(updated_at.replace(microsecond=0), SOURCE_LOADED_AT) if updated_at else SOURCE_LOADED_AT
+
+def request_is_fresh(etag, last_modified):
+    """True when the client's cached copy still matches (If-None-Match wins over If-Modified-Since)"""
+    if session.get("_flashes"):
+        # A pending flash has to be rendered, so never answer 304 over it
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def add_cache_validators(response, etag, last_modified):
+    """Let browsers keep admin pages but revalidate them on every view"""
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+def not_modified_response(etag, last_modified):
+    return add_cache_validators(Response(status=304), etag, last_modified)
+
+# ---------------------------------------------------------------------------
+# Batch QR poster printing
+# ---------------------------------------------------------------------------
+
+QR_ACTIONS = ["clockin", "clockout"]
+QR_SHEET_DIR = os.environ.get("QR_SHEET_DIR", "qr_sheets")
+QR_PRINT_WORKERS = int(os.environ.get("QR_PRINT_WORKERS", os.cpu_count() or 1))
+
+_qr_pool_lock = threading.Lock()
+
+def _new_qr_print_pool():
+    # Spawned, not forked: by the time the pool is replaced the app runs the SSE
+    # relay, punch writer and outbox threads, and a fork could copy their held locks
+    # render_qr_poster lives in qr_posters, so the spawned processes import that
+    # small module rather than the whole app
+    if QR_PRINT_WORKERS < 2:
+        return None
+    return ProcessPoolExecutor(max_workers=QR_PRINT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+# Created at import, before any of the app's threads; processes start on first use
+_qr_pool = _new_qr_print_pool()
+
+def qr_print_pool():
+    global _qr_pool
+    with _qr_pool_lock:
+        if _qr_pool is None:
+            _qr_pool = _new_qr_print_pool()
+        return _qr_pool
+
+def render_qr_posters(jobs):
+    """Render posters across the process pool, in job order"""
+    if len(jobs) < 2 or QR_PRINT_WORKERS < 2:
+        return [render_qr_poster(job) for job in jobs]
+    global _qr_pool
+    try:
+        return list(qr_print_pool().map(render_qr_poster, jobs, chunksize=max(1, len(jobs) // (QR_PRINT_WORKERS * 4))))
+    except BrokenProcessPool as e:
+        print(f"QR print pool failed, rendering in-process: {e}")
+        with _qr_pool_lock:
+            _qr_pool = None
+        return [render_qr_poster(job) for job in jobs]
+
+def current_qr_batch_ids(job_sites, actions):
+    """Batch id per (job_site, action), creating and saving any that are missing"""
+    batches = load_qr_batches()
+    missing = [f"{job_site}::{action}" for job_site in job_sites for action in actions if f"{job_site}::{action}" not in batches]
+    for key in missing:
+        batches[key] = str(uuid.uuid4())
+    if missing:
+        save_qr_batches(batches)
+    return {(job_site, action): batches[f"{job_site}::{action}"] for job_site in job_sites for action in actions}
+
+def clear_qr_sheet_cache():
+    """Drop every cached sheet; called whenever a batch is rotated"""
+    if not os.path.isdir(QR_SHEET_DIR):
+        return
+    for name in os.listdir(QR_SHEET_DIR):
+        try:
+            os.remove(os.path.join(QR_SHEET_DIR, name))
+        except OSError as e:
+            print(f"Error removing cached QR sheet {name}: {e}")
+
+def build_qr_sheet(job_sites, actions, host_url, fmt="html"):
+    """One printable document with a poster per site/action.
+
+    Cached on disk under QR_SHEET_DIR, keyed by the batch ids it encodes, so it is
+    only regenerated after a batch rotation (or for a new site selection/host).
+    Returns (document bytes, mimetype).
+    """
+    batch_ids = current_qr_batch_ids(job_sites, actions)
+    key_source = json.dumps([fmt, host_url, [[site, action, batch_ids[(site, action)]] for site in job_sites for action in actions]])
+    path = os.path.join(QR_SHEET_DIR, f"{hashlib.sha1(key_source.encode()).hexdigest()}.{fmt}")
+    mimetype = "application/pdf" if fmt == "pdf" else "text/html"
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read(), mimetype
+
+    timestamp = int(time.time())
+    jobs = [
+        (site, action, qr_scan_url(host_url, site, batch_ids[(site, action)], timestamp, action), batch_ids[(site, action)], fmt == "pdf")
+        for site in job_sites
+        for action in actions
+    ]
+    images = render_qr_posters(jobs)
+    if fmt == "pdf":
+        pages = [Image.open(io.BytesIO(png)) for png in images]
+        buffer = io.BytesIO()
+        pages[0].save(buffer, format="PDF", save_all=True, append_images=pages[1:], resolution=150)
+        document = buffer.getvalue()
+    else:
+        posters = [
+            {"job_site": site, "action": action, "batch_id": batch_id, "image": base64.b64encode(png).decode()}
+            for (site, action, _, batch_id, _), png in zip(jobs, images)
+        ]
+        document = render_template("print_qr_sheet.html", posters=posters).encode("utf-8")
+
+    os.makedirs(QR_SHEET_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(document)
+    os.replace(tmp_path, path)
+    return document, mimetype
+
+def selected_qr_sheet(job_sites, actions):
+    """Validate site/action selections; empty means all of them"""
+    unknown = [site for site in job_sites if site not in JOB_SITES] + [a for a in actions if a not in QR_ACTIONS]
+    if unknown:
+        raise ValueError(f"Unknown job site or action: {', '.join(unknown)}")
+    return [site for site in JOB_SITES if site in job_sites] or JOB_SITES, [a for a in QR_ACTIONS if a in actions] or QR_ACTIONS
+
+@app.route("/admin/qr_codes/print_all")
+def print_all_qr_codes():
+    if not session.get("admin_authenticated"):
+        return redirect(url_for("admin_view"))
+    fmt = request.args.get("format", "html")
+    if fmt not in ("html", "pdf"):
+        return "Invalid format, expected html or pdf.", 400
+    try:
+        job_sites, actions = selected_qr_sheet(request.args.getlist("site"), request.args.getlist("action"))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        document, mimetype = build_qr_sheet(job_sites, actions, request.host_url, fmt)
+    except Exception as e:
+        print(f"Error building QR sheet: {e}")
+        flash(f"Error building QR sheet: {e}", "error")
+        return redirect(url_for("admin_qr_codes"))
+    headers = {}
+    if fmt == "pdf":
+        headers["Content-Disposition"] = "inline;filename=qr_posters.pdf"
+    return Response(document, mimetype=mimetype, headers=headers)
+
+@app.cli.command("print-qr-sheet")
+@click.option("--site", "sites", multiple=True, help="Job site to include (repeatable, default all).")
+@click.option("--action", "actions", multiple=True, type=click.Choice(QR_ACTIONS), help="Action to include (default both).")
+@click.option("--format", "fmt", type=click.Choice(["html", "pdf"]), default="pdf", show_default=True)
+@click.option("--base-url", required=True, help="Public URL the QR codes point at, e.g. https://shifts.example.com")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), help="Write to a file instead of only warming the cache.")
+def print_qr_sheet_command(sites, actions, fmt, base_url, output):
+    """Generate the printable QR poster sheet and cache it for the web endpoint."""
+    try:
+        job_sites, actions = selected_qr_sheet(list(sites), list(actions))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    started = time.time()
+    document, _ = build_qr_sheet(job_sites, actions, base_url.rstrip("/") + "/", fmt)
+    if output:
+        with open(output, "wb") as f:
+            f.write(document)
+    click.echo(f"{len(job_sites) * len(actions)} posters, {len(document)} bytes in {time.time() - started:.2f}s")
+
+# ---------------------------------------------------------------------------
+# Static asset fingerprinting and response compression
+# ---------------------------------------------------------------------------
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is always available
+    brotli = None
+
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Buffered bodies smaller than this go out uncompressed. Streamed bodies (CSV
+# exports) are always compressed, since their size is unknown up front.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+COMPRESS_MIMETYPES = {
+    "text/html",
+    "text/css",
+    "text/csv",
+    "text/plain",
+    "application/json",
+    "application/javascript",
+    "application/manifest+json",
+}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+_static_fingerprints = {}
+
+def static_fingerprint(filename):
+    """Short content hash of a file under static/, or None if it does not exist"""
+    if filename not in _static_fingerprints:
+        path = os.path.join(app.static_folder, filename)
+        try:
+            with open(path, "rb") as f:
+                _static_fingerprints[filename] = hashlib.sha1(f.read()).hexdigest()[:12]
+        except OSError:
+            return None
+    return _static_fingerprints[filename]
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    # url_for('static', filename=...) -> /static/style.css?v=<hash>
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        fingerprint = static_fingerprint(values["filename"])
+        if fingerprint:
+            values["v"] = fingerprint
+
+def _compressor(encoding):
+    """(compress, flush) pair for a streaming encoder"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+def _compress_stream(chunks, encoding):
+    compress, flush = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compress(chunk)
+            if data:
+                yield data
+        yield flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.after_request
+def cache_and_compress(response):
+    if request.endpoint == "static":
+        filename = (request.view_args or {}).get("filename")
+        if filename and request.args.get("v") == static_fingerprint(filename):
+            # The URL changes whenever the content does
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.mimetype not in COMPRESS_MIMETYPES
+        or "Content-Encoding" in response.headers
+        or request.method == "HEAD"
+    ):
+        return response
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encoding = request.accept_encodings.best_match(offered)
+    if not encoding:
+        return response
+
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Same content, different bytes: only weakly equal to the identity encoding
+        response.set_etag(etag, weak=True)
+    return response
+
+# ---------------------------------------------------------------------------
+# Worker search
+# ---------------------------------------------------------------------------
+
+WORKER_SEARCH_CANDIDATES = 200
+# Fall back to trigram-overlap matching when fewer substring matches than this
+WORKER_SEARCH_FUZZY_BELOW = 20
+WORKER_SEARCH_FUZZY_TRIGRAMS = 5
+WORKER_SEARCH_MIN_SCORE = 0.5
+# Similarity above which a new name at clock-in is probably a typo of an existing worker
+WORKER_DUPLICATE_SCORE = 0.8
+
+_worker_search_state = {"ready": False, "fts": False}
+
+def ensure_worker_search_index():
+    """Create the search index for worker_directory once per process.
+
+    SQLite: an external-content FTS5 table with the trigram tokenizer, kept in
+    sync by triggers. Postgres: a pg_trgm GIN index on lower(name). If neither
+    is available search falls back to a LIKE scan.
+    """
+    if _worker_search_state["ready"]:
+        return _worker_search_state["fts"]
+    dialect_name = db.engine.dialect.name
+    try:
+        if dialect_name == "sqlite":
+            exists = db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'worker_search'")
+            ).first()
+            db.session.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS worker_search USING fts5("
+                "name, subcontractor, content='worker_directory', content_rowid='id', tokenize='trigram')"
+            ))
+            db.session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS worker_directory_ai AFTER INSERT ON worker_directory BEGIN "
+                "INSERT INTO worker_search(rowid, name, subcontractor) VALUES (new.id, new.name, new.subcontractor); END"
+            ))
+            db.session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS worker_directory_ad AFTER DELETE ON worker_directory BEGIN "
+                "INSERT INTO worker_search(worker_search, rowid, name, subcontractor) "
+                "VALUES ('delete', old.id, old.name, old.subcontractor); END"
+            ))
+            db.session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS worker_directory_au AFTER UPDATE OF name, subcontractor ON worker_directory BEGIN "
+                "INSERT INTO worker_search(worker_search, rowid, name, subcontractor) "
+                "VALUES ('delete', old.id, old.name, old.subcontractor); "
+                "INSERT INTO worker_search(rowid, name, subcontractor) VALUES (new.id, new.name, new.subcontractor); END"
+            ))
+            db.session.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS worker_search_vocab USING fts5vocab(worker_search, 'row')"
+            ))
+            if not exists:
+                db.session.execute(text("INSERT INTO worker_search(worker_search) VALUES ('rebuild')"))
+        elif dialect_name == "postgresql":
+            db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            db.session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_worker_directory_name_trgm "
+                "ON worker_directory USING gin (lower(name) gin_trgm_ops)"
+            ))
+        db.session.commit()
+        _worker_search_state["fts"] = dialect_name in ("sqlite", "postgresql")
+    except Exception as e:
+        print(f"Worker search index unavailable, using LIKE search: {e}")
+        db.session.rollback()
+        _worker_search_state["fts"] = False
+    _worker_search_state["ready"] = True
+    return _worker_search_state["fts"]
+
+def record_worker(name, subcontractor, code):
+    """Add a worker to the search directory inside the caller's transaction"""
+    table = WorkerDirectory.__table__
+    stmt = _dialect_insert(table).values(
+        name=name, subcontractor=subcontractor, code=code, first_seen=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=[table.c.name, table.c.subcontractor, table.c.code])
+    db.session.execute(stmt)
+
+def rebuild_worker_directory():
+    """Backfill the directory from worker codes and historic shift names"""
+    rows = {}
+    for name, subcontractor, code, first_seen in db.session.query(
+        Shift.name, Shift.subcontractor, Shift.code, func.min(Shift.clock_in)
+    ).group_by(Shift.name, Shift.subcontractor, Shift.code):
+        rows[(name, subcontractor, code)] = first_seen
+    for worker in WorkerCode.query.all():
+        rows.setdefault((worker.name, worker.subcontractor, worker.code), None)
+    table = WorkerDirectory.__table__
+    stmt = _dialect_insert(table).on_conflict_do_nothing(
+        index_elements=[table.c.name, table.c.subcontractor, table.c.code]
+    )
+    values = [
+        {"name": name, "subcontractor": subcontractor, "code": code, "first_seen": first_seen or datetime.utcnow()}
+        for (name, subcontractor, code), first_seen in rows.items()
+    ]
+    for start in range(0, len(values), 5000):
+        db.session.execute(stmt, values[start:start + 5000])
+    db.session.commit()
+    return len(values)
+
+def _fts5_string(value):
+    return '"{}"'.format(value.replace('"', '""'))
+
+def _rare_trigrams(query, count):
+    """The query's trigrams that occur in the fewest indexed rows (absent ones are skipped)"""
+    trigrams = sorted({query[i:i + 3] for i in range(len(query) - 2)})
+    vocab = db.table("worker_search_vocab", db.column("term"), db.column("doc"))
+    stmt = db.select([vocab.c.term]).where(vocab.c.term.in_(trigrams)).order_by(vocab.c.doc).limit(count)
+    return [row.term for row in db.session.execute(stmt)]
+
+def worker_match_score(query, name):
+    """Prefix and substring matches first, then edit similarity (0..1)"""
+    query = query.lower()
+    name = name.lower()
+    if name.startswith(query) or any(part.startswith(query) for part in name.split()):
+        return 2.0 + len(query) / len(name)
+    if query in name:
+        return 1.5 + len(query) / len(name)
+    return difflib.SequenceMatcher(None, query, name).ratio()
+
+def _worker_candidates(query, subcontractor=None, limit=WORKER_SEARCH_CANDIDATES, always_fuzzy=False):
+    directory = WorkerDirectory.__table__
+    columns = [directory.c.name, directory.c.subcontractor, directory.c.code, directory.c.first_seen]
+    dialect_name = db.engine.dialect.name
+    lowered = query.lower()
+
+    def restrict(stmt):
+        if subcontractor:
+            stmt = stmt.where(directory.c.subcontractor == subcontractor)
+        return stmt
+
+    if ensure_worker_search_index() and dialect_name == "sqlite" and len(lowered) >= 3:
+        worker_search = db.table("worker_search", db.column("rowid"), db.column("rank"))
+
+        def fts_rows(match, ranked):
+            stmt = db.select(columns).select_from(
+                directory.join(worker_search, worker_search.c.rowid == directory.c.id)
+            ).where(text("worker_search MATCH :match"))
+            if ranked:
+                stmt = stmt.order_by(worker_search.c.rank)
+            return db.session.execute(restrict(stmt.limit(limit)), {"match": match}).fetchall()
+
+        # Substring matches need every trigram of the query and come back without ranking
+        rows = fts_rows(_fts5_string(lowered), ranked=False)
+        if always_fuzzy or len(rows) < WORKER_SEARCH_FUZZY_BELOW:
+            # Misspellings: any of the query's rarest trigrams, best bm25 first. Common
+            # trigrams ("jos", "ez ") would match most of the table and only add cost.
+            rare = _rare_trigrams(lowered, WORKER_SEARCH_FUZZY_TRIGRAMS)
+            if rare:
+                seen = {tuple(row) for row in rows}
+                rows += [row for row in fts_rows(" OR ".join(_fts5_string(t) for t in rare), ranked=True) if tuple(row) not in seen]
+        return rows
+    if _worker_search_state["fts"] and dialect_name == "postgresql":
+        lower_name = func.lower(directory.c.name)
+        stmt = (
+            db.select(columns)
+            .where(db.or_(lower_name.op("%")(lowered), db.literal(lowered).op("<%")(lower_name), lower_name.like(f"{lowered}%")))
+            .order_by(func.similarity(lower_name, lowered).desc())
+            .limit(limit)
+        )
+    else:
+        stmt = db.select(columns).where(directory.c.name.ilike(f"%{query}%")).limit(limit)
+    return db.session.execute(restrict(stmt)).fetchall()
+
+def search_workers(query, subcontractor=None, limit=20, min_score=WORKER_SEARCH_MIN_SCORE, always_fuzzy=False):
+    """Workers whose name matches query by prefix, substring or near spelling.
+
+    The index narrows 100k+ names to a few hundred candidates; those are then
+    ranked in Python so both databases order results the same way.
+    """
+    query = " ".join(query.split())
+    if len(query) < 2:
+        return []
+    results = []
+    for row in _worker_candidates(query, subcontractor, always_fuzzy=always_fuzzy):
+        score = worker_match_score(query, row.name)
+        if score >= min_score:
+            results.append({
+                "name": row.name,
+                "subcontractor": row.subcontractor,
+                "code": row.code,
+                "first_seen": row.first_seen.isoformat() if row.first_seen else None,
+                "score": round(score, 3),
+            })
+    results.sort(key=lambda r: (-r["score"], r["name"]))
+    return results[:limit]
+
+def find_similar_worker(name, subcontractor):
+    """The existing worker of the same subcontractor a new clock-in name is probably a misspelling of.
+
+    Returns only that name (or None). The kiosk uses it as a yes/no signal and never
+    shows it: the page is unauthenticated, so it must not reveal other workers.
+    """
+    name = " ".join(name.split())
+    best, best_ratio = None, 0.0
+    for match in search_workers(
+        name, subcontractor=subcontractor, limit=WORKER_SEARCH_CANDIDATES, min_score=WORKER_DUPLICATE_SCORE, always_fuzzy=True
+    ):
+        if match["name"].lower() == name.lower():
+            continue
+        # Whole-name similarity, so "Jose" does not flag every "Jose ..." as a duplicate
+        ratio = difflib.SequenceMatcher(None, name.lower(), match["name"].lower()).ratio()
+        if ratio >= WORKER_DUPLICATE_SCORE and ratio > best_ratio:
+            best, best_ratio = match["name"], ratio
+    return best
+
+@app.route("/api/workers/search")
+def api_search_workers():
+    """Prefix/fuzzy worker search for admins (includes worker codes)"""
+    if not session.get("admin_authenticated"):
+        return {"status": "error", "message": "Not authorized"}, 403
+    try:
+        limit = min(int(request.args.get("limit", 20)), 100)
+    except ValueError:
+        limit = 20
+    started = time.perf_counter()
+    results = search_workers(
+        request.args.get("q", ""), subcontractor=request.args.get("subcontractor") or None, limit=limit
+    )
+    return {"results": results, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+@app.route("/add_worker_search_index")
+def add_worker_search_index():
+    try:
+        db.create_all()
+        _worker_search_state["ready"] = False
+        count = rebuild_worker_directory()
+        indexed = ensure_worker_search_index()
+        return f"Worker directory rebuilt with {count} workers ({'indexed' if indexed else 'LIKE fallback'})."
+    except Exception as e:
+        db.session.rollback()
+        return f"Error: {e}"
+
+@app.cli.command("rebuild-worker-search")
+def rebuild_worker_search_command():
+    """Backfill the worker search directory from worker codes and shifts."""
+    count = rebuild_worker_directory()
+    indexed = ensure_worker_search_index()
+    click.echo(f"{count} workers, {'indexed' if indexed else 'LIKE fallback'} search")
+
+# ---------------------------------------------------------------------------
+# Read replica for admin reporting
+# ---------------------------------------------------------------------------
+
+# Optional. Locally, point it at a second SQLite file and run `flask sync-replica`
+# (optionally with --every N to simulate a lagging replica).
+REPLICA_DATABASE_URL = os.environ.get("REPLICA_DATABASE_URL")
+if REPLICA_DATABASE_URL and REPLICA_DATABASE_URL.startswith("postgres://"):
+    REPLICA_DATABASE_URL = REPLICA_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+REPLICA_RETRY_SECONDS = 30
+
+_replica_lock = threading.Lock()
+_replica_state = {"engine": None, "sessionmaker": None, "down_until": 0.0}
+
+def replica_engine():
+    """Engine for REPLICA_DATABASE_URL, or None when no replica is configured"""
+    if not REPLICA_DATABASE_URL:
+        return None
+    with _replica_lock:
+        if _replica_state["engine"] is None:
+            url = sqlalchemy.engine.make_url(REPLICA_DATABASE_URL)
+            options = {"pool_pre_ping": True}
+            if url.get_backend_name() == "sqlite":
+                if url.database and url.database != ":memory:" and not os.path.isabs(url.database):
+                    # Same rule Flask-SQLAlchemy applies to the primary: relative to the app
+                    url = url.set(database=os.path.join(app.root_path, url.database))
+            else:
+                options.update(pool_recycle=300, connect_args={
+                    "connect_timeout": 10, "application_name": "shift_logger_reporting",
+                })
+            _replica_state["engine"] = sqlalchemy.create_engine(url, **options)
+            _replica_state["sessionmaker"] = sqlalchemy.orm.sessionmaker(bind=_replica_state["engine"])
+        return _replica_state["engine"]
+
+def reporting_session():
+    """Session for admin reports and exports.
+
+    The replica when one is configured and reachable, unless it has not yet
+    replayed a write this admin made (read-your-writes) or this request has
+    written something itself; the primary otherwise. The choice is made once per
+    request so the data version and the data it labels come from the same place.
+    """
+    if "reporting_session" in g:
+        return g.reporting_session
+    chosen = db.session
+    engine = replica_engine()
+    if engine is not None and not g.get("wrote_data") and time.time() >= _replica_state["down_until"]:
+        replica = _replica_state["sessionmaker"]()
+        try:
+            required = session.get("read_version", 0) if has_request_context() else 0
+            if get_data_version(read_session=replica)[0] >= required:
+                chosen = replica
+                g.replica_session = replica
+                if required:
+                    session.pop("read_version", None)
+            else:
+                replica.close()
+        except Exception as e:
+            print(f"Read replica unavailable, using primary for {REPLICA_RETRY_SECONDS}s: {e}")
+            replica.close()
+            _replica_state["down_until"] = time.time() + REPLICA_RETRY_SECONDS
+    g.reporting_session = chosen
+    return chosen
+
+@app.after_request
+def remember_admin_writes(response):
+    # An admin who just changed data must not see the replica's older copy of it
+    if REPLICA_DATABASE_URL and g.get("wrote_data") and session.get("admin_authenticated"):
+        try:
+            session["read_version"] = get_data_version()[0]
+        except Exception as e:
+            print(f"Error recording read-your-writes version: {e}")
+    return response
+
+@app.teardown_appcontext
+def close_reporting_session(exc):
+    replica = g.pop("replica_session", None)
+    if replica is not None:
+        replica.close()
+    g.pop("reporting_session", None)
+
+@app.cli.command("sync-replica")
+@click.option("--every", type=float, help="Keep copying every N seconds (simulates a lagging replica).")
+def sync_replica_command(every):
+    """Copy the primary SQLite database into the SQLite replica (local testing)."""
+    engine = replica_engine()
+    if engine is None:
+        raise click.ClickException("REPLICA_DATABASE_URL is not set.")
+    if db.engine.dialect.name != "sqlite" or engine.dialect.name != "sqlite":
+        raise click.ClickException("sync-replica only copies SQLite files; use Postgres streaming replication.")
+    while True:
+        source = db.engine.raw_connection()
+        target = engine.raw_connection()
+        try:
+            source.connection.backup(target.connection)
+        finally:
+            target.close()
+            source.close()
+        click.echo(f"Replica synced at data version {get_data_version()[0]}")
+        db.session.remove()
+        if not every:
+            break
+        time.sleep(every)
+
+# ---------------------------------------------------------------------------
+# Punch write pipeline
+# ---------------------------------------------------------------------------
+
+# Punches are committed in small groups by one writer thread per process, so a
+# burst of workers arriving at once pays for a handful of commits instead of one
+# each. PUNCH_PIPELINE=0 commits every punch on the request thread instead.
+PUNCH_PIPELINE_ENABLED = os.environ.get("PUNCH_PIPELINE", "1") != "0"
+PUNCH_BATCH_SIZE = int(os.environ.get("PUNCH_BATCH_SIZE", 32))
+PUNCH_BATCH_WINDOW_MS = float(os.environ.get("PUNCH_BATCH_WINDOW_MS", 5))
+PUNCH_TIMEOUT_SECONDS = 30
+
+class PunchError(Exception):
+    """A punch rejected by validation; the message is shown to the worker as is."""
+
+class PunchPending(PunchError):
+    """The punch writer did not answer in time; the punch may or may not be saved yet."""
+
+class PunchKeyReused(PunchError):
+    """An idempotency key arrived again with a different punch than the one it was first used for."""
+
+def punch_clock_in(name, subcontractor, job_site, now, qr_batch_id=None, offline=False):
+    """Open a shift for a named worker and return their code (offline: queued on a phone, flag for review)"""
+    existing_shift = lookup_open_shift(name, subcontractor)
+    if existing_shift:
+        raise PunchError(f"You are already clocked in at job site: {existing_shift[1]}.")
+    code = get_or_create_code(name, subcontractor)
+    extra = {"offline": True} if offline else {}
+    shift = record_clock_event(
+        "clockin", now, code=code, name=name, subcontractor=subcontractor, job_site=job_site, qr_batch_id=qr_batch_id,
+        **extra
+    )
+    adjust_occupancy(job_site, subcontractor, 1)
+    publish_dashboard_event("clockin", shift, on_site_delta=1)
+    return code
+
+def punch_quick_clock_in(code, job_site, now):
+    """Open a shift for the worker who owns an existing code"""
+    worker = get_worker_by_code(code)
+    if not worker:
+        raise PunchError("Code not found. If you're a new worker please use the New Worker form.")
+    active = lookup_open_shift(worker.name, worker.subcontractor)
+    if active:
+        raise PunchError(f"You are already clocked in at job site: {active[1]}.")
+    shift = record_clock_event("clockin", now, code=code, name=worker.name, subcontractor=worker.subcontractor, job_site=job_site)
+    adjust_occupancy(job_site, worker.subcontractor, 1)
+    publish_dashboard_event("clockin", shift, on_site_delta=1)
+
+def punch_break_start(code, now):
+    if not Shift.query.filter_by(code=code).first():
+        raise PunchError("Code not found.")
+    last_break = Break.query.filter_by(shift_code=code).order_by(Break.id.desc()).first()
+    if last_break and last_break.end is None:
+        raise PunchError("You are already on a break.")
+    open_shift = Shift.query.filter_by(code=code, clock_out=None).first()
+    record_clock_event("break_start", now, shift_id=open_shift.id if open_shift else None, code=code)
+    if open_shift:
+        publish_dashboard_event("break_start", open_shift)
+
+def punch_break_end(code, now):
+    last_break = Break.query.filter_by(shift_code=code).order_by(Break.id.desc()).first()
+    if not last_break or last_break.end is not None:
+        raise PunchError("No break to resume.")
+    open_shift = Shift.query.filter_by(code=code, clock_out=None).first()
+    record_clock_event("break_end", now, shift_id=open_shift.id if open_shift else None, break_id=last_break.id, code=code)
+    if open_shift:
+        publish_dashboard_event("break_end", open_shift)
+
+def punch_clock_out(code, now, job_site=None, offline=False):
+    """Close the worker's open shift.
+
+    Returns (total seconds, working seconds), or None when no open shift matches
+    the code (and job site, for QR punches, which also update project history).
+    offline marks a punch queued on a phone, which flags the shift for review.
+    """
+    query = Shift.query.filter_by(code=code, clock_out=None)
+    if job_site is not None:
+        query = query.filter_by(job_site=job_site)
+    shift = query.order_by(Shift.clock_in.desc()).first()
+    if not shift:
+        return None
+    if now < shift.clock_in:
+        # Only a queued punch's phone-reported delay can get here
+        raise PunchError("This clock-out is earlier than your clock-in. Please ask your supervisor to record it.")
+    extra = {"offline": True} if offline else {}
+    total_seconds, working_seconds = record_clock_event("clockout", now, shift_id=shift.id, code=code, **extra)
+    adjust_occupancy(shift.job_site, shift.subcontractor, -1)
+    publish_dashboard_event("clockout", shift, on_site_delta=-1, days_delta=1, hours_delta=working_seconds / 3600)
+    if job_site is not None:
+        update_subcontractor_history(shift)
+    sync_to_procore(shift)
+    return total_seconds, working_seconds
+
+class PunchPipeline:
+    """Group commit for punch operations.
+
+    Request threads queue (operation, args, future) and wait on the future. One
+    writer thread per process takes whatever has arrived within PUNCH_BATCH_WINDOW_MS
+    (up to PUNCH_BATCH_SIZE), runs the operations in one transaction and commits
+    once. Futures are only resolved after that commit, so a caller told its punch
+    succeeded knows it is durable. PunchError from one operation fails just that
+    punch; any other error rolls the group back and replays each operation in its
+    own transaction, so one bad punch never takes its neighbours down with it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.thread = None
+
+    def submit(self, operation, *args):
+        future = Future()
+        self.pending.put((operation, args, future))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="punch-writer", daemon=True)
+                self.thread.start()
+        try:
+            return future.result(timeout=PUNCH_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            # Never report a failure for a punch that may still commit
+            if future.cancel():
+                raise PunchPending("The system is busy and your punch was not recorded. Please try again.")
+            raise PunchPending("Your punch is still being saved. Please wait a minute and check before punching again.")
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + PUNCH_BATCH_WINDOW_MS / 1000
+        while len(batch) < PUNCH_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                # Drops punches whose caller gave up waiting before they started
+                batch = [item for item in self._next_batch() if item[2].set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+                try:
+                    self._commit_batch(batch)
+                except Exception as e:
+                    print(f"Error committing punch batch of {len(batch)}, retrying one by one: {e}")
+                    db.session.rollback()
+                    for item in batch:
+                        if not item[2].done():
+                            self._commit_one(item)
+                finally:
+                    db.session.remove()
+
+    def _commit_batch(self, batch):
+        results = []
+        for operation, args, future in batch:
+            try:
+                results.append((future, operation(*args)))
+            except PunchError as e:
+                # Validation runs before an operation changes anything
+                future.set_exception(e)
+        db.session.commit()
+        for future, result in results:
+            future.set_result(result)
+
+    def _commit_one(self, item):
+        operation, args, future = item
+        try:
+            result = operation(*args)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+punch_pipeline = PunchPipeline()
+
+def run_punch(operation, *args):
+    """Run a punch_* operation, committed, and return its result.
+
+    Raises PunchError with a message for the worker when the punch is rejected.
+    """
+    # End this request's own transaction first: an open SQLite read would block
+    # the writer's commit while we wait for it
+    db.session.commit()
+    if PUNCH_PIPELINE_ENABLED:
+        return punch_pipeline.submit(operation, *args)
+    try:
+        result = operation(*args)
+        db.session.commit()
+        return result
+    except Exception:
+        db.session.rollback()
+        raise
+
+BENCHMARK_SUBCONTRACTOR = "__benchmark__"
+
+def delete_benchmark_punches():
+    """Remove the benchmark's shifts and what was derived from them.
+
+    The shifts are deleted like an admin would delete them, so the clock event log
+    stays append-only: it keeps the benchmark's punches and gains an admin_delete
+    for each shift, and a replay still ends where the tables do.
+    """
+    shift_ids = [shift_id for shift_id, in db.session.query(Shift.id).filter_by(subcontractor=BENCHMARK_SUBCONTRACTOR)]
+    if shift_ids:
+        bulk_shift_action("delete", shift_ids)
+    WorkerCode.query.filter_by(subcontractor=BENCHMARK_SUBCONTRACTOR).delete(synchronize_session=False)
+    WorkerDirectory.query.filter_by(subcontractor=BENCHMARK_SUBCONTRACTOR).delete(synchronize_session=False)
+    SiteOccupancy.query.filter_by(subcontractor=BENCHMARK_SUBCONTRACTOR).delete(synchronize_session=False)
+    ManpowerHour.query.filter_by(subcontractor=BENCHMARK_SUBCONTRACTOR).delete(synchronize_session=False)
+    SubcontractorProjectHistory.query.filter_by(subcontractor=BENCHMARK_SUBCONTRACTOR).delete(synchronize_session=False)
+    DashboardEvent.query.filter(
+        DashboardEvent.payload.like(f'%"subcontractor": "{BENCHMARK_SUBCONTRACTOR}"%')
+    ).delete(synchronize_session=False)
+    # sync_to_procore skips benchmark shifts; this clears rows queued before it did
+    OutboxMessage.query.filter(
+        OutboxMessage.payload.like(f'%"subcontractor": "{BENCHMARK_SUBCONTRACTOR}"%')
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+@app.cli.command("benchmark-punches")
+@click.option("--threads", default=16, show_default=True, help="Concurrent workers punching.")
+@click.option("--punches", default=2000, show_default=True, help="Punches per run (half clock-ins, half clock-outs).")
+@click.option("--database-url", default=None,
+              help="Scratch database to punch into (default: a temporary SQLite file). Never the app's own.")
+def benchmark_punches_command(threads, punches, database_url):
+    """Measure punches per second with and without the write pipeline.
+
+    Runs against a scratch database, so no dashboard events, data versions or
+    outbox rows reach the live one. Punches use the __benchmark__ subcontractor
+    and are deleted afterwards.
+    """
+    global PUNCH_PIPELINE_ENABLED, WORKER_CACHE_ENABLED
+    live_uri, live_options = app.config["SQLALCHEMY_DATABASE_URI"], app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    if database_url and database_url.replace("postgres://", "postgresql://", 1) == live_uri:
+        raise click.BadParameter("must be a scratch database, not the app's own", param_hint="--database-url")
+    scratch_dir = None
+    if not database_url:
+        scratch_dir = tempfile.mkdtemp(prefix="punch_benchmark_")
+        database_url = "sqlite:///" + os.path.join(scratch_dir, "benchmark.db")
+    db.session.remove()
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_pre_ping": True}
+    configured = PUNCH_PIPELINE_ENABLED, WORKER_CACHE_ENABLED
+    # The shared worker cache describes the live database
+    WORKER_CACHE_ENABLED = False
+    db.create_all()
+    click.echo(f"Benchmarking against {database_url}")
+    job_site = JOB_SITES[0]
+    cycles = max(punches // 2 // threads, 1)
+
+    def worker(run, index, errors):
+        with app.app_context():
+            name = f"Benchmark {run} {index}"
+            for _ in range(cycles):
+                try:
+                    code = run_punch(punch_clock_in, name, BENCHMARK_SUBCONTRACTOR, job_site, datetime.now())
+                    run_punch(punch_clock_out, code, datetime.now())
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+    try:
+        for run, enabled in enumerate((False, True)):
+            PUNCH_PIPELINE_ENABLED = enabled
+            errors = []
+            workers = [threading.Thread(target=worker, args=(run, i, errors)) for i in range(threads)]
+            started = time.perf_counter()
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            elapsed = time.perf_counter() - started
+            done = cycles * threads * 2
+            label = "pipeline" if enabled else "per-punch commit"
+            click.echo(f"{label:>17}: {done} punches in {elapsed:.2f}s = {done / elapsed:,.0f} punches/s ({len(errors)} errors)")
+            if errors:
+                click.echo(f"{'':>19}first error: {errors[0]}")
+            db.session.remove()
+    finally:
+        PUNCH_PIPELINE_ENABLED, WORKER_CACHE_ENABLED = configured
+        delete_benchmark_punches()
+        db.session.remove()
+        db.get_engine().dispose()
+        app.config["SQLALCHEMY_DATABASE_URI"], app.config["SQLALCHEMY_ENGINE_OPTIONS"] = live_uri, live_options
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+# ---------------------------------------------------------------------------
+# Clock event log
+# ---------------------------------------------------------------------------
+
+# Every change to a shift or break is appended to clock_event first; the shift and
+# break tables are projections of the log, updated in the same transaction by
+# apply_clock_event() and rebuildable at any time with `flask rebuild-shifts`.
+CLOCK_EVENT_REPLAY_CHUNK = 1000
+
+class ClockReplayError(Exception):
+    """The log cannot reproduce the current shift and break tables; nothing was changed"""
+
+def _event_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+def own_breaks(shift_code, clock_in, clock_out):
+    """Condition for the breaks taken during one shift.
+
+    Codes are reused across a worker's shifts, so breaks are matched on the code
+    and on starting within the shift. Takes columns or values.
+    """
+    if clock_out is None:
+        started_before_end = db.true()
+    elif isinstance(clock_out, datetime):
+        started_before_end = Break.start <= clock_out
+    else:
+        started_before_end = db.or_(clock_out.is_(None), Break.start <= clock_out)
+    return db.and_(Break.shift_code == shift_code, Break.start >= clock_in, started_before_end)
+
+def shift_totals(clock_in, clock_out, breaks):
+    """(total seconds, working seconds, break summary) for a closed shift.
+
+    breaks are (start, end) pairs for the shift's code; only finished breaks that
+    start within the shift count.
+    """
+    total_seconds = (clock_out - clock_in).total_seconds()
+    taken = sorted((start, end) for start, end in breaks if start and end and clock_in <= start <= clock_out)
+    total_break = sum((end - start).total_seconds() for start, end in taken)
+    breaks_str = "; ".join(f"{start.strftime('%I:%M %p')} - {end.strftime('%I:%M %p')}" for start, end in taken)
+    return total_seconds, total_seconds - total_break, breaks_str
+
+def close_shift(shift, clock_out):
+    """Set clock-out, totals and the break summary; returns (total, working) seconds"""
+    breaks = db.session.query(Break.start, Break.end).filter(own_breaks(shift.code, shift.clock_in, clock_out)).all()
+    total_seconds, working_seconds, breaks_str = shift_totals(shift.clock_in, clock_out, breaks)
+    shift.clock_out = clock_out
+    shift.total_time = format_seconds(total_seconds)
+    shift.working_time = format_seconds(working_seconds)
+    shift.breaks = breaks_str
+    return total_seconds, working_seconds
+
+def _apply_clockin(event, data):
+    shift = Shift(
+        id=event.shift_id,
+        name=data["name"],
+        subcontractor=data["subcontractor"],
+        job_site=data["job_site"],
+        clock_in=event.occurred_at,
+        code=event.code,
+        qr_batch_id=data.get("qr_batch_id"),
+        created_at=event.recorded_at,
+    )
+    # Shifts that predate the log were backfilled as one clockin carrying their final state
+    if "clock_out" in data:
+        shift.clock_out = _event_time(data["clock_out"])
+        shift.total_time = data.get("total_time")
+        shift.working_time = data.get("working_time")
+        shift.breaks = data.get("breaks")
+        shift.flagged = data.get("flagged", False)
+    if data.get("offline"):
+        # The punch time came from the phone; payroll checks these
+        shift.flagged = True
+    db.session.add(shift)
+    return shift
+
+def _apply_break_start(event, data):
+    brk = Break(id=event.break_id, shift_code=event.code, start=event.occurred_at, end=_event_time(data.get("end")))
+    db.session.add(brk)
+    return brk
+
+def _apply_break_end(event, data):
+    brk = db.session.get(Break, event.break_id)
+    brk.end = event.occurred_at
+    return brk
+
+def _close_from_event(shift, clock_out, data):
+    """close_shift() for a new event; a replayed one restores the totals it recorded"""
+    if "working_time" not in data:
+        return close_shift(shift, clock_out)
+    shift.clock_out = clock_out
+    shift.total_time = data["total_time"]
+    shift.working_time = data["working_time"]
+    shift.breaks = data["breaks"]
+
+def _apply_clockout(event, data):
+    shift = db.session.get(Shift, event.shift_id)
+    if data.get("offline"):
+        shift.flagged = True
+    return _close_from_event(shift, event.occurred_at, data)
+
+def _apply_auto_close(event, data):
+    shift = db.session.get(Shift, event.shift_id)
+    shift.clock_out = event.occurred_at
+    shift.total_time = format_seconds(data["max_hours"] * 3600)
+    shift.working_time = shift.total_time
+    shift.breaks = "AUTO-CLOSED"
+    shift.flagged = True
+    return shift
+
+def _apply_admin_edit(event, data):
+    shift = db.session.get(Shift, event.shift_id)
+    if data.get("clock_in"):
+        shift.clock_in = _event_time(data["clock_in"])
+    if data.get("clock_out"):
+        _close_from_event(shift, _event_time(data["clock_out"]), data)
+    if "job_site" in data:
+        shift.job_site = data["job_site"]
+    if "flagged" in data:
+        shift.flagged = data["flagged"]
+    return shift
+
+def _apply_recalculate(event, data):
+    shift = db.session.get(Shift, event.shift_id)
+    shift.total_time = data["total_time"]
+    shift.working_time = data["working_time"]
+    shift.breaks = data["breaks"]
+    return shift
+
+def _apply_admin_delete(event, data):
+    shift = db.session.get(Shift, event.shift_id)
+    Break.query.filter(own_breaks(shift.code, shift.clock_in, shift.clock_out)).delete(synchronize_session=False)
+    db.session.delete(shift)
+
+CLOCK_EVENT_HANDLERS = {
+    "clockin": _apply_clockin,
+    "break_start": _apply_break_start,
+    "break_end": _apply_break_end,
+    "clockout": _apply_clockout,
+    "auto_close": _apply_auto_close,
+    "admin_edit": _apply_admin_edit,
+    "admin_delete": _apply_admin_delete,
+    "recalculate": _apply_recalculate,
+}
+
+def apply_clock_event(event):
+    """Update the shift/break projection for one event and return what the handler made"""
+    data = json.loads(event.payload) if event.payload else {}
+    return CLOCK_EVENT_HANDLERS[event.kind](event, data)
+
+def record_clock_event(kind, occurred_at, shift_id=None, break_id=None, code=None, **data):
+    """Append an event and apply it to the projection, in the caller's transaction.
+
+    Returns the handler's result: the new Shift for clockin, the new Break for
+    break_start, (total, working) seconds for clockout.
+    """
+    event = ClockEvent(
+        kind=kind,
+        shift_id=shift_id,
+        break_id=break_id,
+        code=code,
+        occurred_at=occurred_at,
+        recorded_at=datetime.utcnow(),
+        payload=json.dumps(data, default=lambda value: value.isoformat()) if data else None,
+    )
+    tracks_manpower = kind in MANPOWER_EVENT_KINDS
+    if tracks_manpower:
+        worked_before = manpower_interval(db.session.get(Shift, shift_id))
+    result = apply_clock_event(event)
+    if kind == "clockout" or (kind == "admin_edit" and data.get("clock_out")):
+        # A replay restores these rather than recomputing them with whatever
+        # shift_totals() does by then (events logged before this carry none)
+        shift = db.session.get(Shift, event.shift_id)
+        data.update(total_time=shift.total_time, working_time=shift.working_time, breaks=shift.breaks)
+        event.payload = json.dumps(data, default=lambda value: value.isoformat())
+    if tracks_manpower:
+        worked_after = manpower_interval(db.session.get(Shift, shift_id))
+        if worked_after != worked_before:
+            deltas = {}
+            add_manpower_deltas(deltas, worked_before, -1)
+            add_manpower_deltas(deltas, worked_after, 1)
+            apply_manpower_deltas(deltas)
+    if kind in ("clockin", "break_start"):
+        # The log records the id the projection row got, so a replay recreates it
+        db.session.flush()
+        if kind == "clockin":
+            event.shift_id = result.id
+        else:
+            event.break_id = result.id
+    db.session.add(event)
+    return result
+
+CLOCK_BACKFILL_CHUNK = 5000
+
+def _logged_projection_ids():
+    """Selects of the shift ids and break ids that have a creating clock event"""
+    events = ClockEvent.__table__
+    return (
+        db.select(events.c.shift_id).where(events.c.kind == "clockin", events.c.shift_id.isnot(None)),
+        db.select(events.c.break_id).where(events.c.kind == "break_start", events.c.break_id.isnot(None)),
+    )
+
+def unlogged_projection_counts():
+    """(shifts, breaks) with no creating clock event, i.e. not yet backfilled"""
+    logged_shifts, logged_breaks = _logged_projection_ids()
+    return (
+        db.session.query(func.count(Shift.id)).filter(Shift.id.notin_(logged_shifts)).scalar(),
+        db.session.query(func.count(Break.id)).filter(Break.id.notin_(logged_breaks)).scalar(),
+    )
+
+def backfill_clock_events():
+    """Log shifts and breaks that predate the event log; returns (shifts, breaks) added.
+
+    Each old shift becomes one clockin event carrying its current state, so replay
+    reproduces it exactly. Run before taking punches on a newly migrated database
+    (and after a bulk import). Works through the tables CLOCK_BACKFILL_CHUNK rows
+    at a time with Core inserts, committing each chunk.
+    """
+    shift, brk, events = Shift.__table__, Break.__table__, ClockEvent.__table__
+    logged_shifts, logged_breaks = _logged_projection_ids()
+    now = datetime.utcnow()
+    shift_count = break_count = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(shift).where(shift.c.id > last_id, shift.c.id.notin_(logged_shifts))
+            .order_by(shift.c.id).limit(CLOCK_BACKFILL_CHUNK)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(events.insert(), [
+            {
+                "kind": "clockin", "shift_id": row.id, "break_id": None, "code": row.code,
+                "occurred_at": row.clock_in, "recorded_at": row.created_at or now,
+                "payload": json.dumps({
+                    "name": row.name, "subcontractor": row.subcontractor, "job_site": row.job_site,
+                    "qr_batch_id": row.qr_batch_id,
+                    "clock_out": row.clock_out.isoformat() if row.clock_out else None,
+                    "total_time": row.total_time, "working_time": row.working_time,
+                    "breaks": row.breaks, "flagged": bool(row.flagged),
+                }),
+            }
+            for row in rows
+        ])
+        db.session.commit()
+        shift_count += len(rows)
+        last_id = rows[-1].id
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(brk).where(brk.c.id > last_id, brk.c.id.notin_(logged_breaks))
+            .order_by(brk.c.id).limit(CLOCK_BACKFILL_CHUNK)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(events.insert(), [
+            {
+                "kind": "break_start", "shift_id": None, "break_id": row.id, "code": row.shift_code,
+                "occurred_at": row.start, "recorded_at": now,
+                "payload": json.dumps({"end": row.end.isoformat()}) if row.end else None,
+            }
+            for row in rows
+        ])
+        db.session.commit()
+        break_count += len(rows)
+        last_id = rows[-1].id
+    return shift_count, break_count
+
+def _projection_snapshot():
+    shifts = {
+        row.id: (row.name, row.subcontractor, row.job_site, row.clock_in, row.clock_out, row.total_time,
+                 row.working_time, row.breaks, row.code, row.qr_batch_id, bool(row.flagged))
+        for row in Shift.query
+    }
+    breaks = {row.id: (row.shift_code, row.start, row.end) for row in Break.query}
+    return shifts, breaks
+
+def rebuild_clock_projections(dry_run=False, force=False):
+    """Replay the whole log into fresh shift and break tables.
+
+    Returns (events replayed, events skipped, shifts that differ, breaks that differ).
+    Events are replayed in the order they happened, so punches logged before an
+    old row was backfilled still follow its clockin. Raises ClockReplayError when
+    rows have not been backfilled (they would be lost) or, unless force, when any
+    event could not be replayed. dry_run compares and rolls back.
+    """
+    unlogged_shifts, unlogged_breaks = unlogged_projection_counts()
+    if unlogged_shifts or unlogged_breaks:
+        raise ClockReplayError(
+            f"{unlogged_shifts} shifts and {unlogged_breaks} breaks have no clock events; "
+            f"run `flask backfill-clock-events` first"
+        )
+    before_shifts, before_breaks = _projection_snapshot()
+    Break.query.delete(synchronize_session=False)
+    Shift.query.delete(synchronize_session=False)
+    db.session.expunge_all()
+    replayed = skipped = 0
+    last = None
+    while True:
+        query = ClockEvent.query
+        if last is not None:
+            query = query.filter(db.or_(
+                ClockEvent.occurred_at > last.occurred_at,
+                db.and_(ClockEvent.occurred_at == last.occurred_at, ClockEvent.id > last.id),
+            ))
+        chunk = query.order_by(ClockEvent.occurred_at, ClockEvent.id).limit(CLOCK_EVENT_REPLAY_CHUNK).all()
+        if not chunk:
+            break
+        for event in chunk:
+            try:
+                apply_clock_event(event)
+                replayed += 1
+            except (AttributeError, KeyError) as e:
+                print(f"Skipping clock event {event.id} ({event.kind}): {e}")
+                skipped += 1
+        last = types.SimpleNamespace(occurred_at=chunk[-1].occurred_at, id=chunk[-1].id)
+        db.session.flush()
+        db.session.expunge_all()
+    after_shifts, after_breaks = _projection_snapshot()
+    shift_diff = sum(1 for key in before_shifts.keys() | after_shifts.keys() if before_shifts.get(key) != after_shifts.get(key))
+    break_diff = sum(1 for key in before_breaks.keys() | after_breaks.keys() if before_breaks.get(key) != after_breaks.get(key))
+    if dry_run:
+        db.session.rollback()
+        return replayed, skipped, shift_diff, break_diff
+    if skipped and not force:
+        db.session.rollback()
+        raise ClockReplayError(
+            f"{skipped} of {replayed + skipped} events could not be replayed "
+            f"({shift_diff} shifts and {break_diff} breaks would change); nothing was changed"
+        )
+    if db.engine.dialect.name == "postgresql":
+        # Replayed rows carry explicit ids; move the sequences past them
+        for table in ("shift", "break"):
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM \"{table}\"), 0) + 1, false)"
+            ))
+    db.session.commit()
+    reconcile_occupancy()
+    rebuild_manpower_hours()
+    return replayed, skipped, shift_diff, break_diff
+
+@app.route('/add_clock_event_table')
+def add_clock_event_table():
+    try:
+        db.create_all()
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_clock_event_occurred_at ON clock_event (occurred_at, id);"))
+        db.session.commit()
+        shifts, breaks = backfill_clock_events()
+        return f"clock_event table ready; backfilled {shifts} shifts and {breaks} breaks"
+    except Exception as e:
+        db.session.rollback()
+        return f"Error: {e}"
+
+@app.route("/admin/shift/<int:shift_id>/events")
+def admin_shift_events(shift_id):
+    """Full event history of one shift and its breaks, for resolving disputes"""
+    if not session.get("admin_authenticated"):
+        return {"error": "Not authorized"}, 403
+    events = ClockEvent.query.filter_by(shift_id=shift_id).order_by(ClockEvent.id).all()
+    codes = {event.code for event in events if event.code}
+    break_ids = [event.break_id for event in events if event.break_id]
+    if codes:
+        # Backfilled breaks are not tied to a shift id, only to the worker's code
+        events += ClockEvent.query.filter(
+            ClockEvent.kind == "break_start", ClockEvent.shift_id.is_(None), ClockEvent.code.in_(codes),
+            ClockEvent.break_id.notin_(break_ids) if break_ids else db.true(),
+        ).all()
+    return {
+        "shift_id": shift_id,
+        "events": [
+            {
+                "id": event.id,
+                "kind": event.kind,
+                "break_id": event.break_id,
+                "code": event.code,
+                "occurred_at": event.occurred_at.isoformat(),
+                "recorded_at": event.recorded_at.isoformat(),
+                "data": json.loads(event.payload) if event.payload else {},
+            }
+            for event in sorted(events, key=lambda event: event.id)
+        ],
+    }
+
+@app.cli.command("backfill-clock-events")
+def backfill_clock_events_command():
+    """Log existing shifts and breaks that have no clock events yet."""
+    db.create_all()
+    shifts, breaks = backfill_clock_events()
+    click.echo(f"Backfilled {shifts} shifts and {breaks} breaks")
+
+@app.cli.command("rebuild-shifts")
+@click.option("--dry-run", is_flag=True, help="Replay and report differences without changing anything.")
+@click.option("--force", is_flag=True, help="Rebuild even if some events cannot be replayed.")
+def rebuild_shifts_command(dry_run, force):
+    """Rebuild the shift and break tables by replaying the clock event log."""
+    try:
+        replayed, skipped, shift_diff, break_diff = rebuild_clock_projections(dry_run=dry_run, force=force)
+    except ClockReplayError as e:
+        raise click.ClickException(str(e))
+    verb = "would change" if dry_run else "changed"
+    click.echo(f"Replayed {replayed} events ({skipped} skipped); {verb} {shift_diff} shifts and {break_diff} breaks")
+
+# ---------------------------------------------------------------------------
+# Shift anomaly detection
+# ---------------------------------------------------------------------------
+
+# `flask detect-anomalies --every 300` keeps the flags current. Each run only
+# rechecks shifts touched by clock events since the last run (plus the shifts
+# they could conflict with), so the cost follows new punches, not history size.
+ANOMALY_SHORT_SHIFT_MINUTES = int(os.environ.get("ANOMALY_SHORT_SHIFT_MINUTES", 5))
+ANOMALY_SITE_GAP_MINUTES = int(os.environ.get("ANOMALY_SITE_GAP_MINUTES", 15))
+ANOMALY_BUDDY_WINDOW_SECONDS = int(os.environ.get("ANOMALY_BUDDY_WINDOW_SECONDS", 10))
+ANOMALY_BUDDY_MIN_PUNCHES = int(os.environ.get("ANOMALY_BUDDY_MIN_PUNCHES", 4))
+# Events younger than this are rechecked on the next run too, in case a
+# concurrent transaction commits a lower event id after this run has started
+ANOMALY_SETTLE_SECONDS = 60
+ANOMALY_WATERMARK = "shift_anomalies"
+
+def _anomaly_checks(s, dialect_name, now):
+    """(kind, select of shift id and detail) for every check, over shifts aliased as s"""
+    o = Shift.__table__.alias("o")
+    b = Break.__table__
+    s_end = func.coalesce(s.c.clock_out, now)
+    o_end = func.coalesce(o.c.clock_out, now)
+    same_worker = db.and_(o.c.code == s.c.code, o.c.id != s.c.id)
+    overlaps = db.and_(o.c.clock_in < s_end, s.c.clock_in < o_end)
+    site_gap = ANOMALY_SITE_GAP_MINUTES * 60
+    near = db.and_(
+        sql_seconds_between(o_end, s.c.clock_in, dialect_name) < site_gap,
+        sql_seconds_between(s_end, o.c.clock_in, dialect_name) < site_gap,
+    )
+    e = ClockEvent.__table__
+    shift_seconds = sql_seconds_between(s.c.clock_in, s_end, dialect_name)
+    punch_gap = sql_seconds_between(s.c.clock_in, o.c.clock_in, dialect_name)
+
+    def count_text(column):
+        return db.cast(func.count(column), db.String)
+
+    return [
+        ("overlap", db.select(
+            s.c.id,
+            db.literal("overlaps ", db.String) + count_text(o.c.id) + " other shift(s) at this site, e.g. #"
+            + db.cast(func.min(o.c.id), db.String),
+        ).select_from(s.join(o, db.and_(same_worker, o.c.job_site == s.c.job_site, overlaps))).group_by(s.c.id)),
+        ("two_sites", db.select(
+            s.c.id,
+            db.literal("same code punched at ", db.String) + func.min(o.c.job_site)
+            + f" within {ANOMALY_SITE_GAP_MINUTES} min",
+        ).select_from(s.join(o, db.and_(same_worker, o.c.job_site != s.c.job_site, near))).group_by(s.c.id)),
+        ("short_shift", db.select(
+            s.c.id,
+            db.literal(f"shorter than {ANOMALY_SHORT_SHIFT_MINUTES} min", db.String),
+        ).where(s.c.clock_out.isnot(None), shift_seconds < ANOMALY_SHORT_SHIFT_MINUTES * 60)),
+        ("buddy_punch", db.select(
+            s.c.id,
+            db.cast(func.count(o.c.id) + 1, db.String)
+            + f" clock-ins from one QR batch within {ANOMALY_BUDDY_WINDOW_SECONDS}s",
+        ).select_from(s.join(o, db.and_(
+            o.c.qr_batch_id == s.c.qr_batch_id,
+            o.c.id != s.c.id,
+            punch_gap.between(-ANOMALY_BUDDY_WINDOW_SECONDS, ANOMALY_BUDDY_WINDOW_SECONDS),
+        ))).where(s.c.qr_batch_id.isnot(None)).group_by(s.c.id).having(
+            func.count(o.c.id) >= ANOMALY_BUDDY_MIN_PUNCHES - 1
+        )),
+        ("offline_punch", db.select(
+            s.c.id,
+            db.literal("clock-in/out queued on a phone; time reported by the phone", db.String),
+        ).select_from(s.join(e, db.and_(
+            e.c.shift_id == s.c.id, e.c.kind.in_(("clockin", "clockout")), e.c.payload.like('%"offline": true%'),
+        ))).group_by(s.c.id)),
+        ("long_break", db.select(
+            s.c.id,
+            db.literal("breaks add up to more than the shift", db.String),
+        ).select_from(s.join(b, db.and_(
+            b.c.shift_code == s.c.code, b.c.start >= s.c.clock_in, b.c.start < s_end, b.c.end.isnot(None),
+        ))).group_by(s.c.id, s.c.clock_in, s.c.clock_out).having(
+            func.sum(sql_seconds_between(b.c.start, b.c.end, dialect_name)) > shift_seconds
+        )),
+    ]
+
+def detect_anomalies(since=None, until=None):
+    """Recheck shifts and rewrite their ShiftAnomaly rows; returns (shifts checked, anomalies found).
+
+    With since/until (dates) every shift clocked in within the range is rechecked.
+    Otherwise only shifts affected by clock events since the last incremental run.
+    """
+    dialect_name = db.engine.dialect.name
+    s = Shift.__table__.alias("s")
+    watermark = None
+    if since or until:
+        in_range = []
+        if since:
+            in_range.append(s.c.clock_in >= datetime.combine(since, datetime.min.time()))
+        if until:
+            in_range.append(s.c.clock_in < datetime.combine(until + timedelta(days=1), datetime.min.time()))
+        scope = db.and_(*in_range)
+        gone = db.select(ClockEvent.shift_id).where(db.false())
+    else:
+        watermark = db.session.get(JobWatermark, ANOMALY_WATERMARK) or JobWatermark(name=ANOMALY_WATERMARK, position=0)
+        new_events = ClockEvent.id > watermark.position
+        settled = db.session.query(func.max(ClockEvent.id)).filter(
+            new_events, ClockEvent.recorded_at < datetime.utcnow() - timedelta(seconds=ANOMALY_SETTLE_SECONDS)
+        ).scalar()
+        touched_codes = db.select(ClockEvent.code).where(new_events, ClockEvent.code.isnot(None))
+        gone = db.select(ClockEvent.shift_id).where(new_events, ClockEvent.shift_id.isnot(None))
+        touched_batches = db.select(Shift.qr_batch_id).where(Shift.id.in_(gone), Shift.qr_batch_id.isnot(None))
+        # Conflicts are always between shifts sharing a code or a QR batch
+        scope = db.or_(s.c.code.in_(touched_codes), s.c.qr_batch_id.in_(touched_batches))
+
+    scoped_ids = [shift_id for shift_id, in db.session.execute(db.select(s.c.id).where(scope))]
+    table = ShiftAnomaly.__table__
+    db.session.execute(table.delete().where(db.or_(
+        table.c.shift_id.in_(db.select(s.c.id).where(scope)), table.c.shift_id.in_(gone)
+    )))
+    found = 0
+    detected_at = datetime.utcnow()
+    for kind, check in _anomaly_checks(s, dialect_name, datetime.now()):
+        rows = check.where(scope).subquery()
+        result = db.session.execute(table.insert().from_select(
+            ["shift_id", "kind", "detail", "detected_at"],
+            db.select(rows.c[0], db.literal(kind), rows.c[1], db.literal(detected_at)),
+        ))
+        found += max(result.rowcount, 0)
+    if watermark is not None and settled:
+        watermark.position = settled
+        watermark.updated_at = detected_at
+        db.session.add(watermark)
+    db.session.commit()
+    return len(scoped_ids), found
+
+def anomaly_reasons():
+    """Anomaly details joined per shift id, for the admin table"""
+    reasons = {}
+    for shift_id, detail in reporting_session().query(ShiftAnomaly.shift_id, ShiftAnomaly.detail).order_by(ShiftAnomaly.id):
+        reasons[shift_id] = f"{reasons[shift_id]}; {detail}" if shift_id in reasons else detail
+    return reasons
+
+@app.cli.command("detect-anomalies")
+@click.option("--since", help="First clock-in date to recheck (YYYY-MM-DD); rechecks the whole range.")
+@click.option("--until", help="Last clock-in date to recheck (YYYY-MM-DD).")
+@click.option("--every", type=float, help="Keep running incrementally every N seconds.")
+def detect_anomalies_command(since, until, every):
+    """Flag overlapping, short, two-site, buddy-punched, over-break and offline-punched shifts."""
+    db.create_all()
+    since, until = parse_report_date(since), parse_report_date(until)
+    while True:
+        started = time.perf_counter()
+        checked, found = detect_anomalies(since, until)
+        click.echo(f"Checked {checked} shifts, {found} anomalies in {time.perf_counter() - started:.2f}s")
+        db.session.remove()
+        if not every or since or until:
+            break
+        time.sleep(every)
+
+# ---------------------------------------------------------------------------
+# Bulk recalculation of derived shift fields
+# ---------------------------------------------------------------------------
+
+RECALCULATE_CHUNK = 2000
+RECALCULATE_SAMPLE = 20
+
+def recalculate_shifts(shift_ids=None, since=None, until=None, job_site=None, subcontractor=None, dry_run=False,
+                       sample_size=RECALCULATE_SAMPLE):
+    """Recompute total time, working time and the break summary of closed shifts.
+
+    Shifts are processed in id order, RECALCULATE_CHUNK at a time: one query for
+    the shifts, one joining them to their breaks, then one executemany UPDATE and one
+    executemany insert of "recalculate" clock events for the rows that changed,
+    committed per chunk. A shift whose working time or breaks changed has its
+    timecard queued for Procore again in the same transaction. Returns (shifts
+    checked, shifts changed, sample) where sample holds the first sample_size
+    changes as (shift id, {field: (old, new)}). dry_run computes the same diff
+    without writing.
+    """
+    shift = Shift.__table__
+    conditions = [shift.c.clock_out.isnot(None)]
+    if shift_ids:
+        conditions.append(shift.c.id.in_(shift_ids))
+    if since:
+        conditions.append(shift.c.clock_in >= datetime.combine(since, datetime.min.time()))
+    if until:
+        conditions.append(shift.c.clock_in < datetime.combine(until + timedelta(days=1), datetime.min.time()))
+    if job_site:
+        conditions.append(shift.c.job_site == job_site)
+    if subcontractor:
+        conditions.append(shift.c.subcontractor == subcontractor)
+
+    update_shift = shift.update().where(shift.c.id == db.bindparam("b_id")).values(
+        total_time=db.bindparam("b_total_time"),
+        working_time=db.bindparam("b_working_time"),
+        breaks=db.bindparam("b_breaks"),
+    )
+    checked = changed = 0
+    sample = []
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(shift.c.id, shift.c.code, shift.c.name, shift.c.subcontractor, shift.c.job_site,
+                      shift.c.clock_in, shift.c.clock_out, shift.c.total_time, shift.c.working_time,
+                      shift.c.breaks, shift.c.flagged)
+            .where(*conditions, shift.c.id > last_id)
+            .order_by(shift.c.id)
+            .limit(RECALCULATE_CHUNK)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        checked += len(rows)
+
+        breaks_by_shift = {}
+        for shift_id, start, end in db.session.execute(
+            db.select(shift.c.id, Break.start, Break.end)
+            .select_from(shift.join(Break.__table__, own_breaks(shift.c.code, shift.c.clock_in, shift.c.clock_out)))
+            .where(*conditions, shift.c.id.between(rows[0].id, last_id))
+        ):
+            breaks_by_shift.setdefault(shift_id, []).append((start, end))
+
+        updates = []
+        for row in rows:
+            total, working, breaks_str = shift_totals(row.clock_in, row.clock_out, breaks_by_shift.get(row.id, ()))
+            if row.breaks == "AUTO-CLOSED":
+                # Keep the sweeper's marker; the times still get corrected
+                breaks_str = row.breaks
+            values = {"total_time": format_seconds(total), "working_time": format_seconds(working), "breaks": breaks_str}
+            diff = {
+                field: (getattr(row, field), value)
+                for field, value in values.items()
+                if (getattr(row, field) or "") != value
+            }
+            if diff:
+                changed += 1
+                if len(sample) < sample_size:
+                    sample.append((row.id, diff))
+                updates.append((row, values, "working_time" in diff or "breaks" in diff))
+
+        if updates and not dry_run:
+            db.session.execute(update_shift, [
+                {"b_id": row.id, "b_total_time": values["total_time"], "b_working_time": values["working_time"],
+                 "b_breaks": values["breaks"]}
+                for row, values, _ in updates
+            ])
+            now, recorded_at = datetime.now(), datetime.utcnow()
+            db.session.execute(ClockEvent.__table__.insert(), [
+                {"kind": "recalculate", "shift_id": row.id, "code": row.code, "occurred_at": now,
+                 "recorded_at": recorded_at, "payload": json.dumps(values)}
+                for row, values, _ in updates
+            ])
+            for row, values, timecard_changed in updates:
+                # total_time alone is not on the timecard
+                if timecard_changed:
+                    sync_to_procore(types.SimpleNamespace(**{**row._mapping, **values}))
+            db.session.commit()
+    db.session.rollback()
+    return checked, changed, sample
+
+@app.route("/admin/shifts/recalculate", methods=["POST"])
+def admin_recalculate_shifts():
+    """Recalculate the selected shifts; a dry run (the default) only reports the diff"""
+    if not session.get("admin_authenticated"):
+        return {"error": "Not authorized"}, 403
+    try:
+        shift_ids = [int(value) for value in request.form.get("ids", "").split(",") if value.strip()]
+        since = parse_report_date(request.form.get("since"))
+        until = parse_report_date(request.form.get("until"))
+    except ValueError:
+        return {"error": "ids must be numbers and dates YYYY-MM-DD"}, 400
+    dry_run = request.form.get("dry_run", "1") != "0"
+    checked, changed, sample = recalculate_shifts(
+        shift_ids=shift_ids or None,
+        since=since,
+        until=until,
+        job_site=request.form.get("job_site") or None,
+        subcontractor=request.form.get("subcontractor") or None,
+        dry_run=dry_run,
+    )
+    return {
+        "dry_run": dry_run,
+        "checked": checked,
+        "changed": changed,
+        "sample": [{"id": shift_id, "changes": diff} for shift_id, diff in sample],
+    }
+
+@app.cli.command("recalculate-shifts")
+@click.option("--ids", help="Comma-separated shift ids.")
+@click.option("--since", help="First clock-in date (YYYY-MM-DD).")
+@click.option("--until", help="Last clock-in date (YYYY-MM-DD).")
+@click.option("--site", "job_site", help="Only this job site.")
+@click.option("--subcontractor", help="Only this subcontractor.")
+@click.option("--dry-run", is_flag=True, help="Show what would change without writing.")
+@click.option("--show", default=RECALCULATE_SAMPLE, show_default=True, help="How many changed shifts to print.")
+def recalculate_shifts_command(ids, since, until, job_site, subcontractor, dry_run, show):
+    """Recompute total/working time and break summaries from the break records."""
+    shift_ids = [int(value) for value in ids.split(",")] if ids else None
+    started = time.perf_counter()
+    checked, changed, sample = recalculate_shifts(
+        shift_ids, parse_report_date(since), parse_report_date(until), job_site, subcontractor, dry_run, show
+    )
+    for shift_id, diff in sample:
+        click.echo(f"#{shift_id}: " + ", ".join(f"{field} {old!r} -> {new!r}" for field, (old, new) in diff.items()))
+    verb = "would change" if dry_run else "changed"
+    click.echo(f"Checked {checked} shifts, {verb} {changed} in {time.perf_counter() - started:.2f}s")
+
+# ---------------------------------------------------------------------------
+# Bulk admin operations on shifts
+# ---------------------------------------------------------------------------
+
+BULK_SHIFT_ACTIONS = ("delete", "close", "flag", "unflag", "reassign")
+
+def bulk_shift_action(action, shift_ids, job_site=None):
+    """Apply one admin action to many shifts in a single transaction.
+
+    Every statement is set-based or executemany: the shift and break changes, one
+    clock event and one dashboard event per shift, the occupancy counters and the
+    manpower heatmap. Closed shifts have their timecards queued for Procore.
+    Only breaks taken during the selected shifts are touched. Returns a summary
+    dict of affected rows; raises ValueError for a bad action or job site.
+    """
+    if action not in BULK_SHIFT_ACTIONS:
+        raise ValueError(f"Unknown bulk action: {action}")
+    if action == "reassign" and job_site not in JOB_SITES:
+        raise ValueError("Please select a job site to reassign to.")
+    shift = Shift.__table__
+    rows = db.session.execute(db.select(shift).where(shift.c.id.in_(shift_ids))).all()
+    summary = {"action": action, "requested": len(set(shift_ids)), "shifts": 0, "breaks": 0}
+    if action == "close":
+        rows = [row for row in rows if row.clock_out is None]
+    elif action == "reassign":
+        rows = [row for row in rows if row.job_site != job_site]
+    if not rows:
+        return summary
+    ids = [row.id for row in rows]
+    now, recorded_at = datetime.now(), datetime.utcnow()
+    events = []
+    dashboard = []
+    occupancy = {}
+    manpower = {}
+
+    def edited(row, **changes):
+        return types.SimpleNamespace(**{**row._mapping, **changes})
+
+    if action == "delete":
+        selected = shift.alias("selected")
+        summary["breaks"] = db.session.execute(Break.__table__.delete().where(
+            db.select(selected.c.id).where(
+                selected.c.id.in_(ids), own_breaks(selected.c.code, selected.c.clock_in, selected.c.clock_out)
+            ).exists()
+        )).rowcount
+        summary["shifts"] = db.session.execute(shift.delete().where(shift.c.id.in_(ids))).rowcount
+        for row in rows:
+            events.append({"kind": "admin_delete", "shift_id": row.id, "code": row.code, "payload": None})
+            add_manpower_deltas(manpower, manpower_interval(row), -1)
+            if row.clock_out is None:
+                occupancy[(row.job_site, row.subcontractor)] = occupancy.get((row.job_site, row.subcontractor), 0) - 1
+                dashboard.append(("delete", row, -1, 0, 0.0))
+            else:
+                dashboard.append(("delete", row, 0, -1, -parse_duration_hours(row.working_time)))
+
+    elif action == "close":
+        breaks_by_shift = {}
+        for shift_id, start, end in db.session.execute(
+            db.select(shift.c.id, Break.start, Break.end)
+            .select_from(shift.join(Break.__table__, own_breaks(shift.c.code, shift.c.clock_in, now)))
+            .where(shift.c.id.in_(ids))
+        ):
+            breaks_by_shift.setdefault(shift_id, []).append((start, end))
+        updates = []
+        for row in rows:
+            total, working, breaks_str = shift_totals(row.clock_in, now, breaks_by_shift.get(row.id, ()))
+            values = {"clock_out": now, "total_time": format_seconds(total), "working_time": format_seconds(working), "breaks": breaks_str}
+            updates.append({"b_id": row.id, **{f"b_{key}": value for key, value in values.items()}})
+            events.append({"kind": "admin_edit", "shift_id": row.id, "code": row.code,
+                           "payload": json.dumps(dict(values, clock_out=now.isoformat()))})
+            occupancy[(row.job_site, row.subcontractor)] = occupancy.get((row.job_site, row.subcontractor), 0) - 1
+            closed = edited(row, **values)
+            add_manpower_deltas(manpower, manpower_interval(closed), 1)
+            dashboard.append(("edit", closed, -1, 1, working / 3600))
+            sync_to_procore(closed)
+        db.session.execute(shift.update().where(shift.c.id == db.bindparam("b_id")).values(
+            clock_out=db.bindparam("b_clock_out"),
+            total_time=db.bindparam("b_total_time"),
+            working_time=db.bindparam("b_working_time"),
+            breaks=db.bindparam("b_breaks"),
+        ), updates)
+        summary["shifts"] = len(updates)
+
+    else:
+        changes = {"flagged": action == "flag"} if action in ("flag", "unflag") else {"job_site": job_site}
+        summary["shifts"] = db.session.execute(shift.update().where(shift.c.id.in_(ids)).values(**changes)).rowcount
+        for row in rows:
+            events.append({"kind": "admin_edit", "shift_id": row.id, "code": row.code, "payload": json.dumps(changes)})
+            if action == "reassign" and row.clock_out is None:
+                occupancy[(row.job_site, row.subcontractor)] = occupancy.get((row.job_site, row.subcontractor), 0) - 1
+                occupancy[(job_site, row.subcontractor)] = occupancy.get((job_site, row.subcontractor), 0) + 1
+            if action == "reassign":
+                add_manpower_deltas(manpower, manpower_interval(row), -1)
+                add_manpower_deltas(manpower, manpower_interval(edited(row, **changes)), 1)
+            dashboard.append(("edit", edited(row, **changes), 0, 0, 0.0))
+
+    db.session.execute(ClockEvent.__table__.insert(), [
+        {"occurred_at": now, "recorded_at": recorded_at, "break_id": None, **event} for event in events
+    ])
+    db.session.execute(DashboardEvent.__table__.insert(), [
+        {"kind": kind, "payload": dashboard_event_payload(row, on_site, days, hours), "created_at": recorded_at}
+        for kind, row, on_site, days, hours in dashboard
+    ])
+    for (site, subcontractor), delta in occupancy.items():
+        if delta:
+            adjust_occupancy(site, subcontractor, delta)
+    apply_manpower_deltas(manpower)
+    db.session.commit()
+    return summary
+
+def bulk_summary_message(summary):
+    action, count = summary["action"], summary["shifts"]
+    skipped = summary["requested"] - count
+    if action == "delete":
+        message = f"Deleted {count} shift(s) and {summary['breaks']} of their break(s)."
+    elif action == "close":
+        message = f"Closed {count} open shift(s)."
+    elif action == "reassign":
+        message = f"Moved {count} shift(s) to another job site."
+    else:
+        message = f"{'Flagged' if action == 'flag' else 'Unflagged'} {count} shift(s)."
+    if skipped:
+        message += f" {skipped} selected shift(s) were skipped (already closed, already there or gone)."
+    return message
+
+@app.route("/admin/shifts/bulk", methods=["POST"])
+def admin_bulk_shifts():
+    if not session.get("admin_authenticated"):
+        return redirect(url_for("admin_view"))
+    action = request.form.get("action", "")
+    shift_ids = request.form.getlist("shift_ids", type=int)
+    summary = None
+    try:
+        if not shift_ids:
+            raise ValueError("Select at least one shift.")
+        summary = bulk_shift_action(action, shift_ids, request.form.get("target_job_site") or None)
+        message, category = bulk_summary_message(summary), "success"
+    except ValueError as e:
+        message, category = str(e), "error"
+    except Exception as e:
+        print(f"Error in bulk {action}: {e}")
+        db.session.rollback()
+        message, category = "Database error. Nothing was changed.", "error"
+    if request.accept_mimetypes.best == "application/json":
+        return ({**summary, "message": message}, 200) if summary else ({"error": message}, 400)
+    flash(message, category)
+    return redirect(url_for(
+        "admin_view",
+        subcontractor=request.form.get("subcontractor") or None,
+        job_site=request.form.get("job_site") or None,
+    ))
+
+# ---------------------------------------------------------------------------
+# Lightweight shift listings
+# ---------------------------------------------------------------------------
+
+# Listings and exports read shifts with a Core select of the columns they show
+# and wrap each row in a ShiftRecord: no identity map, no attribute
+# instrumentation, nothing bound to a session once the rows are read.
+SHIFT_RECORD_FIELDS = (
+    "id", "name", "subcontractor", "job_site", "clock_in", "clock_out", "total_time",
+    "working_time", "breaks", "code", "created_at", "qr_batch_id", "flagged",
+)
+SHIFT_RECORD_BATCH = 1000
+SHIFT_EXPORT_HEADER = [
+    "ID", "Name", "Subcontractor", "Job Site", "Clock In", "Clock Out", "Total Time",
+    "Working Time", "Breaks", "Code", "QR Batch", "Flagged", "Flag Reasons",
+]
+
+class ShiftRecord:
+    """A read-only shift as listings show it"""
+    __slots__ = SHIFT_RECORD_FIELDS + ("flag_reasons",)
+
+    def __init__(self, row, flag_reasons=None):
+        (self.id, self.name, self.subcontractor, self.job_site, self.clock_in, self.clock_out, self.total_time,
+         self.working_time, self.breaks, self.code, self.created_at, self.qr_batch_id, self.flagged) = row
+        self.flag_reasons = flag_reasons
+
+def shift_records(read_session=None, subcontractor=None, job_site=None, flag_reasons=None):
+    """Yield ShiftRecords newest first, fetched SHIFT_RECORD_BATCH rows at a time"""
+    table = Shift.__table__
+    stmt = db.select(*(table.c[name] for name in SHIFT_RECORD_FIELDS))
+    if subcontractor:
+        stmt = stmt.where(table.c.subcontractor == subcontractor)
+    if job_site:
+        stmt = stmt.where(table.c.job_site == job_site)
+    stmt = stmt.order_by(table.c.created_at.desc()).execution_options(stream_results=True)
+    reasons = flag_reasons or {}
+    for row in (read_session or db.session).execute(stmt).yield_per(SHIFT_RECORD_BATCH):
+        yield ShiftRecord(row, reasons.get(row[0]))
+
+@app.route("/admin/export/shifts")
+def admin_export_shifts():
+    """Every shift (honouring the admin filters) as CSV, streamed"""
+    if not session.get("admin_authenticated"):
+        return redirect(url_for("admin_view"))
+    subcontractor_filter = request.args.get('subcontractor', '')
+    job_site_filter = request.args.get('job_site', '')
+    read_session = reporting_session()
+    version = get_data_version(read_session=read_session)
+    etag = response_etag(version, "export_shifts", subcontractor_filter, job_site_filter)
+    last_modified = response_last_modified(version)
+    if request_is_fresh(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    flag_reasons = anomaly_reasons()
+    records = shift_records(read_session, subcontractor_filter or None, job_site_filter or None, flag_reasons)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(SHIFT_EXPORT_HEADER)
+        for count, s in enumerate(records, 1):
+            writer.writerow([
+                s.id, s.name, s.subcontractor, s.job_site, format_time_for_display(s.clock_in, s.job_site),
+                format_time_for_display(s.clock_out, s.job_site), s.total_time, s.working_time, s.breaks,
+                s.code, s.qr_batch_id, "yes" if s.flagged else "", s.flag_reasons,
+            ])
+            if count % SHIFT_RECORD_BATCH == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv',
+                        headers={"Content-Disposition": "attachment;filename=shifts.csv"})
+    return add_cache_validators(response, etag, last_modified)
+
+@app.cli.command("benchmark-shift-listing")
+@click.option("--repeat", default=3, show_default=True, help="Runs per read path; the best time is reported.")
+def benchmark_shift_listing_command(repeat):
+    """Compare the old ORM listing with ShiftRecords: time and peak memory."""
+    import gc
+    import tracemalloc
+
+    def orm_dicts():
+        # The admin listing before ShiftRecord: ORM objects copied into dicts
+        return [
+            {name: getattr(s, name) for name in SHIFT_RECORD_FIELDS}
+            for s in Shift.query.order_by(Shift.created_at.desc()).all()
+        ]
+
+    def records():
+        return list(shift_records())
+
+    for label, read in (("ORM objects + dicts", orm_dicts), ("Core + ShiftRecord", records)):
+        best = None
+        for _ in range(repeat):
+            db.session.remove()
+            gc.collect()
+            started = time.perf_counter()
+            rows = read()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        db.session.remove()
+        gc.collect()
+        tracemalloc.start()
+        rows = read()
+        _, peak = tracemalloc.get_traced_memory()
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        click.echo(f"{label:>20}: {len(rows)} shifts in {best * 1000:.0f}ms, "
+                   f"peak {peak / 2**20:.1f} MiB, held {retained / 2**20:.1f} MiB")
+        del rows
+
+# ---------------------------------------------------------------------------
+# Sampling profiler
+# ---------------------------------------------------------------------------
+
+# GET /admin/profile?seconds=10 samples the stacks of every other thread in the
+# worker that serves it and returns them in collapsed format ("a;b;c count"),
+# ready for flamegraph.pl or speedscope. Each stack is rooted at the route its
+# thread was serving. Only useful with threaded workers (gthread or the dev
+# server): a single-threaded worker is busy profiling itself.
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL_MS = 5
+PROFILE_MIN_INTERVAL_MS = 1
+
+_profile_lock = threading.Lock()
+_request_routes = {}
+
+@app.before_request
+def remember_request_route():
+    rule = request.url_rule
+    _request_routes[threading.get_ident()] = f"{request.method} {rule.rule if rule else '<no route>'}"
+
+@app.teardown_request
+def forget_request_route(exc):
+    _request_routes.pop(threading.get_ident(), None)
+
+_frame_labels = {}
+
+def _frame_label(code):
+    label = _frame_labels.get(code)
+    if label is None:
+        # Our files relative to the app, libraries as package/module.py (flask/app.py vs app.py);
+        # the function's first line, not the current one, keeps one frame per function
+        filename = code.co_filename
+        if filename.startswith(app.root_path):
+            where = os.path.relpath(filename, app.root_path)
+        else:
+            where = "/".join(filename.replace("\\", "/").split("/")[-2:])
+        label = f"{code.co_name} ({where}:{code.co_firstlineno})".replace(";", ",")
+        _frame_labels[code] = label
+    return label
+
+def sample_stacks(seconds, interval, include_idle=False):
+    """Sample other threads' stacks every interval seconds for seconds.
+
+    Returns (collapsed stack counts, samples taken). Threads not serving a request
+    are left out unless include_idle, in which case they are rooted at their
+    thread name, e.g. [punch-writer].
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    thread_names = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            root = _request_routes.get(ident)
+            if root is None:
+                if not include_idle:
+                    continue
+                if ident not in thread_names:
+                    thread_names.update((t.ident, t.name) for t in threading.enumerate())
+                root = f"[{thread_names.get(ident, ident)}]"
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.append(root)
+            labels.reverse()
+            stacks[";".join(labels)] += 1
+        samples += 1
+        time.sleep(max(min(interval, deadline - time.monotonic()), 0))
+    return stacks, samples
+
+@app.route("/admin/profile")
+def admin_profile():
+    if not session.get("admin_authenticated"):
+        return {"error": "Not authorized"}, 403
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval_ms = float(request.args.get("interval_ms", PROFILE_DEFAULT_INTERVAL_MS))
+        if not (math.isfinite(seconds) and math.isfinite(interval_ms)):
+            raise ValueError
+    except ValueError:
+        return {"error": "seconds and interval_ms must be numbers"}, 400
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    interval_ms = min(max(interval_ms, PROFILE_MIN_INTERVAL_MS), seconds * 1000)
+    if not _profile_lock.acquire(blocking=False):
+        return {"error": "A profile is already running in this worker"}, 409
+    try:
+        started = time.perf_counter()
+        stacks, samples = sample_stacks(seconds, interval_ms / 1000, request.args.get("all") == "1")
+        elapsed = time.perf_counter() - started
+    finally:
+        _profile_lock.release()
+    if request.args.get("format") == "json":
+        routes = Counter()
+        for stack, count in stacks.items():
+            routes[stack.split(";", 1)[0]] += count
+        return {
+            "pid": os.getpid(),
+            "seconds": round(elapsed, 3),
+            "samples": samples,
+            "interval_ms": interval_ms,
+            "routes": dict(routes.most_common()),
+            "stacks": dict(stacks.most_common()),
+        }
+    body = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    return Response(body, mimetype="text/plain", headers={
+        "Content-Disposition": f"attachment;filename=profile-{os.getpid()}-{int(time.time())}.folded",
+        "Cache-Control": "no-store",
+        "X-Profile-Samples": str(samples),
+    })
+
+# ---------------------------------------------------------------------------
+# Manpower heatmap
+# ---------------------------------------------------------------------------
+
+# manpower_hour holds person-seconds per (site, subcontractor, site-local date,
+# hour) for closed shifts. Every clock event that closes, moves or deletes a
+# closed shift subtracts the old interval and adds the new one in the same
+# transaction, so the heatmap only ever reads this small table.
+MANPOWER_EVENT_KINDS = ("clockout", "auto_close", "admin_edit", "admin_delete")
+MANPOWER_REBUILD_CHUNK = 5000
+HEATMAP_DEFAULT_DAYS = 28
+HEATMAP_MAX_DAYS = 366
+
+def manpower_interval(shift):
+    """(site, subcontractor, clock in, clock out) a closed shift counts for, else None"""
+    if shift is None or shift.clock_out is None or shift in db.session.deleted:
+        return None
+    return shift.job_site, shift.subcontractor, shift.clock_in, shift.clock_out
+
+def manpower_hour_buckets(job_site, clock_in, clock_out):
+    """Yield (local date, hour, seconds) for each site-local hour between two UTC times"""
+    tz = pytz.timezone(JOB_SITE_TIMEZONES.get(job_site, "UTC"))
+    cursor = pytz.utc.localize(clock_in)
+    end = pytz.utc.localize(clock_out)
+    local, local_end = cursor.astimezone(tz), end.astimezone(tz)
+    if end - cursor <= timedelta(days=2) and local.utcoffset() == local_end.utcoffset():
+        # No DST change inside the shift: walk the local wall clock directly
+        local, local_end = local.replace(tzinfo=None), local_end.replace(tzinfo=None)
+        while local < local_end:
+            step_end = min(local.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1), local_end)
+            yield local.date(), local.hour, (step_end - local).total_seconds()
+            local = step_end
+        return
+    while cursor < end:
+        local = cursor.astimezone(tz)
+        next_hour = (local.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)).astimezone(pytz.utc)
+        step_end = min(next_hour, end)
+        yield local.date(), local.hour, (step_end - cursor).total_seconds()
+        cursor = step_end
+
+def add_manpower_deltas(deltas, interval, sign):
+    """Accumulate +/- one shift's hours into deltas {(site, sub, date, hour): [seconds, shifts]}"""
+    if interval is None:
+        return
+    job_site, subcontractor, clock_in, clock_out = interval
+    seen = set()
+    for local_date, hour, seconds in manpower_hour_buckets(job_site, clock_in, clock_out):
+        key = (job_site, subcontractor, local_date, hour)
+        cell = deltas.setdefault(key, [0.0, 0])
+        cell[0] += sign * seconds
+        if key not in seen:
+            # The repeated hour when clocks fall back still counts the shift once
+            seen.add(key)
+            cell[1] += sign
+
+def apply_manpower_deltas(deltas):
+    """Add accumulated deltas to the cube in the caller's transaction (one executemany upsert)"""
+    rows = [
+        {"job_site": job_site, "subcontractor": subcontractor, "local_date": local_date, "hour": hour,
+         "person_seconds": seconds, "shifts": shifts}
+        for (job_site, subcontractor, local_date, hour), (seconds, shifts) in deltas.items()
+        if seconds or shifts
+    ]
+    if not rows:
+        return
+    table = ManpowerHour.__table__
+    stmt = _dialect_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.job_site, table.c.subcontractor, table.c.local_date, table.c.hour],
+        set_={
+            "person_seconds": table.c.person_seconds + stmt.excluded.person_seconds,
+            "shifts": table.c.shifts + stmt.excluded.shifts,
+        },
+    )
+    db.session.execute(stmt, rows)
+
+def rebuild_manpower_hours():
+    """Recompute the whole cube from closed shifts in one transaction; returns (shifts, cells)
+
+    Punches add their deltas to the cube in their own transactions, so the cube
+    is locked before the shifts are read: a clock-out that commits first is in
+    the read, and one that commits later waits and adds its delta to the new cube.
+    On SQLite the delete takes the database's write lock, which does the same.
+    """
+    shift = Shift.__table__
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("LOCK TABLE manpower_hour IN EXCLUSIVE MODE"))
+    db.session.execute(ManpowerHour.__table__.delete())
+    deltas = {}
+    count = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(shift.c.id, shift.c.job_site, shift.c.subcontractor, shift.c.clock_in, shift.c.clock_out)
+            .where(shift.c.clock_out.isnot(None), shift.c.id > last_id)
+            .order_by(shift.c.id)
+            .limit(MANPOWER_REBUILD_CHUNK)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            add_manpower_deltas(deltas, tuple(row[1:]), 1)
+        count += len(rows)
+        last_id = rows[-1].id
+    apply_manpower_deltas(deltas)
+    db.session.commit()
+    return count, len(deltas)
+
+def manpower_heatmap(job_site, start, end, subcontractor=None, read_session=None):
+    """{(local date, hour): (average headcount, shifts present)} for one site"""
+    query = (read_session or db.session).query(
+        ManpowerHour.local_date, ManpowerHour.hour,
+        func.sum(ManpowerHour.person_seconds), func.sum(ManpowerHour.shifts),
+    ).filter(
+        ManpowerHour.job_site == job_site, ManpowerHour.local_date >= start, ManpowerHour.local_date <= end,
+    )
+    if subcontractor:
+        query = query.filter(ManpowerHour.subcontractor == subcontractor)
+    return {
+        (local_date, hour): (person_seconds / 3600.0, shifts)
+        for local_date, hour, person_seconds, shifts in query.group_by(ManpowerHour.local_date, ManpowerHour.hour)
+    }
+
+@app.route("/api/heatmap")
+def api_heatmap():
+    """Hour-of-day headcount for one site over a date range (site-local dates)"""
+    if not session.get("admin_authenticated"):
+        return {"error": "Not authorized"}, 403
+    job_site = request.args.get("site", "")
+    subcontractor = request.args.get("subcontractor") or None
+    if job_site not in JOB_SITES:
+        return {"error": "Unknown job site"}, 400
+    try:
+        end = parse_report_date(request.args.get("end"), get_local_time(datetime.utcnow(), job_site).date())
+        start = parse_report_date(request.args.get("start"), end - timedelta(days=HEATMAP_DEFAULT_DAYS - 1))
+    except ValueError:
+        return {"error": "Dates must be YYYY-MM-DD"}, 400
+    if start > end or (end - start).days >= HEATMAP_MAX_DAYS:
+        return {"error": f"Pick a range of 1 to {HEATMAP_MAX_DAYS} days"}, 400
+
+    read_session = reporting_session()
+    version = get_data_version(HEATMAP_DATA_VERSION, read_session=read_session)
+    etag = response_etag(version, "heatmap", job_site, subcontractor, start.isoformat(), end.isoformat())
+    last_modified = response_last_modified(version)
+    if request_is_fresh(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    cells = manpower_heatmap(job_site, start, end, subcontractor, read_session)
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        days.append({
+            "date": day.isoformat(),
+            "headcount": [round(cells.get((day, hour), (0.0, 0))[0], 2) for hour in range(24)],
+            "shifts": [cells.get((day, hour), (0.0, 0))[1] for hour in range(24)],
+        })
+    response = app.make_response({
+        "job_site": job_site,
+        "subcontractor": subcontractor,
+        "timezone": JOB_SITE_TIMEZONES.get(job_site, "UTC"),
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "max_headcount": round(max((value[0] for value in cells.values()), default=0.0), 2),
+        "days": days,
+    })
+    return add_cache_validators(response, etag, last_modified)
+
+@app.route("/admin/heatmap")
+def admin_heatmap():
+    if not session.get("admin_authenticated"):
+        return redirect(url_for("admin_view"))
+    try:
+        subcontractors = filter_options(get_data_version(read_session=reporting_session()))[0]
+    except Exception as e:
+        print(f"Error loading heatmap filters: {e}")
+        subcontractors = []
+    return render_template(
+        "heatmap.html",
+        job_sites=JOB_SITES,
+        subcontractors=sorted(subcontractors),
+        selected_job_site=request.args.get("site") or JOB_SITES[0],
+    )
+
+@app.route('/add_manpower_hour_table')
+def add_manpower_hour_table():
+    try:
+        db.create_all()
+        return "manpower_hour table ready; run `flask rebuild-heatmap` to fill it"
+    except Exception as e:
+        return f"Error: {e}"
+
+@app.cli.command("rebuild-heatmap")
+def rebuild_heatmap_command():
+    """Recompute the manpower heatmap cube from every closed shift."""
+    db.create_all()
+    started = time.perf_counter()
+    shifts, cells = rebuild_manpower_hours()
+    click.echo(f"Built {cells} cells from {shifts} closed shifts in {time.perf_counter() - started:.2f}s")
+
+# ---------------------------------------------------------------------------
+# Offline scan page
+# ---------------------------------------------------------------------------
+
+# /scan is installable and works on one bar of signal: a service worker keeps
+# the page shell and its assets, and the page queues punches on the phone and
+# posts them to /api/punch once it can. Every queued punch carries a key, so a
+# punch that reached the server but whose answer was lost is not applied twice.
+SCAN_SHELL_ASSETS = ("style.css", "logo-220.png", "logo-440.png")
+# The queue delay is the phone's word, so it may only move a punch back a little; a punch
+# kept on the phone longer than this is refused and recorded by a supervisor instead
+PUNCH_OFFLINE_MAX_MINUTES = int(os.environ.get("PUNCH_OFFLINE_MAX_MINUTES", 30))
+# Queued longer than this, a punch's time rests on the phone's word: flag it for review
+PUNCH_OFFLINE_REVIEW_SECONDS = int(os.environ.get("PUNCH_OFFLINE_REVIEW_SECONDS", 120))
+PUNCH_RECEIPT_RETENTION_DAYS = 7
+PUNCH_KEY_MAX_LENGTH = 64
+PUNCH_REQUEST_FIELDS = ("site", "batch", "occurred_at", "name", "subcontractor", "code")
+
+_punch_receipt_state = {"pruned_at": 0.0}
+
+def scan_cache_name():
+    """Service worker cache for the scan shell; changes on every deploy or asset change"""
+    digest = hashlib.sha1(ETAG_SALT.encode())
+    for filename in SCAN_SHELL_ASSETS:
+        digest.update((static_fingerprint(filename) or "").encode())
+    return f"scan-{digest.hexdigest()[:12]}"
+
+def punch_request_hash(action, data):
+    """Digest of the fields that make up a scan-page punch (not sent_at, which changes on every resend)"""
+    fields = [action] + [str(data.get(name) or "").strip() for name in PUNCH_REQUEST_FIELDS]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+def punch_once(key, action, request_hash, operation, *args):
+    """Run a punch_* operation at most once per idempotency key.
+
+    Returns (result, replayed). Runs inside the punch pipeline's transaction, so
+    the receipt commits together with the punch it describes. Rejected punches
+    leave no receipt and are judged afresh if sent again. A key that comes back
+    with a different action or payload raises PunchKeyReused rather than
+    answering with another punch's result.
+    """
+    receipt = db.session.get(PunchReceipt, key)
+    if receipt is not None:
+        if receipt.action != action or receipt.request_hash != request_hash:
+            raise PunchKeyReused("This punch key was already used for a different punch.")
+        return json.loads(receipt.result), True
+    result = operation(*args)
+    db.session.add(PunchReceipt(key=key, action=action, request_hash=request_hash, result=json.dumps(result)))
+    if time.time() - _punch_receipt_state["pruned_at"] > 600:
+        _punch_receipt_state["pruned_at"] = time.time()
+        cutoff = datetime.utcnow() - timedelta(days=PUNCH_RECEIPT_RETENTION_DAYS)
+        PunchReceipt.query.filter(PunchReceipt.created_at < cutoff).delete(synchronize_session=False)
+    return result, False
+
+def queued_punch_time(data):
+    """(when a queued punch happened on the server's clock, whether to flag it as offline).
+
+    The phone sends when it recorded the punch and when it sent it, both on its
+    own clock; only the difference is used, so a phone set to the wrong time or
+    zone still lands the punch at the right moment. The page is unauthenticated
+    and the difference is the phone's say-so, so any real delay is flagged and
+    one longer than PUNCH_OFFLINE_MAX_MINUTES is refused.
+    """
+    try:
+        delay_ms = int(data.get("sent_at")) - int(data.get("occurred_at"))
+    except (TypeError, ValueError):
+        return datetime.now(), False
+    if delay_ms > PUNCH_OFFLINE_MAX_MINUTES * 60 * 1000:
+        raise PunchError(
+            f"This punch was saved more than {PUNCH_OFFLINE_MAX_MINUTES} minutes ago. "
+            "Please ask your supervisor to record it."
+        )
+    delay_ms = max(delay_ms, 0)
+    return datetime.now() - timedelta(milliseconds=delay_ms), delay_ms > PUNCH_OFFLINE_REVIEW_SECONDS * 1000
+
+@app.route("/api/punch", methods=["POST"])
+def api_punch():
+    """Clock in or out from the scan page; safe to resend with the same key"""
+    data = request.get_json(silent=True) or {}
+    key = str(data.get("key") or "").strip()
+    action = data.get("action")
+    job_site = get_job_site_from_id(data.get("site"))
+    batch_id = data.get("batch")
+    if not key or len(key) > PUNCH_KEY_MAX_LENGTH or action not in ("clockin", "clockout"):
+        return {"error": "Invalid punch."}, 400
+    if not job_site or not batch_id:
+        return {"error": "Invalid QR code."}, 400
+
+    request_hash = punch_request_hash(action, data)
+    try:
+        now, offline = queued_punch_time(data)
+        if action == "clockin":
+            name = str(data.get("name") or "").strip()
+            subcontractor = str(data.get("subcontractor") or "").strip()
+            if not name or not subcontractor:
+                raise PunchError("Please fill in all fields.")
+            code, replayed = run_punch(
+                punch_once, key, action, request_hash, punch_clock_in, name, subcontractor, job_site, now, batch_id, offline
+            )
+            return {"status": "ok", "replayed": replayed, "code": code,
+                    "message": f"Successfully clocked in! Your code is: <b>{code}</b>"}
+
+        code = str(data.get("code") or "").strip()
+        if not code:
+            raise PunchError("Please enter your code.")
+        times, replayed = run_punch(
+            punch_once, key, action, request_hash, punch_clock_out, code, now, job_site, offline
+        )
+    except PunchPending as e:
+        # Server-side trouble: the phone keeps the punch and resends it, and the
+        # key makes the resend harmless if this one did get saved
+        return {"error": str(e)}, 503
+    except PunchKeyReused as e:
+        return {"error": str(e)}, 422
+    except PunchError as e:
+        return {"error": str(e)}, 409
+    if times is None:
+        return {"error": "Code not found or already clocked out."}, 409
+    total_seconds, working_seconds = times
+    return {
+        "status": "ok",
+        "replayed": replayed,
+        "message": (
+            f"Shift complete!<br>"
+            f"Total time: <b>{format_seconds(total_seconds)}</b><br>"
+            f"Actual working time: <b>{format_seconds(working_seconds)}</b>"
+        ),
+    }
+
+@app.route("/scan-sw.js")
+def scan_service_worker():
+    response = app.make_response(render_template(
+        "scan_sw.js",
+        cache_name=scan_cache_name(),
+        assets=[url_for("static", filename=filename) for filename in SCAN_SHELL_ASSETS],
+    ))
+    response.mimetype = "application/javascript"
+    # Browsers check for a new worker on navigation; never let a stale copy answer
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route("/scan/manifest.webmanifest")
+def scan_manifest():
+    job_site = get_job_site_from_id(request.args.get("site"))
+    batch_id = request.args.get("batch")
+    if not job_site or not batch_id:
+        return {"error": "Invalid QR code."}, 400
+    response = app.make_response({
+        "name": f"Shift Logger - {job_site}",
+        "short_name": "Shift Logger",
+        "start_url": url_for("qr_scan", site=hashlib.md5(job_site.encode()).hexdigest()[:8], batch=batch_id),
+        "scope": url_for("qr_scan"),
+        "display": "standalone",
+        "background_color": "#e9f0f7",
+        "theme_color": "#6b8eb7",
+        "icons": [{"src": url_for("static", filename="logo-440.png"), "sizes": "440x324", "type": "image/png"}],
+    })
+    response.mimetype = "application/manifest+json"
+    return response
+
+@app.route('/add_punch_receipt_table')
+def add_punch_receipt_table():
+    try:
+        db.create_all()
+        return "punch_receipt table ready"
+    except Exception as e:
+        return f"Error: {e}"
+
+@app.route('/add_punch_receipt_request_columns')
+def add_punch_receipt_request_columns():
+    try:
+        db.session.execute(text("ALTER TABLE punch_receipt ADD COLUMN action VARCHAR(16);"))
+        db.session.execute(text("ALTER TABLE punch_receipt ADD COLUMN request_hash VARCHAR(64);"))
+        db.session.commit()
+        return "punch_receipt request columns added"
+    except Exception as e:
+        return f"Error: {e}"
+
+# ---------------------------------------------------------------------------
+# Worker code cache
+# ---------------------------------------------------------------------------
+
+# Who owns a code, and whether a worker has a shift open, are looked up on every
+# punch but almost never change. A small SQLite file next to the app's temp files
+# keeps them for every gunicorn worker on the host. Entries are dropped after the
+# transaction that changes them commits; an epoch bumped with every drop stops a
+# request that read the database before that commit from putting back an old
+# answer. WORKER_CACHE=0 turns the cache off.
+#
+# The file is per host: a punch served by another instance of the app never
+# drops entries here. "Already clocked in" answers are therefore only kept for a
+# few seconds, so a worker clocked out elsewhere can clock in again right away.
+WORKER_CACHE_ENABLED = os.environ.get("WORKER_CACHE", "1") != "0"
+WORKER_CACHE_PATH = os.environ.get("WORKER_CACHE_PATH")
+WORKER_CACHE_SIZE = int(os.environ.get("WORKER_CACHE_SIZE", 20000))
+WORKER_CACHE_OPEN_SHIFT_TTL = float(os.environ.get("WORKER_CACHE_OPEN_SHIFT_TTL", 5))
+WORKER_CACHE_TOUCH_SECONDS = 60
+
+ALL_KEYS = "*"
+
+class WorkerCodeCache:
+    """LRU cache of code -> worker and worker -> open shift, shared through a SQLite file"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS worker (code TEXT PRIMARY KEY, name TEXT NOT NULL,"
+        " subcontractor TEXT NOT NULL, used_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_worker_name ON worker (name, subcontractor)",
+        "CREATE INDEX IF NOT EXISTS ix_worker_used ON worker (used_at)",
+        "CREATE TABLE IF NOT EXISTS open_shift (name TEXT NOT NULL, subcontractor TEXT NOT NULL,"
+        " shift_id INTEGER, job_site TEXT, stored_at REAL NOT NULL, used_at REAL NOT NULL,"
+        " PRIMARY KEY (name, subcontractor))",
+        "CREATE INDEX IF NOT EXISTS ix_open_shift_used ON open_shift (used_at)",
+        "CREATE TABLE IF NOT EXISTS epoch (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    )
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.inserts = itertools.count()
+
+    def path(self):
+        if WORKER_CACHE_PATH:
+            return WORKER_CACHE_PATH
+        database = hashlib.sha1(app.config["SQLALCHEMY_DATABASE_URI"].encode()).hexdigest()[:12]
+        return os.path.join(tempfile.gettempdir(), f"shift_logger_workers_{database}.sqlite")
+
+    def connection(self):
+        path = self.path()
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.path != path:
+            conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # A cache: losing the last writes in a power cut is fine
+            conn.execute("PRAGMA synchronous=OFF")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.local.conn, self.local.path = conn, path
+        return conn
+
+    def epochs(self):
+        """{"worker": n, "open_shift": n}: how many invalidations each table has seen"""
+        rows = dict(self.connection().execute("SELECT name, value FROM epoch").fetchall())
+        return {"worker": rows.get("worker", 0), "open_shift": rows.get("open_shift", 0)}
+
+    def _touch(self, conn, table, where, args, used_at):
+        now = time.time()
+        if now - used_at > WORKER_CACHE_TOUCH_SECONDS:
+            conn.execute(f"UPDATE {table} SET used_at = ? WHERE {where}", (now, *args))
+
+    def get_worker(self, code=None, name=None, subcontractor=None):
+        """(code, name, subcontractor) by code or by name and subcontractor, or None"""
+        conn = self.connection()
+        if code is not None:
+            where, args = "code = ?", (code,)
+        else:
+            where, args = "name = ? AND subcontractor = ?", (name, subcontractor)
+        row = conn.execute(f"SELECT code, name, subcontractor, used_at FROM worker WHERE {where}", args).fetchone()
+        if row is None:
+            return None
+        self._touch(conn, "worker", "code = ?", (row[0],), row[3])
+        return row[:3]
+
+    def get_open_shift(self, name, subcontractor):
+        """(hit, (shift_id, job_site) or None)"""
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT shift_id, job_site, stored_at, used_at FROM open_shift WHERE name = ? AND subcontractor = ?",
+            (name, subcontractor),
+        ).fetchone()
+        if row is None or time.time() - row[2] > WORKER_CACHE_OPEN_SHIFT_TTL:
+            return False, None
+        self._touch(conn, "open_shift", "name = ? AND subcontractor = ?", (name, subcontractor), row[3])
+        return True, (row[0], row[1]) if row[0] is not None else None
+
+    def _store(self, table, epoch, expected, statement, args):
+        """Run an insert unless the table was invalidated since expected was read"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("SELECT value FROM epoch WHERE name = ?", (epoch,)).fetchone()
+            if (current[0] if current else 0) != expected:
+                return
+            conn.execute(statement, args)
+            if next(self.inserts) % 256 == 0:
+                self._evict(conn)
+        finally:
+            conn.execute("COMMIT")
+
+    def put_worker(self, code, name, subcontractor, expected_epoch):
+        now = time.time()
+        self._store("worker", "worker", expected_epoch,
+                    "INSERT OR REPLACE INTO worker VALUES (?, ?, ?, ?)", (code, name, subcontractor, now))
+
+    def put_open_shift(self, name, subcontractor, open_shift, expected_epoch):
+        shift_id, job_site = open_shift or (None, None)
+        now = time.time()
+        self._store("open_shift", "open_shift", expected_epoch,
+                    "INSERT OR REPLACE INTO open_shift VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, subcontractor, shift_id, job_site, now, now))
+
+    def _evict(self, conn):
+        for table, key in (("worker", "code"), ("open_shift", "rowid")):
+            count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if count > self.max_entries:
+                # Trim to 90% so eviction runs rarely
+                conn.execute(
+                    f"DELETE FROM {table} WHERE {key} IN "
+                    f"(SELECT {key} FROM {table} ORDER BY used_at LIMIT ?)",
+                    (count - self.max_entries * 9 // 10,),
+                )
+
+    def invalidate(self, workers, open_shifts, known=None):
+        """Drop (name, subcontractor) keys, or ALL_KEYS, from each table and bump its epoch.
+
+        known maps keys to the open shift a just-committed write left them with,
+        which is stored in place of the dropped entry.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table, keys in (("worker", workers), ("open_shift", open_shifts)):
+                if not keys:
+                    continue
+                if ALL_KEYS in keys:
+                    conn.execute(f"DELETE FROM {table}")
+                else:
+                    conn.executemany(f"DELETE FROM {table} WHERE name = ? AND subcontractor = ?", list(keys))
+                conn.execute(
+                    "INSERT INTO epoch (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+                    (table,),
+                )
+            if known:
+                now = time.time()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO open_shift VALUES (?, ?, ?, ?, ?, ?)",
+                    [(name, subcontractor, *(open_shift or (None, None)), now, now)
+                     for (name, subcontractor), open_shift in known.items()],
+                )
+        finally:
+            conn.execute("COMMIT")
+
+    def clear(self):
+        self.invalidate({ALL_KEYS}, {ALL_KEYS})
+
+worker_cache = WorkerCodeCache(WORKER_CACHE_SIZE)
+
+def _cache_pending(session):
+    """Cache changes a transaction owes once it commits.
+
+    worker and open_shift hold keys to drop; known holds (name, subcontractor)
+    -> the open shift (or None) this transaction's writes left the worker with.
+    """
+    return session.info.setdefault("worker_cache_pending", {"worker": set(), "open_shift": set(), "known": {}})
+
+def _cache_usable(session, table, key):
+    """Whether session may answer key from the cache (and store what it reads)"""
+    if not WORKER_CACHE_ENABLED:
+        return False
+    if "worker_cache_epochs" not in session.info:
+        # Start the transaction so the epochs are read before anything else
+        session.connection()
+        if "worker_cache_epochs" not in session.info:
+            return False
+    pending = session.info.get("worker_cache_pending")
+    if not pending:
+        return True
+    return ALL_KEYS not in pending[table] and key not in pending[table] and key not in pending["known"]
+
+def _cache_failed(e):
+    print(f"Worker cache unavailable, using the database: {e}")
+
+def lookup_worker(code=None, name=None, subcontractor=None):
+    """Worker by code, or by name and subcontractor, as a (code, name, subcontractor) namespace"""
+    session = db.session()
+    if session.new or session.dirty:
+        # Pending writes have to reach the invalidation hooks before the cache is asked
+        session.flush()
+    usable = _cache_usable(session, "worker", None)
+    if usable:
+        try:
+            cached = worker_cache.get_worker(code, name, subcontractor)
+            if cached:
+                return types.SimpleNamespace(code=cached[0], name=cached[1], subcontractor=cached[2])
+        except sqlite3.Error as e:
+            _cache_failed(e)
+            usable = False
+    if code is not None:
+        worker = WorkerCode.query.filter_by(code=code).first()
+    else:
+        worker = WorkerCode.query.filter_by(name=name, subcontractor=subcontractor).first()
+    if worker is None:
+        return None
+    if usable:
+        try:
+            worker_cache.put_worker(worker.code, worker.name, worker.subcontractor, session.info["worker_cache_epochs"]["worker"])
+        except sqlite3.Error as e:
+            _cache_failed(e)
+    return types.SimpleNamespace(code=worker.code, name=worker.name, subcontractor=worker.subcontractor)
+
+def lookup_open_shift(name, subcontractor):
+    """(shift id, job site) of the worker's open shift, or None.
+
+    Only "already clocked in" is answered from the cache. "Not clocked in" lets
+    a punch open a shift, and only the database's transaction can stop two
+    processes doing that for the same worker at once, so it is always read there.
+    """
+    session = db.session()
+    if session.new or session.dirty:
+        session.flush()
+    usable = _cache_usable(session, "open_shift", (name, subcontractor))
+    if usable:
+        try:
+            hit, open_shift = worker_cache.get_open_shift(name, subcontractor)
+            if hit and open_shift is not None:
+                return open_shift
+        except sqlite3.Error as e:
+            _cache_failed(e)
+            usable = False
+    row = (
+        db.session.query(Shift.id, Shift.job_site)
+        .filter_by(name=name, subcontractor=subcontractor, clock_out=None)
+        .first()
+    )
+    open_shift = (row.id, row.job_site) if row else None
+    if usable:
+        try:
+            worker_cache.put_open_shift(name, subcontractor, open_shift, session.info["worker_cache_epochs"]["open_shift"])
+        except sqlite3.Error as e:
+            _cache_failed(e)
+    return open_shift
+
+@event.listens_for(SASession, "after_begin")
+def _remember_worker_cache_epochs(session, transaction, connection):
+    # Read before this transaction's first query: anything invalidated later may
+    # be missing from what it reads, so it must not be stored
+    if WORKER_CACHE_ENABLED and "worker_cache_epochs" not in session.info:
+        try:
+            session.info["worker_cache_epochs"] = worker_cache.epochs()
+        except sqlite3.Error as e:
+            _cache_failed(e)
+
+@event.listens_for(SASession, "after_flush")
+def _track_worker_cache_writes(session, flush_context):
+    pending = None
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Shift):
+            pending = pending or _cache_pending(session)
+            state = sqlalchemy.inspect(obj)
+            key = (obj.name, obj.subcontractor)
+            if state.attrs.name.history.deleted or state.attrs.subcontractor.history.deleted:
+                pending["open_shift"].add(ALL_KEYS)
+            elif obj in session.deleted:
+                pending["known"].pop(key, None)
+                pending["open_shift"].add(key)
+            elif obj.clock_out is None:
+                pending["known"][key] = (obj.id, obj.job_site)
+            elif None in state.attrs.clock_out.history.deleted:
+                # Clocked out: a worker has one open shift at a time
+                pending["known"][key] = None
+        elif isinstance(obj, WorkerCode) and obj not in session.new:
+            pending = pending or _cache_pending(session)
+            pending["worker"].add(ALL_KEYS)
+
+@event.listens_for(SASession, "do_orm_execute")
+def _track_worker_cache_bulk_writes(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    table = getattr(getattr(orm_execute_state.statement, "table", None), "name", None)
+    if table == "shift":
+        _cache_pending(orm_execute_state.session)["open_shift"].add(ALL_KEYS)
+    elif table == "worker_code" and not orm_execute_state.is_insert:
+        _cache_pending(orm_execute_state.session)["worker"].add(ALL_KEYS)
+
+@event.listens_for(SASession, "before_commit")
+def _invalidate_worker_cache_early(session):
+    # Dropped once before the commit, so other processes miss the cache (and wait
+    # on the database) while it is in flight; refilled from the writes after it
+    if session.info.get("worker_cache_pending"):
+        _invalidate_worker_cache(session, keep_pending=True)
+
+@event.listens_for(SASession, "after_commit")
+def _invalidate_worker_cache(session, keep_pending=False):
+    if keep_pending:
+        pending = session.info.get("worker_cache_pending")
+    else:
+        pending = session.info.pop("worker_cache_pending", None)
+    if not WORKER_CACHE_ENABLED or not pending:
+        return
+    known = {} if ALL_KEYS in pending["open_shift"] else pending["known"]
+    try:
+        if keep_pending:
+            worker_cache.invalidate(pending["worker"], pending["open_shift"] | set(known))
+        else:
+            worker_cache.invalidate(pending["worker"], pending["open_shift"], known)
+    except sqlite3.Error as e:
+        print(f"Error invalidating worker cache, clearing it: {e}")
+        try:
+            os.remove(worker_cache.path())
+        except OSError:
+            pass
+
+@event.listens_for(SASession, "after_transaction_end")
+def _forget_worker_cache_writes(session, transaction):
+    # Rolled back or closed without a commit: nothing it wrote reached the database
+    if transaction.parent is None:
+        session.info.pop("worker_cache_epochs", None)
+        session.info.pop("worker_cache_pending", None)
+
+@app.cli.command("clear-worker-cache")
+def clear_worker_cache_command():
+    """Empty the shared worker code cache (after restoring or editing the database by hand)."""
+    worker_cache.clear()
+    click.echo(f"Cleared {worker_cache.path()}")
+
+# ---------------------------------------------------------------------------
+# Outbox: outbound API sync
+# ---------------------------------------------------------------------------
+
+# Calls to outside APIs never run inside a punch. The punch writes an outbox row
+# in its own transaction, and a dispatcher thread (one per process, or the
+# dispatch-outbox command) sends due rows in batches over a pooled HTTP session.
+# Failures back off exponentially; rows that keep failing, or that the API
+# rejects outright, are dead-lettered for an admin to look at and retry. A 401
+# or 403 says the token is wrong, not the rows, so it pauses the dispatcher
+# instead and the rows keep their attempts.
+PROCORE_API_URL = os.environ.get("PROCORE_API_URL")
+PROCORE_API_TOKEN = os.environ.get("PROCORE_API_TOKEN")
+PROCORE_TIMECARD_TOPIC = "procore.timecard"
+OUTBOX_DISPATCH_IN_PROCESS = os.environ.get("OUTBOX_DISPATCH", "1") != "0"
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_RATE_PER_SECOND = float(os.environ.get("OUTBOX_RATE_PER_SECOND", 5))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_BACKOFF_BASE_SECONDS = 2
+OUTBOX_BACKOFF_MAX_SECONDS = 900
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_AUTH_PAUSE_SECONDS = 300
+OUTBOX_POLL_SECONDS = 2
+OUTBOX_HTTP_TIMEOUT_SECONDS = 10
+OUTBOX_RETENTION_DAYS = 7
+
+class OutboxRetry(Exception):
+    """The call failed but may succeed later (network error, 429, 5xx)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class OutboxRejected(Exception):
+    """The API refused the request; sending it again unchanged will not help"""
+
+class OutboxUnauthorized(Exception):
+    """The API refused our credentials (401/403); no row can be sent until they are fixed"""
+
+def enqueue_outbox(topic, payload):
+    """Add an outbound message to the caller's transaction"""
+    db.session.add(OutboxMessage(topic=topic, payload=json.dumps(payload)))
+    if OUTBOX_DISPATCH_IN_PROCESS:
+        outbox_dispatcher.ensure_running()
+
+def procore_timecard(shift):
+    local_clock_in = get_local_time(shift.clock_in, shift.job_site)
+    return {
+        "shift_id": shift.id,
+        "worker_code": shift.code,
+        "name": shift.name,
+        "subcontractor": shift.subcontractor,
+        "job_site": shift.job_site,
+        "date": local_clock_in.date().isoformat(),
+        "clock_in": shift.clock_in.isoformat() + "Z",
+        "clock_out": shift.clock_out.isoformat() + "Z",
+        "working_hours": round(parse_duration_hours(shift.working_time), 2),
+        "breaks": shift.breaks or "",
+        "flagged": bool(shift.flagged),
+    }
+
+def retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    try:
+        return max(float(value), 0.0) if value else None
+    except ValueError:
+        return None
+
+def send_procore_timecards(http, payloads):
+    """POST a batch of timecards; raises OutboxRetry, OutboxRejected or OutboxUnauthorized on failure"""
+    try:
+        response = http.post(PROCORE_API_URL, json={"timecards": payloads}, timeout=OUTBOX_HTTP_TIMEOUT_SECONDS)
+    except requests.RequestException as e:
+        raise OutboxRetry(f"{type(e).__name__}: {e}")
+    if response.status_code == 429 or response.status_code >= 500:
+        raise OutboxRetry(f"HTTP {response.status_code}", retry_after_seconds(response))
+    if response.status_code in (401, 403):
+        raise OutboxUnauthorized(f"HTTP {response.status_code}: {response.text[:200]}")
+    if response.status_code >= 400:
+        raise OutboxRejected(f"HTTP {response.status_code}: {response.text[:200]}")
+
+# topic -> sender(http session, [payload, ...])
+OUTBOX_SENDERS = {PROCORE_TIMECARD_TOPIC: send_procore_timecards}
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart (shared by the threads of one process)"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def outbox_backoff_seconds(attempts, retry_after=None):
+    """Delay before attempt number attempts + 1: exponential with jitter, at least Retry-After"""
+    delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+    delay *= random.uniform(0.5, 1.0)
+    return max(delay, retry_after or 0.0)
+
+def outbox_http_session():
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    http.headers["User-Agent"] = "shift-logger-outbox"
+    if PROCORE_API_TOKEN:
+        http.headers["Authorization"] = f"Bearer {PROCORE_API_TOKEN}"
+    return http
+
+class OutboxDispatcher:
+    """Sends due outbox rows in batches from one background thread per process.
+
+    Rows are claimed by pushing next_attempt_at out by a lease, so several
+    processes can dispatch at once without sending a row twice; a process that
+    dies mid-batch leaves its rows to be picked up when the lease runs out.
+    Work on a claimed batch stops while there is still time left on the lease
+    (see lease_deadline), and the rows not reached are handed back untouched.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.http = None
+        self.limiter = RateLimiter(OUTBOX_RATE_PER_SECOND)
+        self.last_prune = 0.0
+        self.lease_deadline = 0.0
+        self.paused_until = 0.0
+
+    def ensure_running(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="outbox-dispatcher", daemon=True)
+                self.thread.start()
+
+    def run(self, drain=False):
+        """Dispatch forever (or, with drain, until nothing is due)"""
+        with app.app_context():
+            while True:
+                try:
+                    handled = self.dispatch_once()
+                except Exception as e:
+                    print(f"Error dispatching outbox: {e}")
+                    db.session.rollback()
+                    handled = 0
+                finally:
+                    db.session.remove()
+                if drain and not handled:
+                    return
+                if not handled:
+                    time.sleep(OUTBOX_POLL_SECONDS)
+
+    def claim(self):
+        """Lease up to OUTBOX_BATCH_SIZE due rows to this dispatcher and return them"""
+        now = datetime.utcnow()
+        due = [
+            message_id for message_id, in db.session.query(OutboxMessage.id)
+            .filter(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.id)
+            .limit(OUTBOX_BATCH_SIZE)
+        ]
+        if not due:
+            db.session.commit()
+            return []
+        token = str(uuid.uuid4())
+        # Leave room for one more call to time out before the lease runs out
+        self.lease_deadline = time.monotonic() + OUTBOX_LEASE_SECONDS - 2 * OUTBOX_HTTP_TIMEOUT_SECONDS
+        # Only rows still due are taken: another dispatcher may have leased some meanwhile
+        OutboxMessage.query.filter(
+            OutboxMessage.id.in_(due),
+            OutboxMessage.status == "pending",
+            OutboxMessage.next_attempt_at <= now,
+        ).update(
+            {"claimed_by": token, "next_attempt_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return OutboxMessage.query.filter_by(claimed_by=token, status="pending").order_by(OutboxMessage.id).all()
+
+    def dispatch_once(self):
+        """Send one batch of due rows; returns how many were handled"""
+        if time.monotonic() < self.paused_until:
+            return 0
+        messages = self.claim()
+        if not messages:
+            self.prune()
+            return 0
+        if self.http is None:
+            self.http = outbox_http_session()
+        by_topic = {}
+        for message in messages:
+            by_topic.setdefault(message.topic, []).append(message)
+        for topic, batch in by_topic.items():
+            self.send(topic, batch)
+        db.session.commit()
+        return len(messages)
+
+    def send(self, topic, batch):
+        sender = OUTBOX_SENDERS.get(topic)
+        if sender is None:
+            self.dead_letter(batch, f"No sender for topic {topic!r}")
+            return
+        if time.monotonic() < self.paused_until:
+            # Credentials were refused earlier in this round
+            self.release(batch, datetime.utcnow() + timedelta(seconds=OUTBOX_AUTH_PAUSE_SECONDS))
+            return
+        self.limiter.wait()
+        payloads = [dict(json.loads(message.payload), idempotency_key=f"outbox-{message.id}") for message in batch]
+        try:
+            sender(self.http, payloads)
+        except OutboxRetry as e:
+            self.retry_later(batch, str(e), e.retry_after)
+        except OutboxUnauthorized as e:
+            print(f"Outbox paused for {OUTBOX_AUTH_PAUSE_SECONDS}s, check PROCORE_API_TOKEN: {e}")
+            self.paused_until = time.monotonic() + OUTBOX_AUTH_PAUSE_SECONDS
+            self.release(batch, datetime.utcnow() + timedelta(seconds=OUTBOX_AUTH_PAUSE_SECONDS), str(e))
+        except OutboxRejected as e:
+            if len(batch) == 1:
+                self.dead_letter(batch, str(e))
+            else:
+                # Find the row(s) the API objects to instead of failing the whole batch,
+                # one call per row, for as long as the lease allows
+                for index, message in enumerate(batch):
+                    if time.monotonic() >= self.lease_deadline:
+                        self.release(batch[index:], datetime.utcnow())
+                        break
+                    self.send(topic, [message])
+        else:
+            now = datetime.utcnow()
+            for message in batch:
+                message.status = "sent"
+                message.sent_at = now
+                message.attempts += 1
+                message.last_error = None
+
+    def retry_later(self, batch, error, retry_after=None):
+        now = datetime.utcnow()
+        for message in batch:
+            message.attempts += 1
+            message.last_error = error[:500]
+            if message.attempts >= OUTBOX_MAX_ATTEMPTS:
+                message.status = "dead"
+            else:
+                message.next_attempt_at = now + timedelta(seconds=outbox_backoff_seconds(message.attempts, retry_after))
+
+    def release(self, batch, next_attempt_at, error=None):
+        """Hand rows back to the queue unsent, without using up an attempt"""
+        for message in batch:
+            message.claimed_by = None
+            message.next_attempt_at = next_attempt_at
+            if error:
+                message.last_error = error[:500]
+
+    def dead_letter(self, batch, error):
+        for message in batch:
+            message.attempts += 1
+            message.status = "dead"
+            message.last_error = error[:500]
+
+    def prune(self):
+        if time.time() - self.last_prune < 600:
+            return
+        self.last_prune = time.time()
+        cutoff = datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS)
+        OutboxMessage.query.filter(OutboxMessage.status == "sent", OutboxMessage.sent_at < cutoff).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+outbox_dispatcher = OutboxDispatcher()
+
+@app.before_request
+def start_outbox_dispatcher():
+    # Rows left by a previous run are sent even before this process punches anything
+    if PROCORE_API_URL and OUTBOX_DISPATCH_IN_PROCESS and outbox_dispatcher.thread is None:
+        outbox_dispatcher.ensure_running()
+
+def requeue_dead_outbox(message_ids=None):
+    """Give dead-lettered rows a fresh set of attempts; returns how many"""
+    query = OutboxMessage.query.filter_by(status="dead")
+    if message_ids:
+        query = query.filter(OutboxMessage.id.in_(message_ids))
+    count = query.update(
+        {"status": "pending", "attempts": 0, "next_attempt_at": datetime.utcnow(), "claimed_by": None},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return count
+
+@app.route("/admin/outbox")
+def admin_outbox():
+    """Outbox backlog and the most recent dead letters, as JSON"""
+    if not session.get("admin_authenticated"):
+        return {"error": "Not authorized"}, 403
+    counts = dict(db.session.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status).all())
+    oldest = db.session.query(func.min(OutboxMessage.created_at)).filter(OutboxMessage.status == "pending").scalar()
+    dead = OutboxMessage.query.filter_by(status="dead").order_by(OutboxMessage.id.desc()).limit(50).all()
+    return {
+        "enabled": bool(PROCORE_API_URL),
+        "counts": {status: counts.get(status, 0) for status in ("pending", "sent", "dead")},
+        "oldest_pending": oldest.isoformat() if oldest else None,
+        "dead": [
+            {"id": m.id, "topic": m.topic, "attempts": m.attempts, "last_error": m.last_error,
+             "created_at": m.created_at.isoformat(), "payload": json.loads(m.payload)}
+            for m in dead
+        ],
+    }
+
+@app.route("/admin/outbox/retry", methods=["POST"])
+def admin_outbox_retry():
+    if not session.get("admin_authenticated"):
+        return {"error": "Not authorized"}, 403
+    ids = [int(value) for value in request.form.getlist("id") if value.isdigit()]
+    return {"requeued": requeue_dead_outbox(ids)}
+
+@app.route('/add_outbox_table')
+def add_outbox_table():
+    try:
+        db.create_all()
+        return "outbox_message table ready"
+    except Exception as e:
+        return f"Error: {e}"
+
+@app.cli.command("dispatch-outbox")
+@click.option("--drain", is_flag=True, help="Exit once nothing is due instead of polling forever.")
+def dispatch_outbox_command(drain):
+    """Send queued outbox rows (run with OUTBOX_DISPATCH=0 on the web processes)."""
+    if not PROCORE_API_URL:
+        raise click.ClickException("PROCORE_API_URL is not set.")
+    outbox_dispatcher.run(drain=drain)
+    counts = dict(db.session.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status).all())
+    click.echo(f"Outbox: {counts}")
+
+@app.cli.command("retry-dead-outbox")
+def retry_dead_outbox_command():
+    """Put every dead-lettered outbox row back in the queue."""
+    click.echo(f"Requeued {requeue_dead_outbox()} message(s)")
+
+def outbox_stub_server(port=0, fail_rate=0.0, latency_ms=0, max_per_second=0.0, token=None, reject_codes=()):
+    """Local stand-in for the timecard API; returns an unstarted ThreadingHTTPServer.
+
+    Timecards are counted by idempotency key, so a resend shows up as a
+    duplicate, not a new card. server.options can be changed while it runs and
+    server.stats holds the counts.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    options = {"fail_rate": fail_rate, "latency_ms": latency_ms, "max_per_second": max_per_second,
+               "token": token, "reject_codes": set(reject_codes)}
+    stats = {"requests": 0, "timecards": 0, "duplicates": 0, "failed": 0, "limited": 0, "rejected": 0}
+    seen = set()
+    lock = threading.Lock()
+    limiter = {"window": 0, "count": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(options["latency_ms"] / 1000)
+            with lock:
+                stats["requests"] += 1
+                if options["token"] and self.headers.get("Authorization") != f"Bearer {options['token']}":
+                    return self.answer(401, {"error": "bad token"})
+                window = int(time.time())
+                if limiter["window"] != window:
+                    limiter.update(window=window, count=0)
+                limiter["count"] += 1
+                if options["max_per_second"] and limiter["count"] > options["max_per_second"]:
+                    stats["limited"] += 1
+                    return self.answer(429, {"error": "rate limited"}, {"Retry-After": "1"})
+                if random.random() < options["fail_rate"]:
+                    stats["failed"] += 1
+                    return self.answer(503, {"error": "unavailable"})
+                try:
+                    timecards = json.loads(body)["timecards"]
+                except (ValueError, KeyError, TypeError):
+                    return self.answer(400, {"error": "expected {\"timecards\": [...]}"})
+                if any(card.get("worker_code") in options["reject_codes"] for card in timecards):
+                    stats["rejected"] += 1
+                    return self.answer(422, {"error": "unknown worker"})
+                for card in timecards:
+                    key = card.get("idempotency_key")
+                    if key in seen:
+                        stats["duplicates"] += 1
+                    else:
+                        seen.add(key)
+                        stats["timecards"] += 1
+            self.answer(200, {"accepted": len(timecards)})
+
+        def do_GET(self):
+            with lock:
+                self.answer(200, dict(stats))
+
+        def answer(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.options, server.stats = options, stats
+    return server
+
+@app.cli.command("outbox-stub-server")
+@click.option("--port", default=8765, show_default=True)
+@click.option("--fail-rate", default=0.0, show_default=True, help="Share of requests answered with HTTP 503.")
+@click.option("--latency-ms", default=0, show_default=True, help="Delay before every answer.")
+@click.option("--max-per-second", default=0.0, show_default=True, help="Answer 429 above this request rate (0: no limit).")
+@click.option("--token", help="Answer 401 unless this bearer token is sent.")
+@click.option("--reject-code", "reject_codes", multiple=True, help="Answer 422 to batches with this worker code.")
+def outbox_stub_server_command(port, fail_rate, latency_ms, max_per_second, token, reject_codes):
+    """Local stand-in for the timecard API, for trying the outbox without Procore.
+
+    Point PROCORE_API_URL at http://127.0.0.1:<port>/timecards. Timecards are
+    counted by idempotency key, so a resend shows up as a duplicate, not a new card.
+    """
+    server = outbox_stub_server(port, fail_rate, latency_ms, max_per_second, token, reject_codes)
+    click.echo(f"Stub timecard API on http://127.0.0.1:{port}/timecards (GET for counts)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    click.echo(json.dumps(server.stats))
+
+# ---------------------------------------------------------------------------
+# Bulk timesheet import
+# ---------------------------------------------------------------------------
+
+# Historical timesheets from a previous system are loaded without the punch
+# path: rows are read and validated IMPORT_CHUNK_SIZE at a time, each chunk is
+# written with one COPY (Postgres) or executemany (SQLite) per table and
+# committed together with its manpower cube cells and project history; the
+# clock event log is brought up to date at the end of every run. Shifts already
+# in the database (same worker, job site and clock-in) are skipped, so an import
+# that stopped part way can be run again: the re-run skips the committed chunks
+# and still logs their shifts. Memory stays flat however long the file is:
+# nothing per row outlives its chunk except in a dry run, which has to remember
+# the rows it did not write to spot duplicates further down the file. The admin
+# upload runs inside a web request, so files over IMPORT_UPLOAD_MAX_BYTES go
+# through `flask import-timesheets` instead.
+try:
+    import openpyxl
+except ImportError:  # optional: CSV always works
+    openpyxl = None
+
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_MAX_SHIFT_HOURS = 24
+IMPORT_ERROR_SAMPLES = 20
+IMPORT_UPLOAD_MAX_BYTES = int(os.environ.get("IMPORT_UPLOAD_MAX_BYTES", 2 * 1024 * 1024))
+IMPORT_DATETIME_FORMATS = (
+    "%Y-%m-%d %I:%M %p",   # what the shift export writes
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%m/%d/%Y %I:%M %p",
+    "%m/%d/%Y %H:%M",
+    "%m/%d/%Y %H:%M:%S",
+)
+IMPORT_TIME_FORMATS = ("%I:%M %p", "%I:%M%p", "%H:%M")
+# Accepted spellings of each column, compared lower-case with spaces and underscores removed
+IMPORT_COLUMNS = {
+    "name": ("name", "worker", "workername", "employee"),
+    "subcontractor": ("subcontractor", "company", "sub"),
+    "job_site": ("jobsite", "site", "project"),
+    "clock_in": ("clockin", "timein", "start"),
+    "clock_out": ("clockout", "timeout", "end"),
+    "breaks": ("breaks",),
+    "code": ("code", "workercode"),
+    "flagged": ("flagged",),
+}
+
+class ImportRowError(ValueError):
+    """A timesheet row that cannot be imported; the message says why"""
+
+def import_column_map(header):
+    """{field: index in the header row}; raises ImportRowError when a required column is missing"""
+    normalized = [str(cell or "").strip().lower().replace(" ", "").replace("_", "") for cell in header]
+    columns = {}
+    for field, spellings in IMPORT_COLUMNS.items():
+        for index, cell in enumerate(normalized):
+            if cell in spellings:
+                columns[field] = index
+                break
+    missing = [field for field in ("name", "subcontractor", "job_site", "clock_in", "clock_out") if field not in columns]
+    if missing:
+        raise ImportRowError(f"Missing column(s): {', '.join(missing)}")
+    return columns
+
+def read_timesheet_rows(stream, filename):
+    """Yield (line number, {field: value}) from a CSV or XLSX upload, one row at a time"""
+    if filename.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ImportRowError("Reading .xlsx files needs openpyxl; save the sheet as CSV instead.")
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    else:
+        rows = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = import_column_map(header)
+    for line, row in enumerate(rows, 2):
+        if not any(cell not in (None, "") for cell in row):
+            continue
+        yield line, {field: row[index] if index < len(row) else None for field, index in columns.items()}
+
+def _site_local_to_utc(value, job_site):
+    tz = pytz.timezone(JOB_SITE_TIMEZONES.get(job_site, "UTC"))
+    if value.tzinfo is None:
+        value = tz.localize(value)
+    return value.astimezone(pytz.utc).replace(tzinfo=None)
+
+_import_format_hint = [None]
+
+def parse_import_datetime(value, job_site):
+    """A clock-in/out cell as naive UTC; times without an offset are site-local"""
+    if isinstance(value, datetime):
+        return _site_local_to_utc(value, job_site)
+    text_value = str(value or "").strip()
+    if not text_value:
+        raise ImportRowError("missing time")
+    try:
+        return _site_local_to_utc(datetime.fromisoformat(text_value.replace("Z", "+00:00")), job_site)
+    except ValueError:
+        pass
+    # A file almost always uses one format throughout, so try the last match first
+    last = _import_format_hint[0]
+    for fmt in ((last,) if last else ()) + IMPORT_DATETIME_FORMATS:
+        try:
+            parsed = datetime.strptime(text_value, fmt)
+        except ValueError:
+            continue
+        _import_format_hint[0] = fmt
+        return _site_local_to_utc(parsed, job_site)
+    raise ImportRowError(f"unrecognised date/time {text_value!r}")
+
+def parse_import_breaks(value, clock_in, clock_out, job_site):
+    """"12:00 PM - 12:30 PM; ..." (site-local times within the shift) -> [(start, end)] in UTC"""
+    breaks = []
+    local_clock_in = get_local_time(clock_in, job_site).replace(tzinfo=None)
+    for part in str(value or "").split(";"):
+        if not part.strip():
+            continue
+        bounds = [bound.strip() for bound in part.split(" - " if " - " in part else "-")]
+        if len(bounds) != 2:
+            raise ImportRowError(f"unrecognised break {part.strip()!r}")
+        times = []
+        for bound in bounds:
+            for fmt in IMPORT_TIME_FORMATS:
+                try:
+                    parsed = datetime.strptime(bound.upper(), fmt).time()
+                    break
+                except ValueError:
+                    continue
+            else:
+                raise ImportRowError(f"unrecognised break time {bound!r}")
+            # The first such time at or after the previous one (breaks can cross midnight)
+            after = times[-1] if times else local_clock_in
+            moment = datetime.combine(after.date(), parsed)
+            if moment < after:
+                moment += timedelta(days=1)
+            times.append(moment)
+        start, end = (_site_local_to_utc(moment, job_site) for moment in times)
+        if start < clock_in or end > clock_out:
+            raise ImportRowError(f"break {part.strip()!r} is outside the shift")
+        breaks.append((start, end))
+    return breaks
+
+_IMPORT_JOB_SITES = {site.lower(): site for site in JOB_SITES}
+
+def normalize_timesheet_row(row):
+    """Validated shift values and breaks for one input row"""
+    name = str(row.get("name") or "").strip()
+    subcontractor = str(row.get("subcontractor") or "").strip()
+    job_site = _IMPORT_JOB_SITES.get(str(row.get("job_site") or "").strip().lower())
+    if not name or not subcontractor:
+        raise ImportRowError("name and subcontractor are required")
+    if len(name) > 120 or len(subcontractor) > 120:
+        raise ImportRowError("name or subcontractor longer than 120 characters")
+    if job_site is None:
+        raise ImportRowError(f"unknown job site {row.get('job_site')!r}")
+    clock_in = parse_import_datetime(row.get("clock_in"), job_site)
+    clock_out = parse_import_datetime(row.get("clock_out"), job_site)
+    if clock_out <= clock_in:
+        raise ImportRowError("clock out is not after clock in")
+    if clock_out - clock_in > timedelta(hours=IMPORT_MAX_SHIFT_HOURS):
+        raise ImportRowError(f"shift longer than {IMPORT_MAX_SHIFT_HOURS} hours")
+    breaks = parse_import_breaks(row.get("breaks"), clock_in, clock_out, job_site)
+    total_seconds, working_seconds, breaks_str = shift_totals(clock_in, clock_out, breaks)
+    code = str(row.get("code") or "").strip()
+    if code.endswith(".0"):
+        # Spreadsheets turn codes into numbers
+        code = code[:-2]
+    if code and not (code.isdigit() and len(code) <= 16):
+        raise ImportRowError(f"invalid code {code!r}")
+    return {
+        "name": name, "subcontractor": subcontractor, "job_site": job_site,
+        "clock_in": clock_in, "clock_out": clock_out,
+        "total_time": format_seconds(total_seconds), "working_time": format_seconds(working_seconds),
+        "breaks": breaks_str, "code": code,
+        "flagged": str(row.get("flagged") or "").strip().lower() in ("1", "yes", "true", "y"),
+    }, breaks
+
+def bulk_insert_rows(table, rows):
+    """Insert plain dict rows in the session's transaction: COPY on Postgres, executemany elsewhere"""
+    if not rows:
+        return
+    connection = db.session.connection()
+    if connection.dialect.name != "postgresql":
+        db.session.execute(table.insert(), rows)
+        return
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+        )
+    finally:
+        cursor.close()
+    # COPY bypasses the session hooks that track writes
+    name = DATA_VERSION_TABLES.get(table.name)
+    if name:
+        bump_data_version(name, connection)
+    if table.name == "shift" and _subcontractor_set_changed(connection, added={row["subcontractor"] for row in rows}):
+        bump_data_version(SUBCONTRACTOR_DATA_VERSION, connection)
+
+class TimesheetImport:
+    """State carried across the chunks of one import (per worker and site, not per row)"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.stats = {"rows": 0, "imported": 0, "duplicates": 0, "errors": 0, "workers": 0, "breaks": 0}
+        self.error_samples = []
+        # Shift keys not yet in the database: this chunk's, or every chunk's in a dry run
+        self.seen = set()
+        self.codes = dict(
+            ((name, subcontractor), code)
+            for name, subcontractor, code in db.session.query(WorkerCode.name, WorkerCode.subcontractor, WorkerCode.code)
+        )
+        self.taken_codes = set(self.codes.values())
+        self.taken_codes.update(code for code, in db.session.query(Shift.code).distinct())
+
+    def error(self, line, message):
+        self.stats["errors"] += 1
+        if len(self.error_samples) < IMPORT_ERROR_SAMPLES:
+            self.error_samples.append((line, message))
+
+    def worker_code(self, name, subcontractor, code, new_workers):
+        known = self.codes.get((name, subcontractor))
+        if known:
+            if code and code != known:
+                raise ImportRowError(f"code {code} does not match this worker's code {known}")
+            return known
+        if code in self.taken_codes:
+            raise ImportRowError(f"code {code} already belongs to another worker")
+        while not code:
+            candidate = str(random.randint(100000, 999999))
+            if candidate not in self.taken_codes:
+                code = candidate
+        self.codes[(name, subcontractor)] = code
+        self.taken_codes.add(code)
+        new_workers.append({"name": name, "subcontractor": subcontractor, "code": code})
+        return code
+
+    def add_chunk(self, chunk):
+        """Validate and write one chunk of (line, row) pairs, then commit it"""
+        if not self.dry_run:
+            # Earlier chunks are committed, so the existing-shift query below finds them
+            self.seen.clear()
+        normalized = []
+        for line, row in chunk:
+            self.stats["rows"] += 1
+            try:
+                normalized.append((line, *normalize_timesheet_row(row)))
+            except ImportRowError as e:
+                self.error(line, str(e))
+        existing = set()
+        clock_ins = list({values["clock_in"] for _, values, _ in normalized})
+        for start in range(0, len(clock_ins), 500):
+            existing.update(
+                db.session.query(Shift.name, Shift.subcontractor, Shift.job_site, Shift.clock_in)
+                .filter(Shift.clock_in.in_(clock_ins[start:start + 500]))
+            )
+        shifts, breaks, new_workers = [], [], []
+        manpower, history = {}, {}
+        for line, values, shift_breaks in normalized:
+            key = (values["name"], values["subcontractor"], values["job_site"], values["clock_in"])
+            if key in existing or key in self.seen:
+                self.stats["duplicates"] += 1
+                continue
+            try:
+                values["code"] = self.worker_code(values["name"], values["subcontractor"], values["code"], new_workers)
+            except ImportRowError as e:
+                self.error(line, str(e))
+                continue
+            self.seen.add(key)
+            shifts.append(dict(values, created_at=datetime.utcnow(), qr_batch_id=None))
+            breaks.extend({"shift_code": values["code"], "start": start, "end": end} for start, end in shift_breaks)
+            add_manpower_deltas(
+                manpower, (values["job_site"], values["subcontractor"], values["clock_in"], values["clock_out"]), 1
+            )
+            day = datetime.combine(values["clock_out"].date(), datetime.min.time())
+            first, last, count = history.get((values["subcontractor"], values["job_site"]), (day, day, 0))
+            history[(values["subcontractor"], values["job_site"])] = (min(first, day), max(last, day), count + 1)
+        self.stats["imported"] += len(shifts)
+        self.stats["breaks"] += len(breaks)
+        self.stats["workers"] += len(new_workers)
+        if self.dry_run:
+            return
+        bulk_insert_rows(WorkerCode.__table__, new_workers)
+        if new_workers:
+            directory = WorkerDirectory.__table__
+            db.session.execute(
+                _dialect_insert(directory).on_conflict_do_nothing(
+                    index_elements=[directory.c.name, directory.c.subcontractor, directory.c.code]
+                ),
+                [dict(worker, first_seen=datetime.utcnow()) for worker in new_workers],
+            )
+        bulk_insert_rows(Shift.__table__, shifts)
+        bulk_insert_rows(Break.__table__, breaks)
+        apply_manpower_deltas(manpower)
+        # Project history goes in the chunk's own transaction: a chunk that is
+        # committed, and so skipped as duplicates on a re-run, is already counted
+        for (subcontractor, job_site), (first, last, count) in history.items():
+            row = SubcontractorProjectHistory.query.filter_by(subcontractor=subcontractor, job_site=job_site).first()
+            if row is None:
+                db.session.add(SubcontractorProjectHistory(
+                    subcontractor=subcontractor, job_site=job_site, first_day=first, last_day=last, manpower=count
+                ))
+            else:
+                row.first_day = min(row.first_day, first)
+                row.last_day = max(row.last_day, last)
+                row.manpower = (row.manpower or 0) + count
+        db.session.commit()
+
+    def finish(self):
+        """Bring the clock event log up to date with the imported shifts.
+
+        Runs even when nothing new was imported, so a re-run after an import that
+        stopped part way logs the shifts its committed chunks left behind.
+        """
+        if self.dry_run:
+            return
+        backfill_clock_events()
+
+def import_timesheets(rows, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """Import (line, row) pairs; returns (stats, error samples)"""
+    state = TimesheetImport(dry_run)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        state.add_chunk(chunk)
+    state.finish()
+    return state.stats, state.error_samples
+
+def import_summary_message(stats, dry_run):
+    verb = "Would import" if dry_run else "Imported"
+    return (
+        f"{verb} {stats['imported']} of {stats['rows']} shifts ({stats['breaks']} breaks, "
+        f"{stats['workers']} new workers); {stats['duplicates']} already present, {stats['errors']} rejected."
+    )
+
+@app.route("/admin/import", methods=["POST"])
+def admin_import_timesheets():
+    """Upload a CSV/XLSX of historical shifts (larger files go through the import-timesheets command)"""
+    if not session.get("admin_authenticated"):
+        return redirect(url_for("admin_view"))
+    if (request.content_length or 0) > IMPORT_UPLOAD_MAX_BYTES:
+        flash(
+            f"Files over {IMPORT_UPLOAD_MAX_BYTES // 1024} KB are too large to import here; "
+            "run <code>flask import-timesheets FILE</code> on the server instead.",
+            "error",
+        )
+        return redirect(url_for("admin_view"))
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        flash("Choose a CSV or XLSX file to import.", "error")
+        return redirect(url_for("admin_view"))
+    dry_run = bool(request.form.get("dry_run"))
+    try:
+        stats, errors = import_timesheets(read_timesheet_rows(upload.stream, upload.filename), dry_run)
+    except ImportRowError as e:
+        db.session.rollback()
+        flash(f"Import failed: {escape(str(e))}", "error")
+        return redirect(url_for("admin_view"))
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error importing timesheets: {e}")
+        flash(f"Import stopped by an error; shifts committed so far stay and a re-run skips them. ({escape(str(e))})", "error")
+        return redirect(url_for("admin_view"))
+    flash(import_summary_message(stats, dry_run), "success")
+    if errors:
+        # Messages quote the file's own cells; flashes render as HTML
+        flash("<br>".join(f"Line {line}: {escape(message)}" for line, message in errors[:10]), "error")
+    return redirect(url_for("admin_view"))
+
+@app.cli.command("import-timesheets")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="Validate and count without writing anything.")
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True, help="Rows validated and committed together.")
+def import_timesheets_command(path, dry_run, chunk_size):
+    """Bulk-load historical shifts from a CSV or XLSX file.
+
+    Columns (any order; header names are matched loosely): Name, Subcontractor,
+    Job Site, Clock In, Clock Out, and optionally Breaks, Code, Flagged. Times
+    without a UTC offset are taken as the job site's local time.
+    """
+    db.create_all()
+    started = time.perf_counter()
+    with open(path, "rb") as stream:
+        try:
+            stats, errors = import_timesheets(read_timesheet_rows(stream, path), dry_run, chunk_size)
+        except ImportRowError as e:
+            raise click.ClickException(str(e))
+    for line, message in errors:
+        click.echo(f"  line {line}: {message}")
+    click.echo(f"{import_summary_message(stats, dry_run)} ({time.perf_counter() - started:.1f}s)")
+
+# ---------------------------------------------------------------------------
+# Kiosk page cache
+# ---------------------------------------------------------------------------
+# Kiosks reload / after every punch, yet the page only lists the job sites
+# (fixed in code, so covered by ETAG_SALT) and the subcontractor suggestions.
+# The rendered page is kept per process under the "subcontractors" data version,
+# which is bumped when a subcontractor first appears or loses its last shift (to
+# a delete or a rename) rather than on every punch. Flash
+# messages are spliced in at KIOSK_FLASH_SLOT on the way out, so the cached body
+# never holds one worker's code and a reload with nothing pending can be a 304.
+
+SUBCONTRACTOR_DATA_VERSION = "subcontractors"
+KIOSK_FLASH_SLOT = "<!-- flashes -->"
+OVERDUE_SWEEP_SECONDS = int(os.environ.get("OVERDUE_SWEEP_SECONDS", 60))
+
+_kiosk_lock = threading.Lock()
+_kiosk_page = {"version": None, "body": None}
+_overdue_sweep = {"at": None}
+# Subcontractors this process has seen on a stored shift; punches for them need no check
+_known_subcontractors = set()
+
+def _subcontractor_set_changed(connection, added=(), gone=(), written_ids=()):
+    """Whether a write gave the stored shifts a new subcontractor or took one's last shift.
+
+    added: subcontractors now on the rows written (written_ids, if already in the
+    table); gone: subcontractors those rows had before. Keeps _known_subcontractors
+    in step, so a write that changes neither costs no further query next time.
+    """
+    shift = Shift.__table__
+    changed = False
+    unknown = {name for name in added if name and name not in _known_subcontractors}
+    if unknown:
+        query = db.select(shift.c.subcontractor).distinct().where(shift.c.subcontractor.in_(unknown))
+        if written_ids:
+            query = query.where(shift.c.id.not_in(list(written_ids)))
+        existing = {row[0] for row in connection.execute(query)}
+        _known_subcontractors.update(existing)
+        changed = existing != unknown
+    gone = {name for name in gone if name} - set(added)
+    if gone:
+        remaining = {row[0] for row in connection.execute(
+            db.select(shift.c.subcontractor).distinct().where(shift.c.subcontractor.in_(gone))
+        )}
+        if remaining != gone:
+            changed = True
+            _known_subcontractors.difference_update(gone - remaining)
+    return changed
+
+@event.listens_for(SASession, "after_flush")
+def _bump_subcontractor_version_after_flush(session, flush_context):
+    written = [obj for obj in session.new if isinstance(obj, Shift)]
+    gone = [obj.subcontractor for obj in session.deleted if isinstance(obj, Shift)]
+    for obj in session.dirty:
+        if isinstance(obj, Shift):
+            history = sqlalchemy.inspect(obj).attrs.subcontractor.history
+            if history.has_changes():
+                written.append(obj)
+                gone.extend(history.deleted)
+    if not written and not gone:
+        return
+    connection = session.connection()
+    added = [obj.subcontractor for obj in written]
+    if _subcontractor_set_changed(connection, added, gone, [obj.id for obj in written]):
+        bump_data_version(SUBCONTRACTOR_DATA_VERSION, connection)
+
+def _shift_update_sets_subcontractor(statement):
+    """Whether an UPDATE assigns the subcontractor column (SQLAlchemy keeps .values() privately)"""
+    columns = list(statement._values or {}) + [column for column, _ in statement._ordered_values or ()]
+    return any(getattr(column, "key", column) == "subcontractor" for column in columns)
+
+@event.listens_for(SASession, "do_orm_execute")
+def _bump_subcontractor_version_on_bulk_write(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    statement = orm_execute_state.statement
+    if getattr(getattr(statement, "table", None), "name", None) != "shift":
+        return
+    connection = orm_execute_state.session.connection()
+    if orm_execute_state.is_insert:
+        params = orm_execute_state.parameters
+        rows = params if isinstance(params, (list, tuple)) else [params or {}]
+        if all("subcontractor" in row for row in rows):
+            if _subcontractor_set_changed(connection, added={row["subcontractor"] for row in rows}):
+                bump_data_version(SUBCONTRACTOR_DATA_VERSION, connection)
+            return
+    elif orm_execute_state.is_update and not _shift_update_sets_subcontractor(statement):
+        # Closing, flagging or moving shifts between sites keeps every subcontractor
+        return
+    elif orm_execute_state.is_delete and statement.whereclause is not None:
+        # Only a subcontractor whose last shift is among the deleted rows goes away;
+        # which ones did is checked once the transaction's writes are done
+        shift = Shift.__table__
+        orm_execute_state.session.info.setdefault("subcontractors_gone", set()).update(
+            row[0] for row in connection.execute(
+                db.select(shift.c.subcontractor).distinct().where(statement.whereclause)
+            )
+        )
+        return
+    # Anything else (renames in bulk, inserts without plain values, deleting every
+    # shift) may change the list in ways not worth working out
+    _known_subcontractors.clear()
+    bump_data_version(SUBCONTRACTOR_DATA_VERSION, connection)
+
+@event.listens_for(SASession, "before_commit")
+def _bump_subcontractor_version_after_bulk_delete(session):
+    gone = session.info.pop("subcontractors_gone", None)
+    if gone:
+        connection = session.connection()
+        if _subcontractor_set_changed(connection, gone=gone):
+            bump_data_version(SUBCONTRACTOR_DATA_VERSION, connection)
+
+@event.listens_for(SASession, "after_transaction_end")
+def _forget_subcontractors_gone(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("subcontractors_gone", None)
+
+def sweep_overdue_shifts():
+    """close_overdue_shifts() at most once every OVERDUE_SWEEP_SECONDS per process"""
+    now = time.monotonic()
+    with _kiosk_lock:
+        if _overdue_sweep["at"] is not None and now - _overdue_sweep["at"] < OVERDUE_SWEEP_SECONDS:
+            return
+        _overdue_sweep["at"] = now
+    close_overdue_shifts()
+
+def kiosk_page(version):
+    """Rendered kiosk page (without flashes) for a subcontractors data version"""
+    with _kiosk_lock:
+        if _kiosk_page["version"] == version:
+            return _kiosk_page["body"]
+    if not ensure_tables_exist():
+        raise RuntimeError("tables not available")
+    subcontractors = get_subcontractor_suggestions()
+    body = render_template("index.html", job_sites=JOB_SITES, subcontractors=subcontractors)
+    if not subcontractors:
+        # get_subcontractor_suggestions() answers [] when the read fails: don't keep that
+        return body
+    with _kiosk_lock:
+        current = _kiosk_page["version"]
+        # The list was read after version, so it is never older than it; keep the newest
+        if current is None or version[0] >= current[0]:
+            _kiosk_page.update(version=version, body=body)
+        _known_subcontractors.update(subcontractors)
+    return body
+
+def kiosk_response(body):
+    """A kiosk page with any pending flash messages in place; not stored, they are one-off"""
+    flashes = render_template("flashes.html", messages=get_flashed_messages(with_categories=True))
+    response = app.make_response(body.replace(KIOSK_FLASH_SLOT, flashes, 1))
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+def kiosk_page_response():
+    """GET /: the cached kiosk page, a 304, or the page with this session's flashes"""
+    try:
+        version = get_data_version(SUBCONTRACTOR_DATA_VERSION)
+        body = kiosk_page(version)
+    except Exception as e:
+        print(f"Error loading kiosk page: {e}")
+        db.session.rollback()
+        return kiosk_response(render_template("index.html", job_sites=JOB_SITES, subcontractors=[]))
+    if session.get("_flashes"):
+        return kiosk_response(body)
+    etag = response_etag(version, "kiosk")
+    last_modified = response_last_modified(version)
+    if request_is_fresh(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    return add_cache_validators(app.make_response(body.replace(KIOSK_FLASH_SLOT, "", 1)), etag, last_modified)
+
+@app.cli.command("clear-kiosk-cache")
+def clear_kiosk_cache_command():
+    """Make every process re-render the kiosk page on its next view"""
+    bump_data_version(SUBCONTRACTOR_DATA_VERSION, db.session.connection())
+    db.session.commit()
+    click.echo("Kiosk page cache cleared.")
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,10 @@
+# gunicorn reads this file from the working directory (gunicorn app:app).
+import os
+
+# The admin dashboard keeps a Server-Sent Events request open for up to
+# SSE_STREAM_SECONDS. Threaded workers serve kiosk punches alongside those
+# streams; the default sync worker would be pinned by each open dashboard.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+timeout = 120
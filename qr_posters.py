@@ -0,0 +1,55 @@
+"""QR code and poster rendering for the print pool.
+
+The pool's processes are spawned and import only this module, so it must not
+import app.py (which connects to the database and starts background threads).
+"""
+import io
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+# Letter paper at 150 dpi for the PDF pages
+QR_POSTER_SIZE = (1275, 1650)
+
+def render_qr_png(qr_data):
+    """PNG bytes of a QR code for qr_data"""
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def _poster_font(size):
+    try:
+        return ImageFont.truetype("DejaVuSans-Bold.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+def _draw_centered(draw, y, text, font):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    draw.text(((QR_POSTER_SIZE[0] - (right - left)) // 2, y), text, fill="black", font=font)
+    return y + bottom - top
+
+def render_qr_poster(job):
+    """Render one poster in a pool process.
+
+    job is (job_site, action, qr_url, batch_id, full_page). Returns PNG bytes of
+    the bare QR code, or of a whole printable page when full_page is set.
+    """
+    job_site, action, qr_url, batch_id, full_page = job
+    qr_png = render_qr_png(qr_url)
+    if not full_page:
+        return qr_png
+    page = Image.new("L", QR_POSTER_SIZE, "white")
+    draw = ImageDraw.Draw(page)
+    y = _draw_centered(draw, 120, job_site, _poster_font(64)) + 40
+    y = _draw_centered(draw, y, "CLOCK IN" if action == "clockin" else "CLOCK OUT", _poster_font(96)) + 80
+    qr_img = Image.open(io.BytesIO(qr_png)).convert("L").resize((900, 900), Image.NEAREST)
+    page.paste(qr_img, ((QR_POSTER_SIZE[0] - 900) // 2, y))
+    _draw_centered(draw, y + 960, f"Batch ID: {batch_id}", _poster_font(28))
+    buffer = io.BytesIO()
+    # Fast zlib level: the page is decoded again straight away for the PDF
+    page.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
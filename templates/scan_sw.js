@@ -0,0 +1,69 @@
+// Service worker for the QR scan page. The page shell (one per job site and
+// QR batch) and its assets are served from cache first so the page opens with
+// no signal; punches are queued by the page itself, never here.
+const CACHE = {{ cache_name|tojson }};
+const ASSETS = {{ assets|tojson }};
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(ASSETS)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(
+                names.filter(name => name.startsWith('scan-') && name !== CACHE).map(name => caches.delete(name))
+            ))
+            .then(() => self.clients.claim())
+    );
+});
+
+// /scan?site=..&batch=..&t=.. -> /scan?site=..&batch=.. (t changes on every redirect)
+function shellKey(url) {
+    const key = new URL('/scan', url.origin);
+    key.searchParams.set('site', url.searchParams.get('site') || '');
+    key.searchParams.set('batch', url.searchParams.get('batch') || '');
+    return key.toString();
+}
+
+function refreshShell(request, key) {
+    return fetch(request).then(response => {
+        // no-store marks a page carrying one-off messages (flashes); keep the clean copy
+        if (response.ok && !(response.headers.get('Cache-Control') || '').includes('no-store')) {
+            const copy = response.clone();
+            caches.open(CACHE).then(cache => cache.put(key, copy));
+        }
+        return response;
+    });
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (request.mode === 'navigate' && url.pathname === '/scan') {
+        // Stale-while-revalidate: answer from cache now, refresh it for next time
+        const key = shellKey(url);
+        event.respondWith(caches.match(key).then(cached => {
+            const network = refreshShell(request, key);
+            if (cached) {
+                event.waitUntil(network.catch(() => null));
+                return cached;
+            }
+            return network;
+        }));
+        return;
+    }
+
+    if (url.pathname.startsWith('/static/') || url.pathname === '/scan/manifest.webmanifest') {
+        event.respondWith(caches.match(request).then(cached => cached || fetch(request).then(response => {
+            if (response.ok) {
+                const copy = response.clone();
+                caches.open(CACHE).then(cache => cache.put(request, copy));
+            }
+            return response;
+        })));
+    }
+});
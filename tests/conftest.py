@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py configures itself from the environment at import time, so point it at a
+# scratch database and keep its background threads out of the way first
+_scratch = tempfile.mkdtemp(prefix="shift_logger_tests_")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_scratch, "shifts.db")
+os.environ["WORKER_CACHE_PATH"] = os.path.join(_scratch, "worker_cache.sqlite")
+os.environ["QR_SHEET_DIR"] = os.path.join(_scratch, "qr_sheets")
+os.environ["PUNCH_PIPELINE"] = "0"
+os.environ["OUTBOX_DISPATCH"] = "0"
+os.environ.pop("PROCORE_API_URL", None)
+os.environ.pop("REPLICA_DATABASE_URL", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as shift_logger  # noqa: E402
+
+# QR batch ids are kept in a file next to app.py; keep the tests' ids out of it
+shift_logger.QR_BATCH_FILE = os.path.join(_scratch, "qr_batches.json")
+
+
+@pytest.fixture
+def app_module():
+    """app.py with empty tables and cold in-process caches"""
+    module = shift_logger
+    with module.app.app_context():
+        module.db.session.remove()
+        # The search index lives outside the models, so drop_all leaves it behind
+        for table in ("worker_search_vocab", "worker_search"):
+            module.db.session.execute(module.text(f"DROP TABLE IF EXISTS {table}"))
+        module.db.session.commit()
+        module._worker_search_state.update(ready=False, fts=False)
+        module.db.drop_all()
+        module.db.create_all()
+        module.worker_cache.clear()
+        module._aggregate_cache["version"] = None
+        module._aggregate_cache["entries"].clear()
+        module._occupancy_state.update(snapshot=None, cached_at=0.0)
+        module._kiosk_page.update(version=None, body=None)
+        module._known_subcontractors.clear()
+        module._overdue_sweep["at"] = None
+        yield module
+        module.db.session.remove()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def admin_client(client):
+    with client.session_transaction() as flask_session:
+        flask_session["admin_authenticated"] = True
+    return client
+
+
+@pytest.fixture
+def make_shift(app_module):
+    """Punch a whole shift in and out; returns the closed Shift"""
+    def make_shift(name, subcontractor, job_site, clock_in, clock_out=None):
+        code = app_module.run_punch(app_module.punch_clock_in, name, subcontractor, job_site, clock_in)
+        if clock_out is not None:
+            app_module.run_punch(app_module.punch_clock_out, code, clock_out)
+        return app_module.Shift.query.filter_by(code=code).order_by(app_module.Shift.id.desc()).first()
+    return make_shift
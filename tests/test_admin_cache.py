@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+SITE = "2025 DC water"
+START = datetime(2024, 3, 4, 12)
+
+
+def test_admin_page_is_a_304_until_something_changes(app_module, admin_client, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    first = admin_client.get("/admin")
+    assert first.status_code == 200
+    assert "Ann Lee" in first.get_data(as_text=True)
+    etag = first.headers["ETag"]
+    assert admin_client.get("/admin", headers={"If-None-Match": etag}).status_code == 304
+
+    make_shift("Bob Ray", "Acme", SITE, START, START + timedelta(hours=8))
+    changed = admin_client.get("/admin", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert "Bob Ray" in changed.get_data(as_text=True)
+
+
+def test_filters_get_their_own_etag(app_module, admin_client):
+    everything = admin_client.get("/admin").headers["ETag"]
+    filtered = admin_client.get("/admin", query_string={"subcontractor": "Acme"}).headers["ETag"]
+    assert everything != filtered
+
+
+def test_exports_answer_conditional_gets(app_module, admin_client, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    for url in ("/admin/export", "/admin/timesheets?start=2024-03-04&end=2024-03-10"):
+        response = admin_client.get(url)
+        assert response.status_code == 200
+        again = admin_client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+        assert again.status_code == 304
+        since = admin_client.get(url, headers={"If-Modified-Since": response.headers["Last-Modified"]})
+        assert since.status_code == 304
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+SITE = "2025 DC water"
+OTHER_SITE = "DC Water Projects"
+START = datetime(2024, 3, 4, 12)
+
+
+def _kinds(app_module):
+    return sorted((row.shift_id, row.kind) for row in app_module.ShiftAnomaly.query.all())
+
+
+def _copy_shift(app_module, shift, job_site, clock_in, clock_out):
+    """A second shift on the same code, as an admin edit or an import can leave"""
+    copy = app_module.Shift(name=shift.name, subcontractor=shift.subcontractor, code=shift.code,
+                            job_site=job_site, clock_in=clock_in, clock_out=clock_out)
+    app_module.db.session.add(copy)
+    app_module.db.session.commit()
+    return copy
+
+
+def test_overlapping_and_short_shifts_are_found(app_module, make_shift):
+    ann = make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    copy = _copy_shift(app_module, ann, SITE, START + timedelta(hours=1), START + timedelta(hours=1, minutes=2))
+    checked, found = app_module.detect_anomalies(since=START.date(), until=START.date())
+    assert checked == 2
+    assert _kinds(app_module) == [(ann.id, "overlap"), (copy.id, "overlap"), (copy.id, "short_shift")]
+
+
+def test_two_sites_within_the_gap(app_module, make_shift):
+    ann = make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=4))
+    copy = _copy_shift(app_module, ann, OTHER_SITE, START + timedelta(hours=4, minutes=5), START + timedelta(hours=8))
+    app_module.detect_anomalies(since=START.date())
+    assert _kinds(app_module) == [(ann.id, "two_sites"), (copy.id, "two_sites")]
+
+
+def test_incremental_run_rechecks_only_new_events(app_module, make_shift, monkeypatch):
+    monkeypatch.setattr(app_module, "ANOMALY_SETTLE_SECONDS", -60)
+    make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(minutes=2))
+    assert app_module.detect_anomalies() == (1, 1)
+    assert app_module.detect_anomalies() == (0, 0)
+    assert len(_kinds(app_module)) == 1
+
+    make_shift("Bob Ray", "Acme", SITE, START, START + timedelta(hours=8))
+    assert app_module.detect_anomalies() == (1, 0)
+    # A clean recheck clears an old flag
+    shift = app_module.Shift.query.filter_by(name="Ann Lee").one()
+    app_module.bulk_shift_action("delete", [shift.id])
+    app_module.detect_anomalies()
+    assert _kinds(app_module) == []
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+SITE = "2025 DC water"
+OTHER_SITE = "DC Water Projects"
+
+
+def _occupancy(app_module):
+    return {(row.job_site, row.subcontractor): row.on_site for row in app_module.SiteOccupancy.query.all()}
+
+
+def test_close_only_touches_open_shifts(app_module, make_shift):
+    now = datetime.now()
+    open_shift = make_shift("Ann Lee", "Acme", SITE, now - timedelta(hours=3))
+    app_module.run_punch(app_module.punch_break_start, open_shift.code, now - timedelta(hours=2))
+    app_module.run_punch(app_module.punch_break_end, open_shift.code, now - timedelta(hours=1, minutes=30))
+    closed = make_shift("Bob Ray", "Acme", SITE, now - timedelta(hours=3), now - timedelta(hours=1))
+    summary = app_module.bulk_shift_action("close", [open_shift.id, closed.id])
+    assert (summary["requested"], summary["shifts"]) == (2, 1)
+    app_module.db.session.expire_all()
+    shift = app_module.Shift.query.get(open_shift.id)
+    assert shift.clock_out is not None
+    assert shift.working_time == "2h 30m"
+    assert _occupancy(app_module) == {(SITE, "Acme"): 0}
+    assert app_module.ClockEvent.query.filter_by(kind="admin_edit", shift_id=open_shift.id).count() == 1
+
+
+def test_delete_removes_the_shift_and_only_its_breaks(app_module, make_shift):
+    start = datetime(2024, 3, 4, 12)
+    first = make_shift("Ann Lee", "Acme", SITE, start)
+    app_module.run_punch(app_module.punch_break_start, first.code, start + timedelta(hours=1))
+    app_module.run_punch(app_module.punch_break_end, first.code, start + timedelta(hours=2))
+    app_module.run_punch(app_module.punch_clock_out, first.code, start + timedelta(hours=4))
+    second = make_shift("Ann Lee", "Acme", SITE, start + timedelta(days=1))
+    app_module.run_punch(app_module.punch_break_start, second.code, start + timedelta(days=1, hours=1))
+    summary = app_module.bulk_shift_action("delete", [first.id])
+    assert (summary["shifts"], summary["breaks"]) == (1, 1)
+    assert [s.id for s in app_module.Shift.query.all()] == [second.id]
+    assert app_module.Break.query.count() == 1
+
+
+def test_reassign_moves_occupancy_and_the_heatmap(app_module, make_shift):
+    now = datetime.now()
+    shift = make_shift("Ann Lee", "Acme", SITE, now - timedelta(hours=1))
+    done = make_shift("Bob Ray", "Acme", SITE, now - timedelta(hours=5), now - timedelta(hours=3))
+    app_module.bulk_shift_action("reassign", [shift.id, done.id], OTHER_SITE)
+    assert {s.job_site for s in app_module.Shift.query.all()} == {OTHER_SITE}
+    assert _occupancy(app_module) == {(SITE, "Acme"): 0, (OTHER_SITE, "Acme"): 1}
+    sites = {cell.job_site for cell in app_module.ManpowerHour.query.filter(app_module.ManpowerHour.shifts > 0)}
+    assert sites == {OTHER_SITE}
+
+
+def test_bad_requests_change_nothing(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime.now() - timedelta(hours=1))
+    with pytest.raises(ValueError):
+        app_module.bulk_shift_action("archive", [shift.id])
+    with pytest.raises(ValueError):
+        app_module.bulk_shift_action("reassign", [shift.id], "Nowhere")
+    assert app_module.Shift.query.one().job_site == SITE
+
+
+def test_bulk_route_flags_and_answers_json(app_module, admin_client, make_shift):
+    start = datetime(2024, 3, 4, 12)
+    shift = make_shift("Ann Lee", "Acme", SITE, start, start + timedelta(hours=8))
+    response = admin_client.post("/admin/shifts/bulk", data={"action": "flag", "shift_ids": [shift.id, 999]},
+                                 headers={"Accept": "application/json"})
+    assert response.get_json()["shifts"] == 1
+    assert "1 selected shift(s) were skipped" in response.get_json()["message"]
+    assert app_module.Shift.query.one().flagged
+    empty = admin_client.post("/admin/shifts/bulk", data={"action": "flag"}, headers={"Accept": "application/json"})
+    assert empty.status_code == 400
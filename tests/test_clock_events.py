@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+SITE = "2025 DC water"
+
+
+def _legacy_shift(app_module, clock_in):
+    """An open shift written before the event log existed"""
+    db = app_module.db
+    code = app_module.get_or_create_code("Old Timer", "Acme")
+    shift = app_module.Shift(name="Old Timer", subcontractor="Acme", job_site=SITE, clock_in=clock_in, code=code)
+    db.session.add(shift)
+    db.session.commit()
+    return shift
+
+
+def test_replay_reproduces_punched_shifts(app_module, make_shift):
+    start = datetime(2024, 3, 4, 12)
+    shift = make_shift("Ann Lee", "Acme", SITE, start)
+    app_module.run_punch(app_module.punch_break_start, shift.code, start + timedelta(hours=3))
+    app_module.run_punch(app_module.punch_break_end, shift.code, start + timedelta(hours=3, minutes=30))
+    app_module.run_punch(app_module.punch_clock_out, shift.code, start + timedelta(hours=8))
+    assert app_module.rebuild_clock_projections(dry_run=True) == (4, 0, 0, 0)
+    assert app_module.rebuild_clock_projections() == (4, 0, 0, 0)
+    rebuilt = app_module.Shift.query.one()
+    assert (rebuilt.working_time, rebuilt.clock_out) == ("7h 30m", start + timedelta(hours=8))
+
+
+def test_backfilled_shift_replays_to_itself(app_module):
+    _legacy_shift(app_module, datetime(2024, 3, 4, 12))
+    assert app_module.backfill_clock_events() == (1, 0)
+    assert app_module.backfill_clock_events() == (0, 0)
+    assert app_module.rebuild_clock_projections(dry_run=True) == (1, 0, 0, 0)
+
+
+def test_shift_history_lists_its_events(app_module, admin_client, make_shift):
+    start = datetime(2024, 3, 4, 12)
+    shift = make_shift("Ann Lee", "Acme", SITE, start, start + timedelta(hours=8))
+    events = admin_client.get(f"/admin/shift/{shift.id}/events").get_json()["events"]
+    assert [event["kind"] for event in events] == ["clockin", "clockout"]
+
+
+def test_rebuild_refuses_rows_that_were_never_backfilled(app_module):
+    _legacy_shift(app_module, datetime(2024, 3, 4, 12))
+    with pytest.raises(app_module.ClockReplayError, match="backfill-clock-events"):
+        app_module.rebuild_clock_projections()
+    assert app_module.Shift.query.count() == 1
+
+
+def test_late_backfill_replays_in_time_order(app_module):
+    # Punches on an old shift are logged before the shift itself is backfilled,
+    # so its clockin event has the highest id
+    start = datetime(2024, 3, 4, 12)
+    shift = _legacy_shift(app_module, start)
+    app_module.run_punch(app_module.punch_break_start, shift.code, start + timedelta(hours=2))
+    app_module.run_punch(app_module.punch_break_end, shift.code, start + timedelta(hours=2, minutes=15))
+    app_module.run_punch(app_module.punch_clock_out, shift.code, start + timedelta(hours=8))
+    assert app_module.backfill_clock_events() == (1, 0)
+    assert app_module.rebuild_clock_projections(dry_run=True) == (4, 0, 0, 0)
+
+
+def test_rebuild_aborts_when_events_cannot_be_replayed(app_module, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 12), datetime(2024, 3, 4, 20))
+    app_module.db.session.add(app_module.ClockEvent(
+        kind="clockout", shift_id=999, code="000000", occurred_at=datetime(2024, 3, 5, 20),
+        recorded_at=datetime(2024, 3, 5, 20),
+    ))
+    app_module.db.session.commit()
+    with pytest.raises(app_module.ClockReplayError, match="1 of 3 events"):
+        app_module.rebuild_clock_projections()
+    assert app_module.Shift.query.count() == 1
+    assert app_module.rebuild_clock_projections(force=True)[:2] == (2, 1)
+
+
+def test_rebuild_command_reports_refusal(app_module):
+    _legacy_shift(app_module, datetime(2024, 3, 4, 12))
+    result = app_module.app.test_cli_runner().invoke(args=["rebuild-shifts"])
+    assert result.exit_code != 0
+    assert "have no clock events" in result.output
+
+
+def test_replay_keeps_the_totals_worked_out_at_the_time(app_module, make_shift, monkeypatch):
+    start = datetime(2024, 3, 4, 12)
+    make_shift("Ann Lee", "Acme", SITE, start, start + timedelta(hours=8))
+    bulk = make_shift("Bob Ray", "Acme", SITE, datetime.now() - timedelta(hours=2))
+    app_module.bulk_shift_action("close", [bulk.id])
+    # The rules change after the punches were logged
+    monkeypatch.setattr(app_module, "shift_totals", lambda clock_in, clock_out, breaks: (60, 60, "changed"))
+    assert app_module.rebuild_clock_projections(dry_run=True)[2:] == (0, 0)
+
+
+def test_benchmark_cleanup_appends_to_the_log(app_module, make_shift):
+    start = datetime(2024, 3, 4, 12)
+    make_shift("Ann Lee", "Acme", SITE, start, start + timedelta(hours=8))
+    make_shift("Bench 1", app_module.BENCHMARK_SUBCONTRACTOR, SITE, start, start + timedelta(hours=1))
+    logged = app_module.ClockEvent.query.count()
+    app_module.delete_benchmark_punches()
+    assert app_module.ClockEvent.query.count() == logged + 1
+    assert [shift.name for shift in app_module.Shift.query] == ["Ann Lee"]
+    assert app_module.rebuild_clock_projections(dry_run=True)[1:] == (0, 0, 0)
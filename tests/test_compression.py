@@ -0,0 +1,40 @@
+import gzip
+
+from flask import Response
+
+
+def _after_request(app_module, response):
+    with app_module.app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+        return app_module.cache_and_compress(response)
+
+
+def test_event_stream_is_never_compressed(app_module):
+    response = _after_request(app_module, Response(iter(["data: 1\n\n"]), mimetype="text/event-stream"))
+    assert "Content-Encoding" not in response.headers
+
+
+def test_streamed_csv_is_compressed_whatever_its_size(app_module):
+    response = _after_request(app_module, Response(iter(["a,b\n", "1,2\n"]), mimetype="text/csv"))
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(b"".join(response.response)) == b"a,b\n1,2\n"
+
+
+def test_small_buffered_body_is_left_alone(app_module):
+    response = _after_request(app_module, Response("{}", mimetype="application/json"))
+    assert "Content-Encoding" not in response.headers
+
+
+def test_large_buffered_body_is_compressed(app_module):
+    body = "x" * (app_module.COMPRESS_MIN_BYTES + 1)
+    response = _after_request(app_module, Response(body, mimetype="text/html"))
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()).decode() == body
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+
+def test_fingerprinted_static_urls_are_immutable(app_module, client):
+    with app_module.app.test_request_context("/"):
+        url = app_module.url_for("static", filename="style.css")
+    assert "?v=" in url
+    assert "immutable" in client.get(url).headers["Cache-Control"]
+    assert "immutable" not in client.get("/static/style.css?v=stale").headers.get("Cache-Control", "")
@@ -0,0 +1,54 @@
+import json
+
+SITE = "2025 DC water"
+
+
+def _stream(admin_client, count, **headers):
+    response = admin_client.get("/admin/events", headers=headers, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    chunks = response.response
+    try:
+        return [_as_text(next(chunks)) for _ in range(count)]
+    finally:
+        response.close()
+
+
+def _as_text(chunk):
+    return chunk.decode() if isinstance(chunk, bytes) else chunk
+
+
+def _clock_in(client, name):
+    client.post("/", data={"action": "clockin", "name": name, "subcontractor": "Acme", "job_site": SITE})
+
+
+def test_stream_replays_missed_events(app_module, admin_client, monkeypatch):
+    monkeypatch.setattr(app_module, "SSE_HEARTBEAT_SECONDS", 0.1)
+    _clock_in(admin_client, "Ann Lee")
+    retry, event = _stream(admin_client, 2)
+    assert retry == "retry: 3000\n\n"
+    lines = dict(line.split(": ", 1) for line in event.strip().splitlines())
+    assert lines["event"] == "clockin"
+    assert json.loads(lines["data"])["on_site_delta"] == 1
+
+
+def test_reconnect_resumes_after_last_event_id(app_module, admin_client, monkeypatch):
+    monkeypatch.setattr(app_module, "SSE_HEARTBEAT_SECONDS", 0.1)
+    _clock_in(admin_client, "Ann Lee")
+    first_id = app_module.latest_dashboard_event_id()
+    code = app_module.WorkerCode.query.filter_by(name="Ann Lee").one().code
+    admin_client.post("/", data={"action": "clockout", "input_code": code})
+    _, event = _stream(admin_client, 2, **{"Last-Event-ID": str(first_id)})
+    assert event.startswith(f"id: {first_id + 1}\nevent: clockout")
+
+
+def test_stream_needs_a_login(app_module, client):
+    assert client.get("/admin/events").status_code == 403
+
+
+def test_sync_gunicorn_worker_gets_short_polls(app_module, admin_client):
+    _clock_in(admin_client, "Ann Lee")
+    response = admin_client.get("/admin/events", environ_overrides={
+        "SERVER_SOFTWARE": "gunicorn/20.1.0", "wsgi.multithread": False})
+    body = response.get_data(as_text=True)
+    assert body.startswith(f"retry: {int(app_module.SSE_SHORT_POLL_SECONDS * 1000)}\n\n")
+    assert "event: clockin" in body
@@ -0,0 +1,48 @@
+from datetime import datetime
+
+SITE = "2025 DC water"  # America/New_York
+URL = f"/api/heatmap?site={SITE}&start=2024-03-04&end=2024-03-04"
+
+
+def test_closed_shift_fills_site_local_hours(admin_client, make_shift):
+    # 08:30-11:00 local
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 13, 30), datetime(2024, 3, 4, 16))
+    [day] = admin_client.get(URL).get_json()["days"]
+    assert day["headcount"][8] == 0.5
+    assert day["headcount"][9] == day["headcount"][10] == 1.0
+    assert day["headcount"][11] == 0
+
+
+def test_heatmap_revalidates_after_a_rebuild(app_module, admin_client, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 13), datetime(2024, 3, 4, 16))
+    etag = admin_client.get(URL).headers["ETag"]
+    assert admin_client.get(URL, headers={"If-None-Match": etag}).status_code == 304
+    app_module.db.session.execute(app_module.ManpowerHour.__table__.delete())
+    app_module.db.session.commit()
+    app_module.rebuild_manpower_hours()
+    assert admin_client.get(URL, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_clock_in_alone_keeps_the_heatmap_fresh(app_module, admin_client, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 13), datetime(2024, 3, 4, 16))
+    etag = admin_client.get(URL).headers["ETag"]
+    make_shift("Bob Ray", "Acme", SITE, datetime(2024, 3, 5, 13))
+    assert admin_client.get(URL, headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_benchmark_cleanup_removes_its_cube_cells(app_module, make_shift):
+    make_shift("Benchmark 0 0", app_module.BENCHMARK_SUBCONTRACTOR, SITE, datetime(2024, 3, 4, 13), datetime(2024, 3, 4, 16))
+    assert app_module.ManpowerHour.query.count() == 3
+    app_module.delete_benchmark_punches()
+    assert app_module.ManpowerHour.query.count() == 0
+
+
+def test_table_route_only_creates_the_table(app_module, client, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 13), datetime(2024, 3, 4, 16))
+    app_module.db.session.execute(app_module.ManpowerHour.__table__.delete())
+    app_module.db.session.commit()
+    assert client.get("/add_manpower_hour_table").status_code == 200
+    assert app_module.ManpowerHour.query.count() == 0
+    result = app_module.app.test_cli_runner().invoke(args=["rebuild-heatmap"])
+    assert result.exit_code == 0
+    assert app_module.ManpowerHour.query.count() == 3
@@ -0,0 +1,108 @@
+import io
+
+SITE = "2025 DC water"
+HEADER = "Name,Subcontractor,Job Site,Clock In,Clock Out,Breaks\n"
+ROWS = [
+    f"Ann Lee,Acme,{SITE},2024-03-04 07:00 AM,2024-03-04 03:30 PM,12:00 PM - 12:30 PM\n",
+    f"Bob Ray,Acme,{SITE},2024-03-04 07:15 AM,2024-03-04 03:15 PM,\n",
+    # Same shift again, in the next chunk
+    f"Ann Lee,Acme,{SITE},2024-03-04 07:00 AM,2024-03-04 03:30 PM,12:00 PM - 12:30 PM\n",
+    "Cy Dow,Acme,Nowhere,2024-03-04 07:00 AM,2024-03-04 03:00 PM,\n",
+    f"Cy Dow,Beta Co,{SITE},2024-03-05 06:00 AM,2024-03-05 02:00 PM,\n",
+]
+
+
+def _import(app_module, rows=ROWS, dry_run=False, chunk_size=2):
+    stream = io.BytesIO((HEADER + "".join(rows)).encode("utf-8"))
+    return app_module.import_timesheets(app_module.read_timesheet_rows(stream, "old.csv"), dry_run, chunk_size)
+
+
+def _cube(app_module):
+    hour = app_module.ManpowerHour
+    return sorted(
+        (cell.job_site, cell.subcontractor, cell.local_date, cell.hour, cell.person_seconds, cell.shifts)
+        for cell in hour.query.all()
+    )
+
+
+def test_import_skips_duplicates_and_reports_bad_rows(app_module):
+    stats, errors = _import(app_module)
+    assert (stats["rows"], stats["imported"], stats["duplicates"], stats["errors"]) == (5, 3, 1, 1)
+    assert (stats["workers"], stats["breaks"]) == (3, 1)
+    assert errors == [(5, "unknown job site 'Nowhere'")]
+    ann = app_module.Shift.query.filter_by(name="Ann Lee").one()
+    assert (ann.total_time, ann.working_time) == ("8h 30m", "8h 0m")
+
+    stats, _ = _import(app_module)
+    assert (stats["imported"], stats["duplicates"]) == (0, 4)
+    assert app_module.Shift.query.count() == 3
+
+
+def test_dry_run_counts_the_same_and_writes_nothing(app_module):
+    stats, errors = _import(app_module, dry_run=True)
+    assert (stats["imported"], stats["duplicates"], stats["errors"]) == (3, 1, 1)
+    assert app_module.Shift.query.count() == 0
+    assert app_module.WorkerCode.query.count() == 0
+    assert _cube(app_module) == []
+
+
+def test_only_the_current_chunk_is_kept_in_memory(app_module):
+    state = app_module.TimesheetImport()
+    rows = list(app_module.read_timesheet_rows(io.BytesIO((HEADER + "".join(ROWS)).encode()), "old.csv"))
+    state.add_chunk(rows[:2])
+    state.add_chunk(rows[2:])
+    # The repeat of Ann's shift was found in the database, not in memory
+    assert state.stats["duplicates"] == 1
+    assert len(state.seen) == 1
+    assert _cube(app_module)
+
+
+def test_manpower_cube_matches_a_rebuild(app_module):
+    _import(app_module)
+    imported = _cube(app_module)
+    app_module.rebuild_manpower_hours()
+    app_module.db.session.commit()
+    assert imported == _cube(app_module)
+
+
+def test_admin_upload(admin_client, app_module):
+    data = {"file": (io.BytesIO((HEADER + ROWS[0]).encode()), "old.csv")}
+    response = admin_client.post("/admin/import", data=data, content_type="multipart/form-data",
+                                 follow_redirects=True)
+    assert b"Imported 1 of 1 shifts" in response.data
+    assert app_module.Shift.query.count() == 1
+
+
+def test_rerun_after_a_failed_chunk_completes_derived_data(app_module, monkeypatch):
+    apply_deltas = app_module.apply_manpower_deltas
+    calls = []
+
+    def fail_second_chunk(deltas):
+        calls.append(deltas)
+        if len(calls) == 2:
+            raise RuntimeError("connection lost")
+        apply_deltas(deltas)
+
+    monkeypatch.setattr(app_module, "apply_manpower_deltas", fail_second_chunk)
+    try:
+        _import(app_module)
+    except RuntimeError:
+        app_module.db.session.rollback()
+    monkeypatch.setattr(app_module, "apply_manpower_deltas", apply_deltas)
+    assert app_module.Shift.query.count() == 2
+
+    stats, _ = _import(app_module)
+    assert (stats["imported"], stats["duplicates"]) == (1, 3)
+    history = app_module.SubcontractorProjectHistory.query.filter_by(subcontractor="Acme", job_site=SITE).one()
+    assert history.manpower == 2
+    logged = {event.shift_id for event in app_module.ClockEvent.query.filter_by(kind="clockin")}
+    assert logged == {shift.id for shift in app_module.Shift.query}
+
+
+def test_large_upload_is_sent_to_the_command(admin_client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "IMPORT_UPLOAD_MAX_BYTES", 100)
+    data = {"file": (io.BytesIO((HEADER + "".join(ROWS)).encode()), "old.csv")}
+    response = admin_client.post("/admin/import", data=data, content_type="multipart/form-data",
+                                 follow_redirects=True)
+    assert b"flask import-timesheets" in response.data
+    assert app_module.Shift.query.count() == 0
@@ -0,0 +1,68 @@
+from datetime import datetime
+
+SITE = "2025 DC water"
+
+
+def _clock_in(client, name, subcontractor, **extra):
+    return client.post("/", data={"action": "clockin", "name": name, "subcontractor": subcontractor,
+                                  "job_site": SITE, **extra})
+
+
+def test_reload_without_flashes_is_a_304(app_module, client):
+    first = client.get("/")
+    assert first.status_code == 200
+    assert first.headers["ETag"]
+    again = client.get("/", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+
+
+def test_flashes_are_spliced_into_the_cached_page(app_module, client):
+    etag = client.get("/").headers["ETag"]
+    assert _clock_in(client, "Ann Lee", "Acme", confirm_new="1").status_code == 302
+    page = client.get("/", headers={"If-None-Match": etag})
+    assert page.status_code == 200
+    assert "Your code is" in page.get_data(as_text=True)
+    assert page.headers["Cache-Control"] == "no-store"
+    # The new subcontractor changed the page, so the old copy is stale
+    later = client.get("/", headers={"If-None-Match": etag})
+    assert later.status_code == 200
+    assert "Your code is" not in later.get_data(as_text=True)
+    assert "Acme" in later.get_data(as_text=True)
+
+
+def _version(app_module):
+    return app_module.get_data_version(app_module.SUBCONTRACTOR_DATA_VERSION)[0]
+
+
+def _shifts(make_shift, *subcontractors):
+    start = datetime(2024, 3, 4, 12)
+    return [make_shift(f"Worker {n}", subcontractor, SITE, start, start.replace(hour=20))
+            for n, subcontractor in enumerate(subcontractors)]
+
+
+def test_deleting_a_shift_keeps_the_page_while_its_subcontractor_has_others(app_module, make_shift):
+    first, second, other = _shifts(make_shift, "Acme", "Acme", "Beta Co")
+    version = _version(app_module)
+    app_module.db.session.delete(app_module.db.session.get(app_module.Shift, first.id))
+    app_module.db.session.commit()
+    app_module.bulk_shift_action("flag", [second.id])
+    app_module.db.session.commit()
+    assert _version(app_module) == version
+    assert "Acme" in app_module._known_subcontractors
+    app_module.bulk_shift_action("delete", [second.id])
+    app_module.db.session.commit()
+    assert _version(app_module) > version
+    assert "Acme" not in app_module._known_subcontractors
+
+
+def test_renaming_bumps_only_when_a_subcontractor_appears_or_goes(app_module, make_shift):
+    first, second = _shifts(make_shift, "Acme", "Acme")
+    version = _version(app_module)
+    app_module.db.session.get(app_module.Shift, first.id).subcontractor = "Beta Co"
+    app_module.db.session.commit()
+    assert _version(app_module) > version
+    version = _version(app_module)
+    app_module.db.session.get(app_module.Shift, second.id).subcontractor = "Beta Co"
+    app_module.db.session.commit()
+    assert _version(app_module) > version
+    assert "Acme" not in app_module._known_subcontractors
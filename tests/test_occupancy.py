@@ -0,0 +1,56 @@
+SITE = "2025 DC water"
+
+
+def _counts(app_module):
+    return {
+        (row.job_site, row.subcontractor): row.on_site
+        for row in app_module.SiteOccupancy.query.all()
+    }
+
+
+def _clock_in(client, name, subcontractor="Acme"):
+    client.post("/", data={"action": "clockin", "name": name, "subcontractor": subcontractor, "job_site": SITE})
+
+
+def _clock_out(app_module, client, name, subcontractor="Acme"):
+    code = app_module.WorkerCode.query.filter_by(name=name, subcontractor=subcontractor).one().code
+    client.post("/", data={"action": "clockout", "input_code": code})
+
+
+def test_punches_move_the_counters(app_module, client):
+    _clock_in(client, "Ann Lee")
+    _clock_in(client, "Bob Ray")
+    assert _counts(app_module) == {(SITE, "Acme"): 2}
+    _clock_out(app_module, client, "Ann Lee")
+    assert _counts(app_module) == {(SITE, "Acme"): 1}
+
+    snapshot = client.get("/api/occupancy", query_string={"job_site": SITE}).get_json()
+    assert snapshot["total"] == 1
+    assert snapshot["sites"][SITE]["subcontractors"] == {"Acme": 1}
+
+
+def test_reconcile_repairs_drifted_counters(app_module, client):
+    _clock_in(client, "Ann Lee")
+    app_module.adjust_occupancy(SITE, "Acme", 5)
+    app_module.adjust_occupancy(SITE, "Gone Co", 1)
+    app_module.db.session.commit()
+    result = app_module.app.test_cli_runner().invoke(args=["reconcile-occupancy"])
+    assert result.exit_code == 0
+    assert _counts(app_module) == {(SITE, "Acme"): 1, (SITE, "Gone Co"): 0}
+
+
+def test_reconcile_adds_missing_counters_and_the_poll_leaves_them_alone(app_module, client):
+    _clock_in(client, "Ann Lee")
+    app_module.SiteOccupancy.query.delete()
+    app_module.db.session.commit()
+    assert client.get("/api/occupancy").get_json()["total"] == 0
+    assert _counts(app_module) == {}
+    app_module.reconcile_occupancy()
+    assert _counts(app_module) == {(SITE, "Acme"): 1}
+
+
+def test_counters_never_go_negative(app_module):
+    app_module.adjust_occupancy(SITE, "Acme", -1)
+    app_module.adjust_occupancy(SITE, "Acme", -1)
+    app_module.db.session.commit()
+    assert _counts(app_module) == {(SITE, "Acme"): 0}
@@ -0,0 +1,64 @@
+import hashlib
+
+SITE = "2025 DC water"
+SITE_ID = hashlib.md5(SITE.encode()).hexdigest()[:8]
+
+
+def _punch(client, key, delay_ms, **fields):
+    return client.post("/api/punch", json={
+        "key": key, "site": SITE_ID, "batch": "batch-1", "occurred_at": 1_000_000, "sent_at": 1_000_000 + delay_ms,
+        **fields,
+    })
+
+
+def test_prompt_punch_is_not_flagged(app_module, client):
+    response = _punch(client, "k1", 1500, action="clockin", name="Ann Lee", subcontractor="Acme")
+    assert response.status_code == 200
+    assert app_module.Shift.query.one().flagged is False
+
+
+def test_queued_clock_in_is_backdated_and_flagged(app_module, client):
+    response = _punch(client, "k1", 20 * 60 * 1000, action="clockin", name="Ann Lee", subcontractor="Acme")
+    assert response.status_code == 200
+    shift = app_module.Shift.query.one()
+    assert shift.flagged is True
+    assert (shift.created_at - shift.clock_in).total_seconds() > 20 * 60 - 60
+
+
+def test_queued_clock_out_is_flagged_and_reported(app_module, client):
+    code = _punch(client, "k1", 20 * 60 * 1000, action="clockin", name="Ann Lee", subcontractor="Acme").get_json()["code"]
+    app_module.Shift.query.one().flagged = False
+    app_module.db.session.commit()
+    assert _punch(client, "k2", 10 * 60 * 1000, action="clockout", code=code).status_code == 200
+    shift = app_module.Shift.query.one()
+    assert shift.flagged is True
+    app_module.detect_anomalies()
+    assert [a.kind for a in app_module.ShiftAnomaly.query] == ["offline_punch"]
+    assert app_module.rebuild_clock_projections(dry_run=True)[1:] == (0, 0, 0)
+
+
+def test_resent_punch_is_applied_once(app_module, client):
+    first = _punch(client, "k1", 0, action="clockin", name="Ann Lee", subcontractor="Acme").get_json()
+    again = _punch(client, "k1", 5000, action="clockin", name="Ann Lee", subcontractor="Acme").get_json()
+    assert (again["code"], again["replayed"]) == (first["code"], True)
+    assert app_module.Shift.query.count() == 1
+
+
+def test_punch_older_than_the_limit_is_refused(app_module, client):
+    delay = (app_module.PUNCH_OFFLINE_MAX_MINUTES + 1) * 60 * 1000
+    assert _punch(client, "k1", delay, action="clockin", name="Ann Lee", subcontractor="Acme").status_code == 409
+
+
+def test_queued_clock_out_before_the_clock_in_is_refused(app_module, client):
+    code = _punch(client, "k1", 0, action="clockin", name="Ann Lee", subcontractor="Acme").get_json()["code"]
+    response = _punch(client, "k2", 10 * 60 * 1000, action="clockout", code=code)
+    assert response.status_code == 409
+    assert app_module.Shift.query.one().clock_out is None
+
+
+def test_key_reused_for_a_different_punch_is_refused(app_module, client):
+    code = _punch(client, "k1", 0, action="clockin", name="Ann Lee", subcontractor="Acme").get_json()["code"]
+    response = _punch(client, "k1", 0, action="clockout", code=code)
+    assert response.status_code == 422
+    assert _punch(client, "k1", 0, action="clockin", name="Bob Ray", subcontractor="Acme").status_code == 422
+    assert app_module.Shift.query.one().clock_out is None
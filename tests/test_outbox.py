@@ -0,0 +1,151 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+SITE = "2025 DC water"
+START = datetime(2024, 3, 4, 12)
+
+
+@pytest.fixture
+def stub(app_module, monkeypatch):
+    server = app_module.outbox_stub_server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(app_module, "PROCORE_API_URL", f"http://127.0.0.1:{server.server_port}/timecards")
+    monkeypatch.setattr(app_module, "PROCORE_API_TOKEN", None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatcher(app_module):
+    dispatcher = app_module.OutboxDispatcher()
+    dispatcher.limiter = app_module.RateLimiter(0)
+    return dispatcher
+
+
+def _closed_shifts(make_shift, count):
+    return [
+        make_shift(f"Worker {i}", "Acme", SITE, START + timedelta(minutes=i), START + timedelta(hours=8))
+        for i in range(count)
+    ]
+
+
+def _messages(app_module):
+    app_module.db.session.expire_all()
+    return app_module.OutboxMessage.query.order_by(app_module.OutboxMessage.id).all()
+
+
+def _make_due(app_module):
+    app_module.OutboxMessage.query.update({"next_attempt_at": datetime.utcnow()})
+    app_module.db.session.commit()
+
+
+def test_each_timecard_is_sent_once(app_module, stub, dispatcher, make_shift):
+    _closed_shifts(make_shift, 3)
+    assert dispatcher.dispatch_once() == 3
+    assert dispatcher.dispatch_once() == 0
+    assert [m.status for m in _messages(app_module)] == ["sent"] * 3
+    assert (stub.stats["requests"], stub.stats["timecards"], stub.stats["duplicates"]) == (1, 3, 0)
+
+
+def test_unavailable_api_is_retried_later(app_module, stub, dispatcher, make_shift):
+    _closed_shifts(make_shift, 1)
+    stub.options["fail_rate"] = 1.0
+    dispatcher.dispatch_once()
+    message, = _messages(app_module)
+    assert (message.status, message.attempts, message.last_error) == ("pending", 1, "HTTP 503")
+    assert message.next_attempt_at > datetime.utcnow()
+    assert dispatcher.dispatch_once() == 0
+
+    stub.options["fail_rate"] = 0.0
+    _make_due(app_module)
+    assert dispatcher.dispatch_once() == 1
+    message, = _messages(app_module)
+    assert (message.status, message.attempts, message.last_error) == ("sent", 2, None)
+
+
+def test_resend_after_lost_response_is_a_duplicate(app_module, stub, dispatcher, make_shift, monkeypatch):
+    monkeypatch.setattr(app_module, "OUTBOX_HTTP_TIMEOUT_SECONDS", 0.2)
+    _closed_shifts(make_shift, 1)
+    stub.options["latency_ms"] = 500
+    dispatcher.dispatch_once()
+    assert _messages(app_module)[0].status == "pending"
+
+    stub.options["latency_ms"] = 0
+    _make_due(app_module)
+    dispatcher.dispatch_once()
+    assert _messages(app_module)[0].status == "sent"
+    deadline = time.monotonic() + 5
+    while stub.stats["requests"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert (stub.stats["timecards"], stub.stats["duplicates"]) == (1, 1)
+
+
+def test_rejected_row_is_dead_lettered_alone(app_module, stub, dispatcher, make_shift):
+    good, bad = _closed_shifts(make_shift, 2)
+    stub.options["reject_codes"] = {bad.code}
+    assert dispatcher.dispatch_once() == 2
+    assert [(m.status, m.attempts) for m in _messages(app_module)] == [("sent", 1), ("dead", 1)]
+    assert _messages(app_module)[1].last_error.startswith("HTTP 422")
+    assert (stub.stats["rejected"], stub.stats["timecards"]) == (2, 1)
+
+    assert app_module.requeue_dead_outbox() == 1
+    assert _messages(app_module)[1].status == "pending"
+
+
+def test_refused_credentials_pause_without_dead_lettering(app_module, stub, dispatcher, make_shift):
+    _closed_shifts(make_shift, 2)
+    stub.options["token"] = "secret"
+    dispatcher.dispatch_once()
+    messages = _messages(app_module)
+    assert [(m.status, m.attempts, m.claimed_by) for m in messages] == [("pending", 0, None)] * 2
+    assert messages[0].last_error.startswith("HTTP 401")
+    # Paused: nothing is claimed or sent until the pause is over
+    _make_due(app_module)
+    assert dispatcher.dispatch_once() == 0
+    assert stub.stats["requests"] == 1
+
+    app_module.PROCORE_API_TOKEN = "secret"
+    dispatcher.http = None
+    dispatcher.paused_until = 0.0
+    assert dispatcher.dispatch_once() == 2
+    assert [m.status for m in _messages(app_module)] == ["sent"] * 2
+
+
+def test_row_by_row_fallback_stops_before_the_lease_runs_out(app_module, stub, dispatcher, make_shift, monkeypatch):
+    monkeypatch.setattr(app_module, "OUTBOX_LEASE_SECONDS", 2 * app_module.OUTBOX_HTTP_TIMEOUT_SECONDS)
+    good, bad = _closed_shifts(make_shift, 2)
+    stub.options["reject_codes"] = {bad.code}
+    dispatcher.dispatch_once()
+    assert [(m.status, m.attempts, m.claimed_by) for m in _messages(app_module)] == [("pending", 0, None)] * 2
+    assert stub.stats["requests"] == 1
+
+
+def test_bulk_close_and_recalculation_queue_timecards(app_module, stub, make_shift):
+    open_shift = make_shift("Ann Lee", "Acme", SITE, START)
+    closed = make_shift("Bob Ray", "Acme", SITE, START, START + timedelta(hours=8))
+    assert len(_messages(app_module)) == 1
+
+    app_module.bulk_shift_action("close", [open_shift.id])
+    assert app_module.json.loads(_messages(app_module)[-1].payload)["shift_id"] == open_shift.id
+
+    app_module.Shift.query.filter_by(id=closed.id).update({"working_time": "1h 0m"})
+    app_module.db.session.commit()
+    assert app_module.recalculate_shifts(dry_run=True)[1] == 1
+    assert len(_messages(app_module)) == 2
+    app_module.recalculate_shifts()
+    payload = app_module.json.loads(_messages(app_module)[-1].payload)
+    assert (payload["shift_id"], payload["working_hours"]) == (closed.id, 8.0)
+
+
+def test_benchmark_punches_never_reach_the_outbox(app_module, stub, make_shift):
+    make_shift("Bench 1", app_module.BENCHMARK_SUBCONTRACTOR, SITE, START, START + timedelta(hours=1))
+    assert _messages(app_module) == []
+    app_module.enqueue_outbox(app_module.PROCORE_TIMECARD_TOPIC, {"subcontractor": app_module.BENCHMARK_SUBCONTRACTOR})
+    app_module.db.session.commit()
+    app_module.delete_benchmark_punches()
+    assert _messages(app_module) == []
@@ -0,0 +1,33 @@
+import time
+
+import pytest
+
+
+def test_profile_requires_admin(client):
+    assert client.get("/admin/profile").status_code == 403
+
+
+def test_profile_reports_sampled_stacks(admin_client):
+    response = admin_client.get("/admin/profile?seconds=0.2&interval_ms=20&format=json")
+    assert response.status_code == 200
+    assert response.get_json()["samples"] >= 1
+
+
+@pytest.mark.parametrize("query", ["seconds=nan", "interval_ms=nan", "interval_ms=inf", "seconds=-inf", "seconds=abc"])
+def test_profile_rejects_non_finite_numbers(admin_client, query):
+    assert admin_client.get(f"/admin/profile?{query}").status_code == 400
+
+
+def test_long_interval_is_capped_by_the_window(admin_client):
+    started = time.perf_counter()
+    response = admin_client.get("/admin/profile?seconds=0.2&interval_ms=3600000&format=json")
+    assert time.perf_counter() - started < 1
+    assert response.status_code == 200
+    assert response.get_json()["interval_ms"] == 200
+
+
+def test_sample_stacks_never_sleeps_past_the_deadline(app_module):
+    started = time.perf_counter()
+    stacks, samples = app_module.sample_stacks(0.1, 4, include_idle=True)
+    assert time.perf_counter() - started < 0.5
+    assert samples == 1
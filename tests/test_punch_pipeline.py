@@ -0,0 +1,94 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def pipeline(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "PUNCH_TIMEOUT_SECONDS", 0.2)
+    return app_module.PunchPipeline()
+
+
+def test_pipeline_commits_a_group(app_module, pipeline):
+    results = []
+    threads = [threading.Thread(target=lambda n=n: results.append(pipeline.submit(lambda: n))) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == list(range(8))
+
+
+def test_punch_error_fails_only_that_punch(app_module, pipeline):
+    def rejected():
+        raise app_module.PunchError("No break to resume.")
+    with pytest.raises(app_module.PunchError, match="No break"):
+        pipeline.submit(rejected)
+    assert pipeline.submit(lambda: "ok") == "ok"
+
+
+def test_punches_commit_through_the_pipeline(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "PUNCH_PIPELINE_ENABLED", True)
+    monkeypatch.setattr(app_module, "punch_pipeline", app_module.PunchPipeline())
+    start = datetime(2024, 3, 4, 12)
+    code = app_module.run_punch(app_module.punch_clock_in, "Ann Lee", "Acme", "2025 DC water", start)
+    app_module.run_punch(app_module.punch_clock_out, code, start + timedelta(hours=8))
+    shift = app_module.Shift.query.filter_by(code=code).one()
+    assert shift.working_time == "8h 0m"
+
+
+def test_timed_out_punch_that_never_started_is_dropped(app_module, pipeline):
+    ran = []
+
+    def block_the_writer():
+        with pytest.raises(app_module.PunchPending):
+            pipeline.submit(lambda: time.sleep(0.5))
+    blocker = threading.Thread(target=block_the_writer)
+    blocker.start()
+    time.sleep(0.05)
+    with pytest.raises(app_module.PunchPending, match="not recorded"):
+        pipeline.submit(lambda: ran.append("late"))
+    blocker.join()
+    time.sleep(0.1)
+    assert ran == []
+
+
+def test_timed_out_punch_already_running_is_reported_pending(app_module, pipeline):
+    ran = []
+
+    def slow():
+        time.sleep(0.4)
+        ran.append("saved")
+    with pytest.raises(app_module.PunchPending, match="still being saved"):
+        pipeline.submit(slow)
+    time.sleep(0.4)
+    assert ran == ["saved"]
+
+
+def test_api_punch_asks_the_phone_to_resend_when_pending(app_module, client, monkeypatch):
+    def pending(*args):
+        raise app_module.PunchPending("Your punch is still being saved.")
+    monkeypatch.setattr(app_module, "run_punch", pending)
+    site_id = app_module.hashlib.md5(b"2025 DC water").hexdigest()[:8]
+    response = client.post("/api/punch", json={"key": "k1", "action": "clockout", "site": site_id,
+                                               "batch": "b", "code": "123456"})
+    assert response.status_code == 503
+
+
+def test_benchmark_runs_against_a_scratch_database(app_module):
+    live_uri = app_module.app.config["SQLALCHEMY_DATABASE_URI"]
+    result = app_module.app.test_cli_runner().invoke(args=["benchmark-punches", "--threads", "2", "--punches", "8"])
+    assert result.exit_code == 0, result.output
+    assert "punches/s" in result.output
+    assert app_module.app.config["SQLALCHEMY_DATABASE_URI"] == live_uri
+    assert app_module.ClockEvent.query.count() == 0
+    assert app_module.DataVersion.query.count() == 0
+
+
+def test_benchmark_refuses_the_live_database(app_module):
+    live_uri = app_module.app.config["SQLALCHEMY_DATABASE_URI"]
+    result = app_module.app.test_cli_runner().invoke(args=["benchmark-punches", "--database-url", live_uri])
+    assert result.exit_code != 0
+    assert "scratch database" in result.output
@@ -0,0 +1,43 @@
+def _jobs():
+    return [("2025 DC water", action, f"https://example.test/scan?site=x&batch={n}", str(n), False)
+            for n in range(3) for action in ("clockin", "clockout")]
+
+
+def test_pool_renders_the_same_posters_as_in_process(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "QR_PRINT_WORKERS", 2)
+    monkeypatch.setattr(app_module, "_qr_pool", None)
+    pool = app_module.qr_print_pool()
+    try:
+        assert pool._mp_context.get_start_method() == "spawn"
+        jobs = _jobs()
+        assert app_module.render_qr_posters(jobs) == [app_module.render_qr_poster(job) for job in jobs]
+    finally:
+        pool.shutdown()
+
+
+def test_single_worker_renders_in_process(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "QR_PRINT_WORKERS", 1)
+    monkeypatch.setattr(app_module, "_qr_pool", None)
+    jobs = _jobs()[:2]
+    assert app_module.render_qr_posters(jobs) == [app_module.render_qr_poster(job) for job in jobs]
+    assert app_module._qr_pool is None
+
+
+def test_print_all_sheet(app_module, admin_client, monkeypatch):
+    monkeypatch.setattr(app_module, "QR_PRINT_WORKERS", 1)
+    response = admin_client.get("/admin/qr_codes/print_all", query_string={"site": "2025 DC water", "format": "pdf"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+    assert response.data.startswith(b"%PDF")
+    assert admin_client.get("/admin/qr_codes/print_all", query_string={"format": "png"}).status_code == 400
+
+
+def test_pool_processes_do_not_import_the_app(app_module):
+    import subprocess
+    import sys
+
+    # What a spawned pool process loads to unpickle render_qr_poster
+    assert app_module.render_qr_poster.__module__ == "qr_posters"
+    check = "import sys, qr_posters; sys.exit(bool({'app', 'flask', 'sqlalchemy'} & set(sys.modules)))"
+    root = app_module.os.path.dirname(app_module.__file__)
+    assert subprocess.run([sys.executable, "-c", check], cwd=root).returncode == 0
@@ -0,0 +1,67 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+SITE = "2025 DC water"
+START = datetime(2024, 3, 4, 12)
+
+
+@pytest.fixture
+def replica(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "REPLICA_DATABASE_URL", "sqlite:///" + os.path.join(tmp_path, "replica.db"))
+    monkeypatch.setattr(app_module, "_replica_state", {"engine": None, "sessionmaker": None, "down_until": 0.0})
+    runner = app_module.app.test_cli_runner()
+
+    def sync():
+        result = runner.invoke(args=["sync-replica"])
+        assert result.exit_code == 0, result.output
+    yield sync
+    app_module._replica_state["engine"].dispose()
+
+
+def _shift(make_shift, name):
+    return make_shift(name, "Acme", SITE, START, START + timedelta(hours=8))
+
+
+def _request(app_module, send, *args, **kwargs):
+    # Its own app context, as in production: the test's writes mark the outer g as written
+    with app_module.app.app_context():
+        return send(*args, **kwargs)
+
+
+def _admin_page(app_module, admin_client):
+    return _request(app_module, admin_client.get, "/admin").get_data(as_text=True)
+
+
+def test_admin_reads_come_from_the_replica(app_module, admin_client, make_shift, replica):
+    _shift(make_shift, "Ann Lee")
+    replica()
+    _shift(make_shift, "Bob Ray")
+    page = _admin_page(app_module, admin_client)
+    assert "Ann Lee" in page and "Bob Ray" not in page
+    replica()
+    assert "Bob Ray" in _admin_page(app_module, admin_client)
+
+
+def test_admin_sees_their_own_write_before_the_replica_does(app_module, admin_client, make_shift, replica):
+    ann_id = _shift(make_shift, "Ann Lee").id
+    _shift(make_shift, "Bob Ray")
+    replica()
+    _request(app_module, admin_client.post, f"/admin/delete/{ann_id}")
+    with admin_client.session_transaction() as flask_session:
+        assert flask_session["read_version"]
+    assert "Ann Lee" not in _admin_page(app_module, admin_client)
+    # Once the replica has caught up it is used again
+    replica()
+    _admin_page(app_module, admin_client)
+    with admin_client.session_transaction() as flask_session:
+        assert "read_version" not in flask_session
+
+
+def test_unreachable_replica_falls_back_to_the_primary(app_module, admin_client, make_shift, monkeypatch):
+    monkeypatch.setattr(app_module, "REPLICA_DATABASE_URL", "sqlite:////nonexistent/dir/replica.db")
+    monkeypatch.setattr(app_module, "_replica_state", {"engine": None, "sessionmaker": None, "down_until": 0.0})
+    _shift(make_shift, "Ann Lee")
+    assert "Ann Lee" in _admin_page(app_module, admin_client)
+    assert app_module._replica_state["down_until"] > 0
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+SITE = "2025 DC water"
+START = datetime(2024, 3, 4, 12)
+
+
+def _tamper(app_module, shift_id, **values):
+    app_module.Shift.query.filter_by(id=shift_id).update(values)
+    app_module.db.session.commit()
+
+
+def test_dry_run_reports_without_writing(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    make_shift("Bob Ray", "Acme", SITE, START, START + timedelta(hours=8))
+    _tamper(app_module, shift.id, working_time="1h 0m")
+    checked, changed, sample = app_module.recalculate_shifts(dry_run=True)
+    assert (checked, changed) == (2, 1)
+    assert sample == [(shift.id, {"working_time": ("1h 0m", "8h 0m")})]
+    app_module.db.session.expire_all()
+    assert app_module.Shift.query.get(shift.id).working_time == "1h 0m"
+
+
+def test_recalculation_fixes_rows_and_logs_them(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, START)
+    app_module.run_punch(app_module.punch_break_start, shift.code, START + timedelta(hours=2))
+    app_module.run_punch(app_module.punch_break_end, shift.code, START + timedelta(hours=2, minutes=30))
+    app_module.run_punch(app_module.punch_clock_out, shift.code, START + timedelta(hours=8))
+    _tamper(app_module, shift.id, total_time="", working_time="", breaks="")
+    assert app_module.recalculate_shifts(subcontractor="Acme")[:2] == (1, 1)
+    app_module.db.session.expire_all()
+    fixed = app_module.Shift.query.get(shift.id)
+    assert (fixed.total_time, fixed.working_time) == ("8h 0m", "7h 30m")
+    assert fixed.breaks
+    assert app_module.ClockEvent.query.filter_by(kind="recalculate", shift_id=shift.id).count() == 1
+    assert app_module.recalculate_shifts()[:2] == (1, 0)
+
+
+def test_auto_closed_marker_is_kept(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=24))
+    _tamper(app_module, shift.id, breaks="AUTO-CLOSED", working_time="0h 0m")
+    app_module.recalculate_shifts()
+    app_module.db.session.expire_all()
+    fixed = app_module.Shift.query.get(shift.id)
+    assert (fixed.breaks, fixed.working_time) == ("AUTO-CLOSED", "24h 0m")
+
+
+def test_admin_route_defaults_to_a_dry_run(app_module, admin_client, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    _tamper(app_module, shift.id, working_time="1h 0m")
+    result = admin_client.post("/admin/shifts/recalculate", data={"ids": str(shift.id)}).get_json()
+    assert (result["dry_run"], result["changed"]) == (True, 1)
+    assert admin_client.post("/admin/shifts/recalculate", data={"ids": "x"}).status_code == 400
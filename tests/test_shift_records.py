@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+SITE = "2025 DC water"
+START = datetime(2024, 3, 4, 12)
+
+
+def test_records_are_detached_and_filtered(app_module, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    make_shift("Bob Ray", "Beta Co", SITE, START + timedelta(days=1), START + timedelta(days=1, hours=8))
+    records = list(app_module.shift_records(subcontractor="Acme"))
+    app_module.db.session.remove()
+    assert [(r.name, r.working_time, r.flag_reasons) for r in records] == [("Ann Lee", "8h 0m", None)]
+    assert [r.name for r in app_module.shift_records()] == ["Bob Ray", "Ann Lee"]
+
+
+def test_shift_export_streams_csv_with_validators(app_module, admin_client, make_shift):
+    start = datetime(2024, 3, 4, 12)
+    make_shift("Ann Lee", "Acme", SITE, start, start + timedelta(hours=8))
+    make_shift("Bob Ray", "Beta Co", SITE, start, start + timedelta(hours=8))
+    response = admin_client.get("/admin/export/shifts", query_string={"subcontractor": "Acme"})
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0].startswith("ID,Name,Subcontractor")
+    assert len(lines) == 2 and "Ann Lee" in lines[1]
+    again = admin_client.get("/admin/export/shifts", query_string={"subcontractor": "Acme"},
+                             headers={"If-None-Match": response.headers["ETag"]})
+    assert again.status_code == 304
+
+
+def test_shift_export_needs_a_login(app_module, client):
+    assert client.get("/admin/export/shifts").status_code == 302
+
+
+def test_admin_page_streams_the_listing(app_module, admin_client, make_shift):
+    empty = admin_client.get("/admin")
+    assert empty.is_streamed
+    assert "No shifts found" in empty.get_data(as_text=True)
+    make_shift("Ann Lee", "Acme", SITE, START, START + timedelta(hours=8))
+    page = admin_client.get("/admin").get_data(as_text=True)
+    assert "Ann Lee" in page and "No shifts found" not in page
+
+
+def test_flashes_are_shown_once_on_the_streamed_page(app_module, admin_client):
+    with admin_client.session_transaction() as flask_session:
+        flask_session["_flashes"] = [("success", "Shift deleted.")]
+    assert "Shift deleted." in admin_client.get("/admin").get_data(as_text=True)
+    assert "Shift deleted." not in admin_client.get("/admin").get_data(as_text=True)
@@ -0,0 +1,56 @@
+import csv
+import io
+from datetime import datetime
+
+SITE = "2025 DC water"  # America/New_York
+
+
+def _rows(response):
+    return list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+
+
+def test_weekly_timesheet_splits_overtime(admin_client, make_shift):
+    # Mon-Fri, 10h a day in March (EST, UTC-5)
+    for day in range(4, 9):
+        make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, day, 12), datetime(2024, 3, day, 22))
+    response = admin_client.get("/admin/timesheets?start=2024-03-04&end=2024-03-10")
+    assert response.status_code == 200
+    [row] = _rows(response)
+    assert row["Week Start"] == "2024-03-04"
+    assert row["Total Hours"] == "50.00"
+    assert row["Regular Hours"] == "40.00"
+    assert row["Overtime Hours"] == "10.00"
+
+
+def test_timesheet_shift_is_split_at_site_midnight(admin_client, make_shift):
+    # 20:00-04:00 local: 4h on Monday, 4h on Tuesday
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 5, 1), datetime(2024, 3, 5, 9))
+    [row] = _rows(admin_client.get("/admin/timesheets?start=2024-03-04&end=2024-03-10"))
+    assert (row["Mon"], row["Tue"]) == ("4.00", "4.00")
+
+
+def test_timesheets_reject_start_after_end(admin_client):
+    response = admin_client.get("/admin/timesheets?start=2024-03-10&end=2024-03-01")
+    assert response.status_code == 400
+
+
+def test_timesheets_require_admin(client):
+    assert client.get("/admin/timesheets").status_code == 302
+
+
+def test_timesheets_command_writes_csv(app_module, make_shift):
+    make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 12), datetime(2024, 3, 4, 20))
+    result = app_module.app.test_cli_runner().invoke(args=["timesheets", "--start", "2024-03-04", "--end", "2024-03-10"])
+    assert result.exit_code == 0
+    [row] = list(csv.DictReader(io.StringIO(result.output)))
+    assert (row["Name"], row["Total Hours"]) == ("Ann Lee", "8.00")
+
+
+def test_timesheets_command_rejects_end_before_start(app_module):
+    result = app_module.app.test_cli_runner().invoke(args=["timesheets", "--end", "2020-01-01"])
+    assert result.exit_code != 0
+    assert "start date is after end date" in result.output
+
+
+def test_empty_calendar_yields_nothing(app_module):
+    assert list(app_module.iter_weekly_timesheets(datetime(2024, 3, 11).date(), datetime(2024, 3, 1).date())) == []
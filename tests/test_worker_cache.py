@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+SITE = "2025 DC water"
+
+
+def test_lookups_are_served_from_the_cache(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime.now() - timedelta(hours=1))
+    assert app_module.lookup_worker(code=shift.code).name == "Ann Lee"
+    assert app_module.lookup_open_shift("Ann Lee", "Acme") == (shift.id, SITE)
+    app_module.db.session.commit()
+    assert app_module.worker_cache.get_worker(code=shift.code)[1] == "Ann Lee"
+    assert app_module.worker_cache.get_open_shift("Ann Lee", "Acme") == (True, (shift.id, SITE))
+
+
+def test_clock_out_replaces_the_cached_open_shift(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime.now() - timedelta(hours=1))
+    app_module.lookup_open_shift("Ann Lee", "Acme")
+    app_module.db.session.commit()
+    app_module.run_punch(app_module.punch_clock_out, shift.code, datetime.now())
+    assert app_module.lookup_open_shift("Ann Lee", "Acme") is None
+    again = make_shift("Ann Lee", "Acme", SITE, datetime.now())
+    assert again.code == shift.code
+    assert app_module.lookup_open_shift("Ann Lee", "Acme") == (again.id, SITE)
+
+
+def test_renamed_worker_is_not_served_stale(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 12), datetime(2024, 3, 4, 20))
+    app_module.lookup_worker(code=shift.code)
+    app_module.db.session.commit()
+    worker = app_module.WorkerCode.query.filter_by(code=shift.code).one()
+    worker.name = "Ann Leigh"
+    app_module.db.session.commit()
+    assert app_module.lookup_worker(code=shift.code).name == "Ann Leigh"
+    assert app_module.lookup_worker(name="Ann Lee", subcontractor="Acme") is None
+
+
+def test_a_rolled_back_write_leaves_the_cache_alone(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 12), datetime(2024, 3, 4, 20))
+    app_module.lookup_worker(code=shift.code)
+    app_module.db.session.commit()
+    worker = app_module.WorkerCode.query.filter_by(code=shift.code).one()
+    worker.name = "Ann Leigh"
+    app_module.db.session.flush()
+    app_module.db.session.rollback()
+    assert app_module.lookup_worker(code=shift.code).name == "Ann Lee"
+
+
+def test_open_shift_answers_age_out_quickly(app_module, make_shift, monkeypatch):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime.now() - timedelta(hours=1))
+    app_module.lookup_open_shift("Ann Lee", "Acme")
+    app_module.db.session.commit()
+    assert app_module.worker_cache.get_open_shift("Ann Lee", "Acme") == (True, (shift.id, SITE))
+    # Another host clocks the worker out; nothing drops this host's entry
+    later = app_module.time.time() + app_module.WORKER_CACHE_OPEN_SHIFT_TTL + 1
+    monkeypatch.setattr(app_module.time, "time", lambda: later)
+    assert app_module.worker_cache.get_open_shift("Ann Lee", "Acme") == (False, None)
+
+
+def test_a_new_process_keeps_the_shared_entries(app_module, make_shift):
+    shift = make_shift("Ann Lee", "Acme", SITE, datetime(2024, 3, 4, 12), datetime(2024, 3, 4, 20))
+    app_module.lookup_worker(code=shift.code)
+    app_module.db.session.commit()
+    restarted = app_module.WorkerCodeCache(app_module.WORKER_CACHE_SIZE)
+    assert restarted.get_worker(code=shift.code)[1] == "Ann Lee"
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+SITE = "2025 DC water"
+START = datetime(2024, 3, 4, 12)
+
+
+def _workers(make_shift, *names):
+    for name, subcontractor in names:
+        make_shift(name, subcontractor, SITE, START, START + timedelta(hours=8))
+
+
+def test_prefix_substring_and_misspelling(app_module, make_shift):
+    _workers(make_shift, ("Jonathan Smith", "Acme"), ("Maria Lopez", "Acme"), ("Jon Ray", "Beta Co"))
+    assert [r["name"] for r in app_module.search_workers("jon")] == ["Jon Ray", "Jonathan Smith"]
+    assert [r["name"] for r in app_module.search_workers("lope")] == ["Maria Lopez"]
+    assert [r["name"] for r in app_module.search_workers("Jonathon Smith")][0] == "Jonathan Smith"
+    assert [r["name"] for r in app_module.search_workers("jon", subcontractor="Beta Co")] == ["Jon Ray"]
+    assert app_module.search_workers("j") == []
+
+
+def test_search_api_returns_codes_to_admins(app_module, admin_client, make_shift):
+    _workers(make_shift, ("Maria Lopez", "Acme"))
+    results = admin_client.get("/api/workers/search", query_string={"q": "maria"}).get_json()["results"]
+    code = app_module.WorkerCode.query.one().code
+    assert [(r["name"], r["code"]) for r in results] == [("Maria Lopez", code)]
+
+
+def test_search_api_needs_a_login(app_module, client):
+    assert client.get("/api/workers/search", query_string={"q": "maria"}).status_code == 403
+
+
+def _clock_in(client, name, subcontractor, **extra):
+    return client.post("/", data={"action": "clockin", "name": name, "subcontractor": subcontractor,
+                                  "job_site": SITE, **extra})
+
+
+def test_similar_name_asks_for_a_code_without_naming_anyone(app_module, client, make_shift):
+    _workers(make_shift, ("Jonathan Smith", "Acme"), ("Jonathon Smyth", "Other Co"))
+    code = app_module.WorkerCode.query.filter_by(name="Jonathan Smith").one().code
+    response = _clock_in(client, "Jonathan Smit", "Acme")
+    page = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'value="quickclockin"' in page
+    for secret in ("Jonathan Smith", "Jonathon Smyth", code):
+        assert secret not in page
+    assert app_module.Shift.query.filter_by(clock_out=None).count() == 0
+
+
+def test_returning_worker_clocks_in_with_their_code(app_module, client, make_shift):
+    _workers(make_shift, ("Jonathan Smith", "Acme"))
+    code = app_module.WorkerCode.query.filter_by(name="Jonathan Smith").one().code
+    client.post("/", data={"action": "quickclockin", "code": "000000" if code != "000000" else "999999",
+                           "job_site": SITE})
+    assert app_module.Shift.query.filter_by(clock_out=None).count() == 0
+    client.post("/", data={"action": "quickclockin", "code": code, "job_site": SITE})
+    assert app_module.Shift.query.filter_by(name="Jonathan Smith", clock_out=None).count() == 1
+    assert app_module.WorkerCode.query.count() == 1
+
+
+def test_confirmed_new_name_clocks_in(app_module, client, make_shift):
+    _workers(make_shift, ("Jonathan Smith", "Acme"))
+    response = _clock_in(client, "Jonathan Smit", "Acme", confirm_new="1")
+    assert response.status_code == 302
+    assert app_module.Shift.query.filter_by(name="Jonathan Smit", clock_out=None).count() == 1
+
+
+def test_similar_name_at_another_subcontractor_is_not_offered(app_module, client, make_shift):
+    _workers(make_shift, ("Jonathan Smith", "Acme"))
+    assert _clock_in(client, "Jonathan Smit", "Other Co").status_code == 302
+    assert app_module.find_similar_worker("Jonathan Smit", "Other Co") is None